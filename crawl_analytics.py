@@ -0,0 +1,254 @@
+'''	crawl_analytics: the rating breakdowns of crawl_stats.R (by area,
+	neighborhood, cuisine and feature, and for its cash only, wheelchair,
+	happy hour and over-5-reviews subsets) over the scraped venues held as
+	NumPy columns, quick enough to run after every crawl.
+
+	Run with e.g.:
+		python crawl_analytics.py --db                          # the menupages MySQL db
+		python crawl_analytics.py --db-file menupages.sqlite    # or its SQLite stand-in
+		python crawl_analytics.py --jsonl menupages.jsonl.gz --by area,feature
+		python crawl_analytics.py --db --json > breakdowns.json
+'''
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+import optparse
+import gzip, json
+
+import numpy as np
+
+from crawl_records import FEATURES
+
+RATINGS = ('average', 'food', 'value', 'service', 'atmosphere')
+GROUPS = ('area', 'neighborhood', 'cuisine')
+
+
+def _factor(values):
+	''' (codes, labels): values as int codes into their sorted distinct labels, None as u'' '''
+	labels, codes = np.unique(np.array([v or u'' for v in values] or [u''], dtype=object), return_inverse=True)
+	return codes[:len(values)].astype(np.int32), list(labels)
+
+
+def _unpack(masks, width):
+	''' A bool matrix, a row per int mask and a column per bit, `width` bits wide '''
+	matrix = np.zeros((len(masks), width), dtype=bool)
+	for lo in xrange(0, width, 64):
+		bits = min(width - lo, 64)
+		words = np.array([m >> lo & 0xFFFFFFFFFFFFFFFF for m in masks], dtype=np.uint64)
+		matrix[:, lo:lo+bits] = (words[:, None] >> np.arange(bits, dtype=np.uint64)) & np.uint64(1)
+	return matrix
+
+
+def _rows(rows, dedupe):
+	'''	With dedupe, leave out what crawl_stats.R does: venues under a /menu
+		url (the venue's own page is crawled too), then all but the first of a name '''
+	if not dedupe:
+		return list(rows)
+	kept, names = [], set()
+	for row in rows:
+		if '/menu' in row[1] or row[0] in names:
+			continue
+		names.add(row[0])
+		kept.append(row)
+	return kept
+
+
+class VenueFrame(object):
+	'''	The scraped venues as columns, a row per venue: names and urls as
+		lists; area, neighborhood and cuisine as int codes into sorted label
+		lists (self.areas, self.neighborhoods, self.cuisines); the review
+		count and a (venues x RATINGS) float matrix of ratings; and the
+		features as a bool matrix with a column for each bit of the
+		crawl_records.FEATURES masks (self.feature_names).  Built from rows of
+		(name, url, area, neighborhood, cuisine, count, (ratings), feature
+		mask); see the from_* constructors.
+	'''
+	def __init__(self, rows, vocab=FEATURES):
+		cols = zip(*rows) or [()] * 8
+		self.names, self.urls = list(cols[0]), list(cols[1])
+		self.area, self.areas = _factor(cols[2])
+		self.neighborhood, self.neighborhoods = _factor(cols[3])
+		self.cuisine, self.cuisines = _factor(cols[4])
+		self.count = np.array([c or 0 for c in cols[5]], dtype=np.int32)
+		self.ratings = np.array(cols[6], dtype=np.float64).reshape(len(self.names), len(RATINGS))
+		self.feature_names = list(vocab.members)
+		self.features = _unpack(cols[7], len(self.feature_names))
+
+	def __len__(self):
+		return len(self.names)
+
+	@classmethod
+	def from_profiles(cls, profiles, dedupe=True):
+		''' From profile dicts or Venue records (a crawl's restaurants, an export) '''
+		def row(p):
+			r = p['ratings'] or {}
+			mask = getattr(p, 'feature_mask', None)
+			if mask is None:
+				mask = FEATURES.encode(p['features'])
+			return (p['name'], p['mp_url'], p['area'], p['neighborhood'], p['cuisine'],
+					r.get('count', 0), tuple([r.get(k) for k in RATINGS]), mask)
+		return cls(_rows(map(row, profiles), dedupe))
+
+	@classmethod
+	def from_jsonl(cls, fname, dedupe=True):
+		''' From a JsonlSink export (gzipped if fname ends in .gz) '''
+		fp = fname.endswith('.gz') and gzip.open(fname, 'rb') or open(fname, 'rb')
+		try:
+			return cls.from_profiles([json.loads(line) for line in fp if line.strip()], dedupe)
+		finally:
+			fp.close()
+
+	@classmethod
+	def from_db(cls, conn, dedupe=True):
+		''' From the venue tables (see mp_setup.sql), over a MySQLdb or sqlite3 connection '''
+		cursor = conn.cursor()
+		try:
+			cursor.execute('SELECT rest_id, feature FROM venue_feature')
+			masks = {}
+			for rest_id, feature in cursor.fetchall():
+				masks[rest_id] = masks.get(rest_id, 0) | FEATURES.bit(feature)
+			cursor.execute('SELECT v.rest_id, v.name, v.url, v.area, v.neighborhood, d.cuisine, r.count, '
+						   + ', '.join(['r.' + k for k in RATINGS])
+						   + ' FROM venue v JOIN detail d ON d.rest_id = v.rest_id'
+						   ' JOIN rating r ON r.rest_id = v.rest_id ORDER BY v.rest_id')
+			rows = [tuple(v[1:7]) + (tuple(v[7:]), masks.get(v[0], 0)) for v in cursor.fetchall()]
+		finally:
+			cursor.close()
+		return cls(_rows(rows, dedupe))
+
+	def featuring(self, feature):
+		''' Bool mask of the venues with feature (none, for a feature never seen) '''
+		if feature not in self.feature_names:
+			return np.zeros(len(self), dtype=bool)
+		return self.features[:, self.feature_names.index(feature)]
+
+	def _rated(self, mask):
+		rated = self.count > 0  # crawl_stats.R's DF: unrated venues have 0s, not ratings
+		return rated if mask is None else rated & mask
+
+	def breakdown(self, by, mask=None):
+		'''	[(label, venues, reviews, mean of each of RATINGS)] for each `by`
+			group (area, neighborhood or cuisine) with rated venues among those
+			selected by mask, in label order '''
+		labels = getattr(self, by + 's')
+		keep = self._rated(mask)
+		codes = getattr(self, by)[keep]
+		n = len(labels)
+		venues = np.bincount(codes, minlength=n)
+		reviews = np.bincount(codes, weights=self.count[keep], minlength=n)
+		ratings = self.ratings[keep]
+		sums = np.column_stack([np.bincount(codes, weights=ratings[:, k], minlength=n)
+								for k in xrange(len(RATINGS))]).reshape(n, len(RATINGS))
+		return self._table(labels, venues, reviews, sums)
+
+	def feature_breakdown(self, mask=None, absent=False):
+		'''	The same for each feature: the rated venues with it, or with absent
+			those without it (absent 'Accepts Credit Cards' being cash only) '''
+		keep = self._rated(mask)
+		features = self.features[keep]
+		if absent:
+			features = ~features
+		f = features.T.astype(np.float64)  # (features x venues)
+		return self._table(self.feature_names, f.sum(1), f.dot(self.count[keep]), f.dot(self.ratings[keep]))
+
+	@staticmethod
+	def _table(labels, venues, reviews, sums):
+		groups = np.flatnonzero(venues)
+		means = sums[groups] / venues[groups][:, None]
+		return [(labels[g], int(venues[g]), int(reviews[g])) + tuple(means[i].tolist())
+				for i, g in enumerate(groups)]
+
+	def venues(self, mask=None):
+		'''	[(name, area, cuisine, count, ratings...)] of the rated venues mask
+			selects, ordered by area then cuisine, like crawl_stats.R's subsets '''
+		rows = np.flatnonzero(self._rated(mask))
+		rows = rows[np.lexsort((self.cuisine[rows], self.area[rows]))]
+		return [(self.names[i], self.areas[self.area[i]], self.cuisines[self.cuisine[i]], int(self.count[i]))
+				+ tuple(self.ratings[i].tolist()) for i in rows]
+
+
+# crawl_stats.R's subsets of interest: (name, the venues in it)
+SUBSETS = (
+	('cash only', lambda frame: ~frame.featuring(u'Accepts Credit Cards')),
+	('wheelchair friendly', lambda frame: frame.featuring(u'Wheelchair Friendly')),
+	('happy hour', lambda frame: frame.featuring(u'Happy Hour')),
+	('over 5 reviews', lambda frame: frame.count > 5),
+)
+
+
+def summarize(frame, by=GROUPS + ('feature',)):
+	'''	{group: breakdown} for each of by (feature giving feature_breakdown),
+		and {'subsets': {subset: {'venues': n, 'area': .., 'cuisine': ..}}} '''
+	summary = {}
+	for group in by:
+		summary[group] = frame.feature_breakdown() if group == 'feature' else frame.breakdown(group)
+	summary['subsets'] = {}
+	for name, select in SUBSETS:
+		mask = select(frame)
+		summary['subsets'][name] = {'venues': int(np.count_nonzero(frame._rated(mask))),
+									'area': frame.breakdown('area', mask),
+									'cuisine': frame.breakdown('cuisine', mask)}
+	return summary
+
+
+def format_breakdown(title, rows):
+	lines = ["%-40s %7s %8s %s" % (title, 'venues', 'reviews', ' '.join(['%10s' % k for k in RATINGS]))]
+	for row in rows:
+		label = row[0] or '-'
+		if isinstance(label, unicode):
+			label = label.encode('utf-8')
+		lines.append("%-40s %7d %8d %s" % ((label, row[1], row[2]) + (' '.join(['%10.2f' % v for v in row[3:]]),)))
+	return '\n'.join(lines)
+
+
+def report(summary):
+	''' summarize's breakdowns as text tables '''
+	out = []
+	for group in GROUPS + ('feature',):
+		if group in summary:
+			out.append(format_breakdown('by ' + group, summary[group]))
+	for name, select in SUBSETS:
+		sub = summary['subsets'][name]
+		out.append(format_breakdown('%s (%d venues), by area' % (name, sub['venues']), sub['area']))
+	return '\n\n'.join(out)
+
+
+if __name__ == "__main__":
+	optp = optparse.OptionParser(usage="%prog --db | --db-file FILE | --jsonl FILE [options]")
+	optp.add_option('--db', action='store_true', dest='db', default=False,
+					help="read the menupages MySQL db")
+	optp.add_option('--db-file', dest='db_file', default=None, metavar='FILE',
+					help="read this SQLite stand-in for it instead")
+	optp.add_option('--jsonl', dest='jsonl', default=None, metavar='FILE',
+					help="read a --jsonl export instead")
+	optp.add_option('--by', dest='by', default=','.join(GROUPS + ('feature',)),
+					help="comma separated breakdowns: area, neighborhood, cuisine, feature [%default]")
+	optp.add_option('--all', action='store_false', dest='dedupe', default=True,
+					help="keep /menu urls and repeated names, which are left out by default")
+	optp.add_option('--json', action='store_true', dest='json', default=False,
+					help="print the breakdowns as one JSON object")
+	opts, args = optp.parse_args()
+	by = tuple(opts.by.split(','))
+	for group in by:
+		if group not in GROUPS + ('feature',):
+			optp.error("unknown breakdown: %s" % group)
+
+	if opts.jsonl:
+		frame = VenueFrame.from_jsonl(opts.jsonl, opts.dedupe)
+	elif opts.db_file or opts.db:
+		if opts.db_file:
+			import sqlite3
+			conn = sqlite3.connect(opts.db_file)
+		else:
+			from crawl_sink import connect_db
+			conn = connect_db()
+		frame = VenueFrame.from_db(conn, opts.dedupe)
+		conn.close()
+	else:
+		optp.error("pick a source: --db, --db-file or --jsonl")
+
+	summary = summarize(frame, by)
+	if opts.json:
+		print json.dumps(summary, sort_keys=True)
+	else:
+		print report(summary)
@@ -0,0 +1,995 @@
+'''	crawl_bench: timing harnesses for the hot paths of menupages_crawl.
+
+	Run one with e.g.:
+		python crawl_bench.py linkqueue --size 200000
+		python crawl_bench.py extract saved_pages/
+
+	and, offline against a local stand-in for the site, whole crawls:
+		python crawl_bench.py record pages.warc.gz -n 500     # save a corpus from the live site
+		python crawl_bench.py crawl --corpus pages.warc.gz    # replay it
+		python crawl_bench.py crawl --pages 10000             # or a generated site of that size
+		python crawl_bench.py suite > new.jsonl               # 1k, 10k and 100k pages, 0 and 2 parsers
+		python crawl_bench.py compare old.jsonl new.jsonl     # exits 1 on a regression
+		python crawl_bench.py shards --pages 10000 --shards 1,2,4   # sharded crawls, by shard count
+		python crawl_bench.py reviews --pages 200             # review paging, and its cutoff on a recrawl
+		python crawl_bench.py dbload --pages 100000            # upserts vs a bulk reload, into sqlite
+		python crawl_bench.py analytics                        # crawl_analytics vs crawl_stats.R, on mp_setup.sql
+		python crawl_bench.py analytics --pages 100000         # ... and on a generated db of that size
+		python crawl_bench.py imports                          # start-up times; exits 1 if over budget
+'''
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+import optparse, os, re, sys, time
+from datetime import date, timedelta
+import compileall, gzip, hashlib, json, multiprocessing, platform, resource, shutil, sqlite3, subprocess, tempfile, threading, urlparse, uuid
+import BaseHTTPServer, SocketServer
+from cStringIO import StringIO
+
+import menupages_crawl
+from menupages_crawl import MpCrawler, ReviewPager, parse_profile, find_restaurant_links, process_page, list_uniques, crawl_shard, log
+from crawl_cluster import Cluster
+from crawl_sink import DbSink, BulkLoader
+from crawl_records import MEALS, FEATURES
+from crawl_metrics import METRICS
+from crawl_utils import fetch_page, HTTP_POOL
+from BeautifulSoup import BeautifulSoup, SoupStrainer
+
+
+def bench_link_queue(size=200000, batch=100, checkpoints=(1000, 10000, 100000)):
+	'''	Push batches of venue links through MpCrawler.__update_link_queue while
+		moving links from the queue to the crawled set, and report the cost
+		per candidate url as the queue and crawled set grow.  Each batch mixes
+		new links with ones already queued or crawled, like a real venue page.
+	'''
+	crawler = MpCrawler('')
+	update = crawler._MpCrawler__update_link_queue
+	marks = sorted(set([c for c in checkpoints if c < size] + [size]))
+	results = []
+	seen, elapsed, ncand = 0, 0.0, 0
+	while seen < size:
+		links = ['/restaurants/venue-%d/' % i for i in xrange(seen, seen + batch)]
+		# a few links back to pages we already know about
+		links.extend(['/restaurants/venue-%d/' % (i // 2) for i in xrange(seen, seen + batch, 10)])
+		start = time.time()
+		update(links)
+		elapsed += time.time() - start
+		ncand += len(links)
+		seen += batch
+
+		# pretend the crawl caught up on half of what was queued
+		for i in xrange(batch // 2):
+			url, tag = crawler.link_queue.popitem(last=False)
+			crawler.crawled.add(url)
+
+		if seen >= marks[0]:
+			results.append((seen, len(crawler.link_queue), len(crawler.crawled), 1e6 * elapsed / ncand))
+			elapsed, ncand = 0.0, 0
+			marks.pop(0)
+	return results
+
+
+class _Quiet(object):
+	''' stand-in for sys.stdout that swallows the crawler's per-page prints '''
+	def write(self, s):
+		pass
+
+	def flush(self):
+		pass  # multiprocessing.Pool flushes stdout as it forks the parsers
+
+
+def load_pages(paths):
+	''' Read saved html pages from files and (recursively) from directories '''
+	pages = []
+	for path in paths:
+		if os.path.isdir(path):
+			for root, dirs, files in os.walk(path):
+				pages.extend([os.path.join(root, f) for f in sorted(files)])
+		else:
+			pages.append(path)
+	return [(p, open(p, 'rb').read()) for p in pages]
+
+
+def _soup_profile(doc, url):
+	'''	The scraper parse_profile replaced, kept to check it against and time it
+		by: builds a full BeautifulSoup tree and searches it once per field.
+		Returns the venue name and the profile dict. '''
+	pparser = BeautifulSoup(doc)
+	info_tags = ['meta', 'li', 'span', 'tr', 'div']
+	
+	''' Cheating for now: using known structure of restaurant pages to pull out relevant info '''
+	venue_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('restaurant', 2)})
+	
+	try:
+		assert venue_tag, "No Tag Reference Found"
+		venue_txt = venue_tag[0]['content'].rsplit('-')[0]
+
+	except Exception, e:
+		log("Unretrievable Info Or Non-Restaurant Page")
+		log("Non-Exit Failure: " + str(e)) # DEBUG statement
+		return '', None
+	
+
+	profile = dict.fromkeys([
+									'name', 'street address', 'city', 
+									'zip-code', 'area', 'neighborhood', 
+									'cuisine', 'meals', 'features',
+									'ratings', 'reviews'])
+	
+	profile['mp_url'] = url
+	profile['name'] = venue_txt
+	
+	street_tag = pparser.fetch(info_tags, attrs = {'class' : re.compile('street.address')})
+	profile['street address'] = street_tag[0].text
+	
+	city_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('city')})
+	profile['city'] = city_tag[0]['content']
+	
+	postal_tag = pparser.fetch(info_tags, attrs = {'class' : re.compile('postal.code')})
+	profile['zip-code'] = postal_tag[0].text
+	
+	area_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('area')})
+	profile['area'] = area_tag[0]['content']
+	
+	hood_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('neighborhood')})
+	profile['neighborhood'] = hood_tag[0]['content']
+	
+	cuisine_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('cuisine')})
+	profile['cuisine'] = cuisine_tag[0]['content']
+	
+	meals_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('meal')})
+	profile['meals'] = map(lambda(x): x['content'], meals_tag)
+
+	features_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('feature')})
+	profile['features'] = map(lambda(x): x['content'], features_tag)
+	
+	ratings_tag = pparser.fetch(info_tags, attrs = {'id' : re.compile('restaurant.ratings')})
+	
+	# If there are no ratings (or reviews) then we should dismiss this profile
+	if not ratings_tag:
+		return '', profile
+		
+	# Store ratings items in a dictionary (not the most efficient for memory but simpler code)
+	ratings_dct = { 
+		'count' : 0, 'average' : 0.0, 
+		'food' : 0.0, 'value' : 0.0, 
+		'service' : 0.0, 'atmosphere' : 0.0
+		}
+		
+	# Descend the tag structure to gather the necessary data items to put into dictionary
+	info_tags.append('table') # a few more tags needed for combing the structure; exclude "td"
+	info_tags.append('th')
+	
+	itm_fetch = lambda(s): ratings_tag[0].fetch(info_tags, attrs = {'class' : re.compile(s)})
+	# Slightly different treatment depending on where each element resides in the table structure
+	''' 
+	##  In the future a few helper functions to traverse the tag structure and "find" relevant elements
+	##  would allow this to be more generic; relying on known structure of mp's restaurant profile html
+	##  for now.  There's no reason that these items need to be hardcoded -- but would require
+	##  a lexical ontology from which parsing can take place.
+	'''
+	
+	ratings_dct['count'] = int(itm_fetch('count')[0].text)
+	if ratings_dct['count']:  # if there are no ratings, other values will be non-existent
+		ratings_dct['average'] = float(itm_fetch('average')[0].text)
+		ratings_dct['food'] = float(itm_fetch('food.rating')[0].first().text)
+		ratings_dct['value'] = float(itm_fetch('value.rating')[0].first().text)
+		ratings_dct['service'] = float(itm_fetch('service.rating')[0].first().text)
+		ratings_dct['atmosphere'] = float(itm_fetch('atmosphere.rating')[0].first().text)
+	
+	# Assign it to the ratings key
+	profile['ratings'] = ratings_dct
+	
+	
+	info_tags = ['p', 'li', 'cite', 'h6', 'span']  # Review items are nested in these tags
+	reviews_tag = pparser.fetch(info_tags, attrs = {'class' : re.compile('comment.\w*')})
+	
+	profile['reviews'] = []
+	
+	select_itm = lambda s,m: m.fetch(info_tags, attrs = {'class' : re.compile(s)})
+	# Just the reviews listed on this page -- to get all the reviews we'd have to make AJAX calls to
+	# paginate through and pull in the ones on other pages for this restaurant
+	for tag in reviews_tag:
+		# Store reviews in a dictionary too
+		reviews_dct = {
+			'reviewer' : '', 'dtreviewed' : '',
+			'summary' : '', 'comment' : ''
+			}
+		reviews_dct['reviewer'] = select_itm('reviewer', tag)[0].text
+		_dt_str = select_itm('dtreviewed', tag)[0].text
+		if _dt_str != '':
+			_dt_mdy = map(int, _dt_str.encode().split('/'))
+			reviews_dct['dtreviewed'] = date(_dt_mdy[2], _dt_mdy[0], _dt_mdy[1]).isoformat()
+		reviews_dct['summary'] = select_itm('summary', tag)[0].text
+		reviews_dct['comment'] = select_itm('description', tag)[0].text
+		
+		# Finally -- append it to the list of reviews for this url
+		profile['reviews'].append(reviews_dct)
+	
+	return venue_txt, profile
+
+
+def _soup_page(doc, url):
+	''' profile and links the way crawl used to get them: two BeautifulSoup parses '''
+	venue, profile = _soup_profile(doc, url)
+	if profile is not None:  # as parse_profile gives them, to compare against
+		profile['meals'] = MEALS.normalize(profile['meals'])
+		profile['features'] = FEATURES.normalize(profile['features'])
+	linkfilt = SoupStrainer('a', href = re.compile('/?restaurants?/'))
+	links = list_uniques([tag['href'] for tag in BeautifulSoup(doc, parseOnlyThese=linkfilt)])
+	return venue, profile, links
+
+
+def _two_pass_page(doc, url):
+	venue, profile = parse_profile(doc, url)
+	return venue, profile, find_restaurant_links(doc)
+
+
+EXTRACTORS = [
+	('beautifulsoup', _soup_page),
+	('spec, two passes', _two_pass_page),
+	('spec, one pass', lambda doc, url: process_page(doc, url)),
+	]
+
+
+def bench_extract(pages, repeat=3):
+	'''	Time getting the profile and restaurant links out of each page, on one
+		core: the old pair of BeautifulSoup parses, the FieldSpec extractor run
+		once for the profile and once for links, and process_page doing both in
+		one pass.  Also checks that all of them agree.
+	'''
+	results = []
+	outputs = []
+	real_stdout = sys.stdout
+	for name, extract in EXTRACTORS:
+		best = None
+		for r in xrange(repeat):
+			out = []
+			sys.stdout = _Quiet()
+			try:
+				start = time.time()
+				for url, doc in pages:
+					try:
+						out.append(extract(doc, url))
+					except Exception, e:
+						out.append(type(e))  # a page the extraction chokes on costs the same in all
+				elapsed = time.time() - start
+			finally:
+				sys.stdout = real_stdout
+			best = min(best or elapsed, elapsed)
+		results.append((name, len(pages) / best))
+		outputs.append(out)
+	return results, all(out == outputs[0] for out in outputs)
+
+
+## Recorded pages: WARC files in, a local http server out
+
+class WarcWriter(object):
+	'''	Appends fetched pages to a WARC/1.0 file as response records, each one
+		its own gzip member when the file name ends in .gz (as warc tools expect). '''
+	def __init__(self, path):
+		self.fp = open(path, 'ab')
+		self.compress = path.endswith('.gz')
+		self.count = 0
+		self._lock = threading.Lock()
+
+	def write(self, url, page):
+		status = page.get('status') == 304 and 200 or page.get('status') or 200  # the cached body was a 200
+		head = ['HTTP/1.1 %d %s' % (status, BaseHTTPServer.BaseHTTPRequestHandler.responses.get(status, ('',))[0]),
+				'Content-Type: text/html']
+		for name, key in (('ETag', 'etag'), ('Last-Modified', 'lastmodified')):
+			if page.get(key):
+				head.append('%s: %s' % (name, page[key]))
+		http = '\r\n'.join(head) + '\r\n\r\n' + (page.get('data') or '')
+		record = '\r\n'.join(['WARC/1.0', 'WARC-Type: response', 'WARC-Target-URI: %s' % url,
+			'WARC-Date: %s' % time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+			'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+			'Content-Type: application/http; msgtype=response',
+			'Content-Length: %d' % len(http)]) + '\r\n\r\n' + http + '\r\n\r\n'
+		if self.compress:
+			buf = StringIO()
+			gz = gzip.GzipFile(fileobj=buf, mode='wb')
+			gz.write(record)
+			gz.close()
+			record = buf.getvalue()
+		self._lock.acquire()
+		try:
+			self.fp.write(record)
+			self.count += 1
+		finally:
+			self._lock.release()
+
+	def close(self):
+		self.fp.close()
+
+
+def read_warc(path):
+	''' (url, status, body) of each response record in a WARC file, gzipped or not '''
+	fp = path.endswith('.gz') and gzip.open(path, 'rb') or open(path, 'rb')
+	try:
+		while True:
+			line = fp.readline()
+			if not line:
+				break
+			if not line.startswith('WARC/'):
+				continue
+			headers = {}
+			for line in iter(fp.readline, '\r\n'):
+				if not line:
+					break
+				name, _, value = line.partition(':')
+				headers[name.strip().lower()] = value.strip()
+			block = fp.read(int(headers.get('content-length', 0)))
+			if headers.get('warc-type') != 'response':
+				continue
+			head, _, body = block.partition('\r\n\r\n')
+			status = int(head.split(' ', 2)[1])
+			yield headers['warc-target-uri'], status, body
+	finally:
+		fp.close()
+
+
+class RecordingFetch(object):
+	''' fetch_page, saving each page it gets to a WarcWriter (see MpCrawler.fetch) '''
+	def __init__(self, writer, fetch=fetch_page):
+		self.writer = writer
+		self.fetch = fetch
+
+	def __call__(self, url, **kwargs):
+		page = self.fetch(url, **kwargs)
+		if page.get('status') in (200, 304):
+			self.writer.write(url, page)
+		return page
+
+
+def corpus_pages(path):
+	'''	{path?query: html} of the 200s in a WARC file, with absolute links back
+		to the recorded site made relative so a replay never leaves it. '''
+	pages = {}
+	for url, status, body in read_warc(path):
+		if status != 200:
+			continue
+		parts = urlparse.urlsplit(url)
+		body = body.replace('%s://%s/' % (parts.scheme, parts.netloc), '/')
+		pages[parts.path + (parts.query and '?' + parts.query or '')] = body
+	return pages
+
+
+class _ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+class ReplaySite(object):
+	'''	Local http stand-in for the site: serves `pages` (a dict of path?query
+		-> html, or a function of it returning html or None for a 404) over
+		keep-alive HTTP/1.1 with ETags and gzip, on `port` of 127.0.0.1 (or a
+		free one; pass a closed site's port to serve new pages at its url).  It runs in a forked process, so serving doesn't take CPU (or the GIL)
+		from the crawl being measured.  url is the base to crawl from.
+	'''
+	def __init__(self, pages, port=0):
+		lookup = callable(pages) and pages or pages.get
+
+		class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+			protocol_version = 'HTTP/1.1'
+			wbufsize = -1  # whole response in one send (flushed after each request), no Nagle stalls
+
+			def do_GET(self):
+				body = lookup(self.path)
+				if body is None:
+					return self._send(404, 'not found')
+				etag = '"%s"' % hashlib.md5(body).hexdigest()
+				if self.headers.get('If-None-Match') == etag:
+					return self._send(304, '', [('ETag', etag)])
+				headers = [('ETag', etag), ('Content-Type', 'text/html')]
+				if 'gzip' in self.headers.get('Accept-Encoding', ''):
+					buf = StringIO()
+					gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=1)
+					gz.write(body)
+					gz.close()
+					body = buf.getvalue()
+					headers.append(('Content-Encoding', 'gzip'))
+				self._send(200, body, headers)
+
+			def _send(self, status, body, headers=()):
+				self.send_response(status)
+				for name, value in headers:
+					self.send_header(name, value)
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+			def log_message(self, *args):
+				pass
+
+		self.server = _ThreadedServer(('127.0.0.1', port), Handler)
+		self.url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+		self.process = multiprocessing.Process(target=self.server.serve_forever)
+		self.process.daemon = True
+		self.process.start()
+
+	def close(self):
+		self.process.terminate()
+		self.process.join()
+		self.server.server_close()
+
+
+class SyntheticSite(object):
+	'''	A made-up site of `venues` venue pages, generated on request and the same
+		every time: the home page links the first ten venues, and each venue
+		page has a profile, a few reviews, and links to five other venues (the
+		next one among them, so all are reachable) and to area and cuisine pages.
+		With review_pages, each venue has that many pages of REVIEWS_PER_PAGE
+		reviews, newest first, the first on its own page and the rest under
+		/restaurants/venue-N/reviews/?page=2 and on (see ReviewPager), and
+		new_reviews posted since then on top, the first of them dated the same
+		day as the newest of the others.
+	'''
+	AREAS = ['east-village', 'soho', 'chelsea', 'midtown', 'harlem', 'tribeca']
+	CUISINES = ['american-new', 'french', 'italian', 'thai', 'pizza', 'sushi', 'mexican']
+	MEALS = ['breakfast', 'lunch', 'brunch', 'dinner']
+	FEATURES = ['Accepts Credit Cards', 'BYOB', 'Delivery', 'Happy Hour', 'Outdoor Dining', 'Take Out', 'WiFi']
+	VENUE_RE = re.compile(r'^/restaurants/venue-(\d+)/$')
+	REVIEWS_RE = re.compile(r'^/restaurants/venue-(\d+)/reviews/\?page=(\d+)$')
+	REVIEWS_PER_PAGE = 3
+
+	def __init__(self, venues, review_pages=0, new_reviews=0):
+		self.venues = venues
+		self.review_pages = review_pages
+		self.new_reviews = new_reviews
+
+	def __call__(self, path):
+		if path == '/':
+			return '<html><body>%s</body></html>' % ' '.join(
+				['<a href="/restaurants/venue-%d/">x</a>' % i for i in xrange(min(10, self.venues))])
+		m = self.VENUE_RE.match(path)
+		if m and int(m.group(1)) < self.venues:
+			return self.venue(int(m.group(1)))
+		m = self.REVIEWS_RE.match(path)
+		if m and int(m.group(1)) < self.venues:
+			return self.review_page(int(m.group(1)), int(m.group(2)))
+		for kind in ('manhattan', 'cuisine'):
+			if path.startswith('/restaurants/%s/' % kind):
+				return '<html><body>%s</body></html>' % path
+		return None
+
+	def reviews(self, i):
+		''' The html of venue i's reviews, newest first '''
+		review = lambda r, when: (
+			'<li class="comment hreview"><cite class="reviewer">diner %d</cite>'
+			'<span class="dtreviewed">%d/%d/%d</span><h6 class="summary">Visit %d</h6>'
+			'<p class="description">The <b>food</b> at venue %d, take %d</p></li>'
+			% (r, when.month, when.day, when.year, r, i, r))
+		if not self.review_pages:
+			return [review(r, date(2011, 1 + (i + r) % 12, 1 + (i * r) % 28)) for r in xrange(1 + i % 3)]
+		newest = date(2011, 6, 1) - timedelta(i % 30)
+		new = [review(1000 + r, newest + timedelta(r)) for r in xrange(self.new_reviews)]
+		return new[::-1] + [review(r, newest - timedelta(r)) for r in xrange(self.REVIEWS_PER_PAGE * self.review_pages)]
+
+	def _review_list(self, i, page):
+		''' Page `page` of venue i's reviews and the link on to the next, if there is one '''
+		reviews = self.reviews(i)
+		per = self.review_pages and self.REVIEWS_PER_PAGE or len(reviews)
+		more = page * per < len(reviews) and '<a href="/restaurants/venue-%d/reviews/?page=%d">more</a>\n' % (i, page + 1) or ''
+		return '<ul>\n%s\n</ul>\n%s' % ('\n'.join(reviews[(page - 1) * per:page * per]), more)
+
+	def review_page(self, i, page):
+		if page < 2 or (page - 1) * self.REVIEWS_PER_PAGE >= len(self.reviews(i)) or not self.review_pages:
+			return None
+		return '<html><head><title>Venue %d reviews</title></head><body>\n%s</body></html>' % (i, self._review_list(i, page))
+
+	def venue(self, i):
+		n = self.venues
+		meta = [('restaurant', 'Venue %d - Menupages' % i), ('city', 'New York'), ('area', 'Manhattan'),
+				('neighborhood', self.AREAS[i % len(self.AREAS)].title()),
+				('cuisine', self.CUISINES[i % len(self.CUISINES)])]
+		meta += [('meal', m) for j, m in enumerate(self.MEALS) if i >> j & 1]
+		meta += [('feature', f) for j, f in enumerate(self.FEATURES) if (i * 7) >> j & 1]
+		reviews = self.reviews(i)
+		nearby = [(i + 1) % n, (3 * i + 1) % n, (7 * i + 2) % n, i // 2, (i * i + 5) % n]
+		return ''.join([
+			'<html><head><title>Venue %d</title>\n' % i,
+			''.join(['<meta name="%s" content="%s"/>\n' % kv for kv in meta]),
+			'</head><body>\n<div class="adr"><span class="street-address">%d W. %dth St.</span> '
+			'<span class="locality">NY</span> <span class="postal-code">%05d</span></div>\n' % (i, 1 + i % 99, 10001 + i % 280),
+			'<div id="restaurant-ratings"><table>\n<tr><th class="count">%d</th></tr>\n' % len(reviews),
+			'<tr><th class="average">%.1f</th></tr>\n' % (1 + i % 9 / 2.0),
+			''.join(['<tr><th class="%s-rating"><span>%.1f</span></th></tr>\n' % (k, 1 + (i + j) % 9 / 2.0)
+					 for j, k in enumerate(('food', 'value', 'service', 'atmosphere'))]),
+			'</table></div>\n%s' % self._review_list(i, 1),
+			'<p>Nearby: %s ' % ' '.join(['<a href="/restaurants/venue-%d/">x</a>' % j for j in nearby]),
+			'<a href="/restaurants/manhattan/%s/">area</a> ' % self.AREAS[i % len(self.AREAS)],
+			'<a href="/restaurants/cuisine/%s/">c</a></p>\n</body></html>' % self.CUISINES[i % len(self.CUISINES)]])
+
+
+## Whole crawls
+
+def _stage(name):
+	t = METRICS.snapshot()['timings'].get(name)
+	if t is None:
+		return None
+	return {'count': t['count'], 'mean_ms': 1e3 * t['mean'], 'p99_ms': 1e3 * t['p99'], 'total_s': t['total']}
+
+
+def _timed_calls(fn, args):
+	''' mean ms of fn(*a) over args, quietly '''
+	real_stdout, sys.stdout = sys.stdout, _Quiet()
+	try:
+		start = time.time()
+		for a in args:
+			fn(*a)
+		return 1e3 * (time.time() - start) / max(len(args), 1)
+	finally:
+		sys.stdout = real_stdout
+
+
+def _rss_mb():
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0  # KB on Linux
+
+
+def bench_crawl(site, n, sample, workers=8, parsers=0, source=''):
+	'''	Crawl a ReplaySite end to end with MpCrawler.crawl, quietly, then write
+		what it scraped with output_csv and output_db (to sqlite), and time
+		scrape_profile and scan_restaurant_links over the (url, html) pairs in
+		`sample`.  Returns a dict: throughput, the per-page stage timings the
+		crawl recorded (fetch_page, its time to first byte, parsing, the link
+		queue update), the per-venue cost of each output and the peak RSS.
+	'''
+	menupages_crawl.BASE_URL = site.url
+	menupages_crawl.VERBOSE = False
+	METRICS.reset()
+	rss_before = _rss_mb()
+	real_stdout, sys.stdout = sys.stdout, _Quiet()  # crawl's summary prints
+	try:
+		start = time.time()
+		crawler = MpCrawler(fetch_page(site.url)['data'])
+		crawler.close()
+		crawler.scan_restaurant_links()
+		crawler.crawl(n, workers, workers, 0.0, parsers)
+		elapsed = time.time() - start
+	finally:
+		sys.stdout = real_stdout
+	result = {'bench': 'crawl', 'source': source, 'pages_requested': n, 'workers': workers, 'parsers': parsers,
+			  'python': platform.python_version(), 'when': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+			  'pages': len(crawler.crawled), 'venues': len(crawler.restaurants), 'seconds': elapsed,
+			  'pages_per_sec': len(crawler.crawled) / elapsed, 'http': HTTP_POOL.stats(),
+			  'stages': {'fetch_page': _stage('fetch'), 'ttfb': _stage('ttfb'), 'parse': _stage('parse'),
+						 'update_link_queue': _stage('link_queue')}}
+	venues = max(len(crawler.restaurants), 1)
+	tmp = tempfile.mkdtemp()
+	try:
+		result['stages']['output_csv'] = {'per_venue_ms': _timed_calls(
+			crawler.output_csv, [(os.path.join(tmp, 'bench'),)]) / venues}
+		conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+		result['stages']['output_db'] = {'per_venue_ms': _timed_calls(crawler.output_db, [(conn,)]) / venues}
+		conn.close()
+	finally:
+		shutil.rmtree(tmp)
+	result['stages']['scrape_profile'] = {'mean_ms': _timed_calls(MpCrawler('').scrape_profile,
+																  [(doc, url) for url, doc in sample])}
+	result['stages']['scan_restaurant_links'] = {'mean_ms': _timed_calls(MpCrawler('').scan_restaurant_links,
+																		 [(doc,) for url, doc in sample])}
+	result['rss_before_mb'] = rss_before
+	result['peak_rss_mb'] = _rss_mb()
+	return result
+
+
+def crawl_synthetic(pages, workers=8, parsers=0):
+	site = SyntheticSite(pages)
+	sample = [('restaurants/venue-%d/' % i, site.venue(i)) for i in xrange(min(pages, 500))]
+	replay = ReplaySite(site)
+	try:
+		return bench_crawl(replay, pages, sample, workers, parsers, 'synthetic')
+	finally:
+		replay.close()
+
+
+def crawl_corpus(path, workers=8, parsers=0):
+	pages = corpus_pages(path)
+	replay = ReplaySite(pages)
+	try:
+		sample = [(urlparse.urljoin(replay.url, p.lstrip('/')), doc) for p, doc in sorted(pages.items())[:500]]
+		return bench_crawl(replay, len(pages), sample, workers, parsers, 'corpus:' + os.path.basename(path))
+	finally:
+		replay.close()
+
+
+def record_corpus(path, n, base, workers=4, delay=1.0):
+	'''	Crawl up to n pages from base (politely: two at a time per host, `delay`
+		seconds apart), saving every page fetched to the WARC file at path. '''
+	writer = WarcWriter(path)
+	try:
+		fetch = RecordingFetch(writer)
+		menupages_crawl.BASE_URL = base
+		crawler = MpCrawler(fetch(base)['data'])
+		crawler.close()
+		crawler.scan_restaurant_links()
+		crawler.fetch = fetch
+		crawler.crawl(n, workers, 2, delay)
+		return writer.count
+	finally:
+		writer.close()
+
+
+def _quiet_shard(*args, **kwargs):
+	sys.stdout = open(os.devnull, 'w')  # flushed on the way out of the process, unlike _Quiet
+	crawl_shard(*args, **kwargs)
+
+
+def crawl_sharded(pages, shards, workers=8, parsers=0):
+	'''	A sharded crawl (see crawl_cluster) of a generated site of `pages`
+		venues, by `shards` local shard processes of `workers` fetch threads
+		each.  Returns throughput, the pages each shard took and the merged
+		stage timings; run it for 1, 2, 4 ... shards to see how it scales. '''
+	replay = ReplaySite(SyntheticSite(pages))
+	menupages_crawl.BASE_URL = replay.url
+	menupages_crawl.VERBOSE = False
+	METRICS.reset()
+	try:
+		start = time.time()
+		crawler = MpCrawler(fetch_page(replay.url)['data'])
+		crawler.close()
+		crawler.scan_restaurant_links()
+		crawler.keep_profiles = False
+		profiles = _Counter()
+		crawler.sinks = [profiles]
+		cluster = Cluster(shards, base_url=replay.url, max_pages=pages)
+		procs = [multiprocessing.Process(target=_quiet_shard, args=(cluster.address, i),
+										 kwargs={'workers': workers, 'host_limit': workers, 'parsers': parsers})
+				 for i in xrange(shards)]
+		done = cluster.run(crawler, procs)
+		elapsed = time.time() - start
+	finally:
+		replay.close()
+	crawled = sum([d['pages'] for d in done.values()])
+	return {'bench': 'shards', 'source': 'synthetic', 'pages_requested': pages, 'shards': shards,
+			'workers': workers, 'parsers': parsers, 'python': platform.python_version(),
+			'when': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()), 'cpus': multiprocessing.cpu_count(),
+			'pages': crawled, 'venues': profiles.written, 'seconds': elapsed, 'pages_per_sec': crawled / elapsed,
+			'pages_by_shard': [done[i]['pages'] for i in sorted(done)],
+			'stages': {'fetch_page': _stage('fetch'), 'parse': _stage('parse'), 'update_link_queue': _stage('link_queue')}}
+
+
+class _Counter(object):
+	''' A sink that only counts '''
+	written = 0
+
+	def add(self, profile):
+		self.written += 1
+
+	def flush(self):
+		pass
+
+
+def bench_reviews(venues, review_pages=4, new_reviews=4, workers=4):
+	'''	Crawl a generated site of `venues` venues with `review_pages` pages of
+		reviews each, with a ReviewPager and a DbSink (to sqlite), then crawl
+		it again once `new_reviews` more have been posted per venue, the first
+		of them on the day of the last crawl's newest (and, past the first
+		page's three, left to the pager to find).  The second crawl should
+		page only as far back as that day, and the db end up with every review
+		once, the same-day one included.  Returns the review pages each crawl
+		fetched, the reviews in the db and 'ok' if all that held.
+	'''
+	menupages_crawl.VERBOSE = False
+	tmp = tempfile.mkdtemp()
+	conn = sqlite3.connect(os.path.join(tmp, 'reviews.db'), check_same_thread=False)
+	fetched = []
+	port = 0
+	try:
+		for new in (0, new_reviews):
+			# the same url both times, so the second crawl updates the first's venues
+			replay = ReplaySite(SyntheticSite(venues, review_pages, new), port)
+			port = replay.server.server_address[1]
+			menupages_crawl.BASE_URL = replay.url
+			real_stdout, sys.stdout = sys.stdout, _Quiet()
+			try:
+				crawler = MpCrawler(fetch_page(replay.url)['data'])
+				crawler.close()
+				crawler.scan_restaurant_links()
+				crawler.pager = ReviewPager(workers, 100, workers)
+				crawler.sinks = [DbSink(conn)]
+				crawler.crawl(-1, workers, workers)
+				crawler.pager.close()
+			finally:
+				sys.stdout = real_stdout
+				replay.close()
+				HTTP_POOL.close()  # its kept-alive connections went with the server
+			fetched.append(crawler.pager.fetched)
+		reviews = conn.execute('SELECT COUNT(*) FROM reviews').fetchone()[0]
+		same_day = conn.execute("SELECT COUNT(DISTINCT rest_id) FROM reviews WHERE reviewer = 'diner 1000'").fetchone()[0]
+	finally:
+		conn.close()
+		shutil.rmtree(tmp)
+	expected = venues * (SyntheticSite.REVIEWS_PER_PAGE * review_pages + new_reviews)
+	return {'bench': 'reviews', 'source': 'synthetic', 'pages_requested': venues, 'review_pages': review_pages,
+			'new_reviews': new_reviews, 'fetched': fetched, 'reviews': reviews, 'expected_reviews': expected,
+			'ok': (fetched[0] == venues * (review_pages - 1) and fetched[1] < fetched[0] and reviews == expected
+				   and (not new_reviews or same_day == venues))}
+
+
+def _venue_profiles(venues):
+	''' `venues` profiles: the generated site's first 1000, over and over under new urls '''
+	menupages_crawl.VERBOSE = False
+	site = SyntheticSite(1000)
+	base = [parse_profile(site.venue(i), None)[1] for i in xrange(1000)]
+	for i in xrange(venues):
+		profile = dict(base[i % len(base)])
+		profile['mp_url'] = 'http://www.menupages.com/restaurants/venue-%d/' % i
+		yield profile
+
+
+def bench_db_load(venues=100000):
+	'''	Write `venues` profiles (the generated site's, under as many urls) to a
+		fresh sqlite stand-in db, once through DbSink's batched upserts and once
+		through BulkLoader's reload.  Returns (sink, seconds, venue rows) each. '''
+	results = []
+	for sink_class in (DbSink, BulkLoader):
+		tmp = tempfile.mkdtemp()
+		try:
+			conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+			start = time.time()
+			sink = sink_class(conn)
+			for profile in _venue_profiles(venues):
+				sink.add(profile)
+			sink.close()
+			elapsed = time.time() - start
+			results.append((sink_class.__name__, elapsed, conn.execute('SELECT COUNT(*) FROM venue').fetchone()[0]))
+			conn.close()
+		finally:
+			shutil.rmtree(tmp)
+	return results
+
+
+def _r_pipeline():
+	''' crawl_stats.R as far as its rating subsets, before the model fitting and plots '''
+	src = open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crawl_stats.R')).read()
+	return src[:src.index('# Predict food rating')]
+
+
+def bench_analytics(venues=None, repeat=3):
+	'''	crawl_analytics' breakdowns, loaded from the db and summarized in
+		process (best of `repeat`) and as a whole command, against the same
+		data through crawl_stats.R's merges and greps with Rscript.  With
+		venues=None that is the menupages MySQL db (load mp_setup.sql into it
+		first); otherwise a sqlite stand-in holding that many generated venues,
+		which RMySQL can't read, so R is left out.  Returns [(name, seconds)].
+	'''
+	from crawl_analytics import VenueFrame, summarize
+	tmp = tempfile.mkdtemp()
+	try:
+		if venues is None:
+			from crawl_sink import connect_db
+			conn, source = connect_db(), ['--db']
+		else:
+			conn = sqlite3.connect(os.path.join(tmp, 'bench.db'))
+			source = ['--db-file', os.path.join(tmp, 'bench.db')]
+			sink = BulkLoader(conn)
+			for profile in _venue_profiles(venues):
+				sink.add(profile)
+			sink.close()
+		results = []
+		best = None
+		for i in xrange(repeat):
+			start = time.time()
+			summarize(VenueFrame.from_db(conn))
+			best = min(best, time.time() - start) if best is not None else time.time() - start
+		results.append(('python (in process)', best))
+		conn.close()
+
+		script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'crawl_analytics.py')
+		start = time.time()
+		subprocess.check_call([sys.executable, script, '--json'] + source, stdout=open(os.devnull, 'w'))
+		results.append(('python (command)', time.time() - start))
+		if venues is None and any(os.access(os.path.join(d, 'Rscript'), os.X_OK)
+								  for d in os.environ.get('PATH', '').split(os.pathsep)):
+			r_script = os.path.join(tmp, 'crawl_stats_data.R')
+			open(r_script, 'w').write(_r_pipeline())
+			start = time.time()
+			subprocess.check_call(['Rscript', r_script], stdout=open(os.devnull, 'w'))
+			results.append(('R (crawl_stats.R)', time.time() - start))
+	finally:
+		shutil.rmtree(tmp)
+	return results
+
+
+# (name, what a fresh interpreter runs, budget in ms): the start-up cost of a
+# cron job or worker process, up to its first useful work.  PAGE is a venue page.
+IMPORT_CHECKS = (
+	('crawl_utils', 'import crawl_utils', 15),
+	('crawl_store', 'import crawl_store', 25),
+	('crawl_sink', 'import crawl_sink', 10),
+	('menupages_crawl', 'import menupages_crawl', 40),
+	('first profile', 'import menupages_crawl; menupages_crawl.parse_profile(PAGE, None)', 50),
+)
+
+
+def bench_imports(checks=IMPORT_CHECKS, repeat=5):
+	'''	Run each check's statement in a fresh interpreter `repeat` times and
+		return (name, best ms, modules loaded, budget ms) for each.  The
+		modules are timed from a copy in a scratch directory, so the .pyc
+		files compiled for it don't land in the checkout. '''
+	here = os.path.dirname(os.path.abspath(__file__))
+	tmp = tempfile.mkdtemp()
+	try:
+		src = os.path.join(tmp, 'src')
+		os.mkdir(src)
+		for fname in os.listdir(here):
+			if fname.endswith('.py'):
+				shutil.copy(os.path.join(here, fname), src)
+		compileall.compile_dir(src, maxlevels=0, quiet=True)  # as installed: from .pyc, not compiling the source
+		page = os.path.join(tmp, 'venue.html')
+		open(page, 'wb').write(SyntheticSite(10).venue(1))
+		results = []
+		for name, stmt, budget in checks:
+			code = ('import sys, time\nPAGE = open(%r, "rb").read()\nn = len(sys.modules)\nstart = time.time()\n%s\n'
+					'print time.time() - start, len(sys.modules) - n' % (page, stmt))
+			runs = []
+			for i in xrange(repeat):
+				out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], cwd=src)
+				seconds, modules = out.split()[-2:]
+				runs.append((float(seconds), int(modules)))
+			results.append((name, 1000 * min(runs)[0], min(runs)[1], budget))
+	finally:
+		shutil.rmtree(tmp)
+	return results
+
+
+SUITE_SCALES = (1000, 10000, 100000)
+SUITE_PARSERS = (0, 2)  # parsing in the crawl's thread, and in a pool of parser processes
+
+
+def run_suite(scales=SUITE_SCALES, workers=8, parsers=SUITE_PARSERS):
+	'''	bench_crawl on a synthetic site at each scale, with each number of
+		parser processes, each in a process of its own so the peak memory
+		reported is that run's alone. '''
+	for pages in scales:
+		for procs in parsers:
+			out = subprocess.check_output([sys.executable, os.path.abspath(__file__), 'crawl', '--pages', str(pages),
+										   '--workers', str(workers), '--parsers', str(procs)])
+			yield json.loads(out.strip().splitlines()[-1])
+
+
+# (name, better): figures compare looks at, 'higher' or 'lower' being better
+def _figures(result):
+	figures = [('pages_per_sec', 'higher', result.get('pages_per_sec')),
+			   ('peak_rss_mb', 'lower', result.get('peak_rss_mb'))]
+	for stage, t in sorted((result.get('stages') or {}).items()):
+		for k in ('mean_ms', 'per_venue_ms'):
+			if t and k in t:
+				figures.append(('%s.%s' % (stage, k), 'lower', t[k]))
+	return figures
+
+
+def compare(old, new, tolerance=0.10, floor_ms=0.01):
+	'''	Match up runs in two lists of results by (bench, source, pages, shards,
+		parsers) and list every figure that got worse by more than tolerance
+		(a fraction).  Stage timings under floor_ms are too small to judge and
+		are skipped. '''
+	key = lambda r: (r.get('bench'), r.get('source'), r.get('pages_requested'), r.get('shards'), r.get('parsers', 0))
+	before = dict([(key(r), r) for r in old])
+	rows = []
+	for r in new:
+		base = before.get(key(r))
+		if base is None:
+			continue
+		was = dict([(name, v) for name, better, v in _figures(base)])
+		for name, better, v in _figures(r):
+			w = was.get(name)
+			if v is None or not w or (name.endswith('_ms') and w < floor_ms):
+				continue
+			change = (v - w) / float(w)
+			regressed = better == 'higher' and change < -tolerance or better == 'lower' and change > tolerance
+			rows.append((key(r), name, w, v, change, regressed))
+	return rows
+
+
+def load_results(path):
+	return [json.loads(line) for line in open(path) if line.strip()]
+
+
+if __name__ == "__main__":
+	optp = optparse.OptionParser(usage="%prog linkqueue|extract|record|crawl|suite|compare|shards|reviews|dbload|analytics|imports [options] [args...]")
+	optp.add_option('--size', type='int', dest='size', default=200000,
+					help="linkqueue: number of distinct urls to push through [%default]")
+	optp.add_option('--repeat', type='int', dest='repeat', default=3,
+					help="extract/analytics/imports: passes over the pages (or data), best one counts [%default]")
+	optp.add_option('--pages', type='int', dest='pages', default=1000,
+					help="crawl/shards/reviews: venues on the generated site; dbload/analytics: profiles to write [%default]")
+	optp.add_option('--corpus', dest='corpus', default=None,
+					help="crawl: replay the pages in this WARC file instead")
+	optp.add_option('--scales', dest='scales', default=','.join(map(str, SUITE_SCALES)),
+					help="suite: comma separated site sizes [%default]")
+	optp.add_option('--shards', dest='shards', default='1,2,4',
+					help="shards: comma separated shard counts to crawl with [%default]")
+	optp.add_option('--review-pages', type='int', dest='review_pages', default=4,
+					help="reviews: pages of reviews per venue [%default]")
+	optp.add_option('--new-reviews', type='int', dest='new_reviews', default=4,
+					help="reviews: reviews posted per venue before the recrawl [%default]")
+	optp.add_option('-w', '--workers', type='int', dest='workers', default=8,
+					help="record/crawl/suite/shards/reviews: fetch threads (per shard) [%default]")
+	optp.add_option('-p', '--parsers', type='int', dest='parsers', default=0,
+					help="crawl/shards: parser processes (per shard) [%%default]; "
+						 "suite: the pool to run besides none [%d]" % SUITE_PARSERS[-1])
+	optp.add_option('-n', type='int', dest='n', default=200,
+					help="record: pages to crawl [%default]")
+	optp.add_option('--base', dest='base', default=menupages_crawl.BASE_URL,
+					help="record: site to crawl [%default]")
+	optp.add_option('--delay', type='float', dest='delay', default=1.0,
+					help="record: seconds between requests to the site [%default]")
+	optp.add_option('--tolerance', type='float', dest='tolerance', default=0.10,
+					help="compare: allowed fractional slowdown [%default]")
+	opts, args = optp.parse_args()
+
+	if args[:1] == ['linkqueue']:
+		print "%10s %10s %10s %12s" % ('urls', 'queued', 'crawled', 'usec/url')
+		for row in bench_link_queue(opts.size):
+			print "%10d %10d %10d %12.2f" % row
+
+	elif args[:1] == ['extract']:
+		pages = load_pages(args[1:])
+		if not pages:
+			optp.error("extract needs saved html pages (files or directories)")
+		rates, same = bench_extract(pages, opts.repeat)
+		for name, rate in rates:
+			print "%-20s %10.1f pages/sec/core %6.1fx" % (name, rate, rate / rates[0][1])
+		print "identical profiles and links: %s" % same
+
+	elif args[:1] == ['record']:
+		if len(args) != 2:
+			optp.error("record needs the WARC file to write")
+		print "recorded %d pages to %s" % (record_corpus(args[1], opts.n, opts.base, opts.workers, opts.delay), args[1])
+
+	elif args[:1] == ['crawl']:
+		# one JSON object per line, to append to a results file
+		if opts.corpus:
+			print json.dumps(crawl_corpus(opts.corpus, opts.workers, opts.parsers), sort_keys=True)
+		else:
+			print json.dumps(crawl_synthetic(opts.pages, opts.workers, opts.parsers), sort_keys=True)
+
+	elif args[:1] == ['suite']:
+		parsers = opts.parsers and (0, opts.parsers) or SUITE_PARSERS
+		for result in run_suite(map(int, opts.scales.split(',')), opts.workers, parsers):
+			print json.dumps(result, sort_keys=True)
+			sys.stdout.flush()
+
+	elif args[:1] == ['shards']:
+		for shards in map(int, opts.shards.split(',')):
+			print json.dumps(crawl_sharded(opts.pages, shards, opts.workers, opts.parsers), sort_keys=True)
+			sys.stdout.flush()
+
+	elif args[:1] == ['reviews']:
+		result = bench_reviews(opts.pages, opts.review_pages, opts.new_reviews, opts.workers)
+		print json.dumps(result, sort_keys=True)
+		if not result['ok']:
+			sys.exit(1)
+
+	elif args[:1] == ['dbload']:
+		for name, seconds, rows in bench_db_load(opts.pages):
+			print "%-12s %8.2f s %10.0f venues/sec %8d venue rows" % (name, seconds, opts.pages / seconds, rows)
+
+	elif args[:1] == ['analytics']:
+		# the mp_setup.sql data in MySQL unless --pages is given
+		venues = opts.pages if [a for a in sys.argv[1:] if a.split('=')[0] == '--pages'] else None
+		for name, seconds in bench_analytics(venues, opts.repeat):
+			print "%-22s %8.3f s" % (name, seconds)
+
+	elif args[:1] == ['imports']:
+		rows = bench_imports(repeat=opts.repeat)
+		for name, ms, modules, budget in rows:
+			print "%-16s %8.1f ms %5d modules   budget %4d ms %s" % (name, ms, modules, budget, ms > budget and 'OVER' or '')
+		if any(ms > budget for name, ms, modules, budget in rows):
+			sys.exit(1)
+
+	elif args[:1] == ['compare']:
+		if len(args) != 3:
+			optp.error("compare needs the old and new results files")
+		rows = compare(load_results(args[1]), load_results(args[2]), opts.tolerance)
+		for (bench, source, pages, shards, parsers), name, was, now, change, regressed in rows:
+			print "%-6s %-18s %7s p%-2s %-34s %12.4f %12.4f %+7.1f%% %s" % (
+				bench, source, pages, parsers, name, was, now, 100 * change, regressed and 'REGRESSION' or '')
+		if any(row[-1] for row in rows):
+			sys.exit(1)
+
+	else:
+		optp.error("pick a benchmark: linkqueue, extract, record, crawl, suite, compare, shards, reviews, dbload, analytics or imports")
@@ -0,0 +1,266 @@
+import hashlib, threading, time, Queue
+from multiprocessing.managers import BaseManager
+
+from crawl_records import Venue
+from crawl_metrics import METRICS
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' Sharded Crawls Across Processes and Machines '''
+
+AUTHKEY = 'menupages'
+
+
+def shard_of(url, shards):
+	''' The shard (0 .. shards-1) that owns url: the same in every process and on every machine '''
+	if isinstance(url, unicode):
+		url = url.encode('utf-8')
+	return int(hashlib.md5(url).hexdigest()[:8], 16) % shards
+
+
+class _Config(object):
+	def __init__(self, config):
+		self.config = config
+
+	def get(self):
+		return self.config
+
+
+class _Budget(object):
+	''' The pages left for the shards to crawl between them (None for no limit) '''
+	def __init__(self, pages):
+		self.left = pages
+		self.lock = threading.Lock()  # the manager serves each shard's connection in a thread of its own
+
+	def take(self):
+		''' Reserve a page to crawl, or say the budget is spent '''
+		self.lock.acquire()
+		try:
+			if self.left is None:
+				return True
+			if self.left <= 0:
+				return False
+			self.left -= 1
+			return True
+		finally:
+			self.lock.release()
+
+
+class _ShardManager(BaseManager):
+	pass
+
+# what a shard can ask the coordinator for: its settings, each shard's inbox of links, the coordinator's inbox,
+# the page budget
+_ShardManager.register('config')
+_ShardManager.register('inbox')
+_ShardManager.register('control')
+_ShardManager.register('budget')
+
+
+class Cluster(object):
+	'''	The coordinator of a sharded crawl.  Links are split between `shards`
+		shard processes by shard_of their url: each shard keeps the queue and
+		crawled set for its own links only, and sends any others it finds to
+		the inboxes of the shards that own them.  The inboxes, and the control
+		queue the shards report back on, live here and are served to the
+		shards, local or on other machines, by a multiprocessing manager
+		listening on `address` (with `authkey`).  `config` is handed to every
+		shard (see menupages_crawl.crawl_shard).  Its max_pages is one budget
+		for the whole crawl: the shards reserve each page from it as they go,
+		so a shard owning more of the site than others crawls more of it.
+	'''
+	def __init__(self, shards, address=('127.0.0.1', 0), authkey=AUTHKEY, **config):
+		self.shards = shards
+		self.inboxes = [Queue.Queue() for i in xrange(shards)]
+		self.control = Queue.Queue()  # (kind, shard, ...) from the shards, see run
+		self.sent = 0  # batches of seed links handed out
+		pages = config.get('max_pages', -1)
+		self.budget = _Budget(pages if pages >= 0 else None)
+		config['shards'] = shards
+		info = _Config(config)
+
+		class Manager(BaseManager):
+			pass
+		Manager.register('config', callable=lambda: info)
+		Manager.register('inbox', callable=lambda i: self.inboxes[i])
+		Manager.register('control', callable=lambda: self.control)
+		Manager.register('budget', callable=lambda: self.budget)
+		self.server = Manager(address=address, authkey=authkey).get_server()
+		host, port = self.server.address
+		self.address = (host in ('', '0.0.0.0') and '127.0.0.1' or host, port)  # for the local shards
+		self.thread = threading.Thread(target=self.server.serve_forever)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def seed(self, urls):
+		''' Hand each of urls to the shard that owns it '''
+		batches = [[] for i in xrange(self.shards)]
+		for url in urls:
+			batches[shard_of(url, self.shards)].append(url)
+		for i, batch in enumerate(batches):
+			if batch:
+				self.inboxes[i].put(batch)
+				self.sent += 1
+
+	def run(self, crawler, procs=()):
+		'''	Start the local shard processes in procs, seed the shards with the
+			links in crawler.link_queue and merge the profiles they send back
+			into crawler (its restaurants, unless keep_profiles is off, and its
+			sinks) until the cluster has run dry: every shard has reported in
+			idle and every batch of links sent has been taken in.  Then call the
+			shards off and wait for their final reports.  Returns {shard: its
+			final report}: pages crawled and its metrics (merged into METRICS).
+		'''
+		for proc in procs:
+			proc.start()
+		self.seed(list(crawler.link_queue))
+		idle = {}  # shard -> (batches sent, batches taken in) when it last ran out of work
+		done = {}
+		stopping = False
+		try:
+			while len(done) < self.shards:
+				try:
+					msg = self.control.get(timeout=1.0)
+				except Queue.Empty:
+					for proc in procs:
+						if proc.exitcode is not None and proc.exitcode != 0:
+							raise RuntimeError("shard process %s exited with %d" % (proc.name, proc.exitcode))
+					continue
+				kind, shard = msg[:2]
+				if kind == 'profiles':
+					for profile in msg[2]:
+						if crawler.keep_profiles:
+							crawler.restaurants[profile['mp_url']] = Venue.from_dict(profile)
+						for sink in crawler.sinks:
+							sink.add(profile)
+				elif kind == 'busy':
+					idle.pop(shard, None)
+				elif kind == 'idle':
+					idle[shard] = msg[2:4]
+				elif kind == 'done':
+					done[shard] = msg[2]
+					METRICS.merge(msg[2]['metrics'])
+				# shards report busy (synchronously) before any work an incoming batch makes,
+				# so once all are idle and the counts agree no batch is still on its way
+				if not stopping and len(idle) == self.shards and \
+						self.sent + sum([s for s, r in idle.values()]) == sum([r for s, r in idle.values()]):
+					self.stop()
+					stopping = True
+		finally:
+			if not stopping:
+				self.stop()
+			for proc in procs:
+				proc.join()
+			for sink in crawler.sinks:
+				sink.flush()
+		return done
+
+	def stop(self):
+		for inbox in self.inboxes:
+			inbox.put(None)
+
+
+class ShardLink(object):
+	'''	One shard's end of a Cluster, for MpCrawler.shard.  route() keeps the
+		links this shard owns and batches the rest up for the shards that own
+		them; start() feeds the batches that come in to the crawl, as
+		('links', None, urls, None) events, and the coordinator's call to stop
+		as a ('stop', ...) one.  reserve() takes a page from the crawl's shared
+		budget.  idle() and busy() report the shard running out of work and
+		picking some up again.  It is also the crawl's one sink:
+		profiles go back to the coordinator `batch` at a time.
+	'''
+	def __init__(self, address, shard, authkey=AUTHKEY, batch=100, interval=0.5):
+		self.manager = _ShardManager(address=address, authkey=authkey)
+		self.manager.connect()
+		self.config = self.manager.config().get()
+		self.shard = shard
+		self.shards = self.config['shards']
+		self.inboxes = [self.manager.inbox(i) for i in xrange(self.shards)]
+		self.control = self.manager.control()
+		self.budget = self.config.get('max_pages', -1) >= 0 and self.manager.budget() or None
+		self.batch = batch
+		self.interval = interval  # most seconds a link waits in an outgoing batch
+		self.outgoing = [[] for i in xrange(self.shards)]
+		self.profiles = []
+		self.last_flush = time.time()
+		self.sent = 0  # batches of links sent to other shards
+		self.received = 0  # ... and taken in
+		self.is_idle = False
+		self.written = 0
+
+	def route(self, urls):
+		''' The urls this shard owns; the others are queued up for their shards '''
+		mine = []
+		for url in urls:
+			s = shard_of(url, self.shards)
+			if s == self.shard:
+				mine.append(url)
+			else:
+				self.outgoing[s].append(url)
+		if time.time() - self.last_flush > self.interval or \
+				max([len(urls) for urls in self.outgoing]) >= self.batch:
+			self.flush_links()
+		return mine
+
+	def flush_links(self):
+		for s, urls in enumerate(self.outgoing):
+			if urls:
+				self.inboxes[s].put(urls)
+				self.sent += 1
+				self.outgoing[s] = []
+		self.last_flush = time.time()
+
+	def start(self, events):
+		def feed():
+			inbox = self.manager.inbox(self.shard)  # a connection of this thread's own
+			while True:
+				urls = inbox.get()
+				if urls is None:
+					events.put(('stop', None, None, None))
+					return
+				events.put(('links', None, urls, None))
+		thread = threading.Thread(target=feed)
+		thread.daemon = True
+		thread.start()
+
+	def reserve(self):
+		''' Whether there is a page left in the budget for this shard to crawl; if so it's taken '''
+		return self.budget is None or self.budget.take()
+
+	def take(self, urls):
+		''' Count in a batch of links from the inbox, before doing anything with it '''
+		self.busy()
+		self.received += 1
+		return urls
+
+	def busy(self):
+		if self.is_idle:
+			self.control.put(('busy', self.shard))
+			self.is_idle = False
+
+	def idle(self):
+		''' Send on everything held back, then tell the coordinator we're out of work '''
+		self.flush_links()
+		self.flush()
+		self.control.put(('idle', self.shard, self.sent, self.received))
+		self.is_idle = True
+
+	def done(self, crawled, metrics):
+		self.flush()
+		self.control.put(('done', self.shard, {'pages': crawled, 'metrics': metrics}))
+
+	# the sink interface (see crawl_sink)
+	def add(self, profile):
+		self.profiles.append(profile)
+		self.written += 1
+		if len(self.profiles) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		if self.profiles:
+			self.control.put(('profiles', self.shard, self.profiles))
+			self.profiles = []
+
+	def close(self):
+		self.flush()
@@ -0,0 +1,78 @@
+import httplib, socket, time, urllib2
+
+from crawl_metrics import METRICS
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' HTTP Connections and the urllib2 Opener, for crawl_utils' fetching '''
+
+# what a failed fetch can raise (see crawl_utils.RetryPolicy)
+ERRORS = (socket.error, httplib.HTTPException, urllib2.URLError)
+
+
+# Subclass urllib2.HTTPRedirectHandler so that we know status code for future
+class SmartRedirectHandler(urllib2.HTTPRedirectHandler):
+    def http_error_301(self, req, fp, code, msg, headers):
+        result = urllib2.HTTPRedirectHandler.http_error_301(
+            self, req, fp, code, msg, headers)
+        result.status = code
+        return result
+
+    def http_error_302(self, req, fp, code, msg, headers):
+        result = urllib2.HTTPRedirectHandler.http_error_302(
+            self, req, fp, code, msg, headers)
+        result.status = code
+        return result
+        
+
+# Subclass urllib2.HTTPError so that we handle errors gracefully       
+class DefaultErrorHandler(urllib2.HTTPDefaultErrorHandler):
+    def http_error_default(self, req, fp, code, msg, headers):
+        result = urllib2.HTTPError(
+            req.get_full_url(), code, msg, headers, fp)
+        result.status = code
+        return result
+
+
+def _timed_socket(conn):
+    '''A socket connected to conn's host, timing the DNS lookup and the TCP connect separately'''
+    start = time.time()
+    family, socktype, proto, name, addr = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)[0]
+    METRICS.observe('dns', time.time() - start)
+    start = time.time()
+    sock = socket.create_connection(addr[:2], conn.timeout)
+    METRICS.observe('connect', time.time() - start)
+    return sock
+
+
+class TimedHTTPConnection(httplib.HTTPConnection):
+    '''HTTPConnection that times the DNS lookup and the TCP connect separately'''
+    def connect(self):
+        self.sock = _timed_socket(self)
+
+
+class TimedHTTPSConnection(httplib.HTTPSConnection):
+    '''HTTPSConnection that times the DNS lookup, the TCP connect and the TLS handshake separately'''
+    def connect(self):
+        sock = _timed_socket(self)
+        start = time.time()
+        self.sock = self._context.wrap_socket(sock, server_hostname=self.host)
+        METRICS.observe('tls', time.time() - start)
+
+
+def connection(scheme, host, timeout):
+    '''A new connection to host, for crawl_utils.ConnectionPool'''
+    if scheme == 'https':
+        return TimedHTTPSConnection(host, timeout=timeout)
+    return TimedHTTPConnection(host, timeout=timeout)
+
+
+def redirect_loop(source, resp):
+    return urllib2.HTTPError(source, resp.status, 'redirect loop', resp.msg, None)
+
+
+def open_urllib2(source, headers):
+    '''Open source over a one-off connection through urllib2'''
+    request = urllib2.Request(source, headers=headers)
+    opener = urllib2.build_opener(SmartRedirectHandler(), DefaultErrorHandler())
+    return opener.open(request)
@@ -0,0 +1,201 @@
+import math, os, sys, threading, time
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' Counters and Timings for a Crawl '''
+
+
+class _Timer(object):
+	__slots__ = ('metrics', 'name', 'start')
+
+	def __init__(self, metrics, name):
+		self.metrics = metrics
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *exc):
+		self.metrics.observe(self.name, time.time() - self.start)
+
+
+class Histogram(object):
+	'''	Latencies in power-of-two microsecond buckets: constant memory however
+		many are observed, percentiles good to within a factor of two. '''
+	__slots__ = ('count', 'total', 'max', 'buckets')
+
+	def __init__(self):
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+		self.buckets = {}
+
+	def add(self, seconds):
+		self.count += 1
+		self.total += seconds
+		self.max = max(self.max, seconds)
+		b = seconds > 1e-6 and int(math.log(seconds * 1e6, 2)) or 0
+		self.buckets[b] = self.buckets.get(b, 0) + 1
+
+	def state(self):
+		return (self.count, self.total, self.max, dict(self.buckets))
+
+	def merge(self, state):
+		''' Add in the observations of another histogram's state() '''
+		count, total, top, buckets = state
+		self.count += count
+		self.total += total
+		self.max = max(self.max, top)
+		for b, n in buckets.items():
+			self.buckets[b] = self.buckets.get(b, 0) + n
+
+	def percentile(self, q):
+		''' Upper bound (in seconds) of the bucket holding the q-th percentile '''
+		rank, seen = q * self.count, 0
+		for b in sorted(self.buckets):
+			seen += self.buckets[b]
+			if seen >= rank:
+				return min(2 ** (b + 1) / 1e6, self.max)
+		return self.max
+
+	def summary(self):
+		return {'count': self.count, 'total': self.total,
+				'mean': self.count and self.total / self.count or 0.0,
+				'p50': self.percentile(0.5), 'p90': self.percentile(0.9),
+				'p99': self.percentile(0.99), 'max': self.max}
+
+
+class Metrics(object):
+	'''	Thread-safe counters (incr) and latency histograms (observe, or the
+		timer() context manager) for the hot paths of a crawl. '''
+	def __init__(self):
+		self._lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		self._lock.acquire()
+		try:
+			self.started = time.time()
+			self.counters = {}
+			self.timings = {}
+		finally:
+			self._lock.release()
+
+	def incr(self, name, n=1):
+		self._lock.acquire()
+		try:
+			self.counters[name] = self.counters.get(name, 0) + n
+		finally:
+			self._lock.release()
+
+	def observe(self, name, seconds):
+		self._lock.acquire()
+		try:
+			h = self.timings.get(name)
+			if h is None:
+				h = self.timings[name] = Histogram()
+			h.add(seconds)
+		finally:
+			self._lock.release()
+
+	def timer(self, name):
+		return _Timer(self, name)
+
+	def snapshot(self):
+		self._lock.acquire()
+		try:
+			return {'elapsed': time.time() - self.started,
+					'counters': dict(self.counters),
+					'timings': dict([(k, h.summary()) for k, h in self.timings.items()])}
+		finally:
+			self._lock.release()
+
+	def export(self):
+		''' The raw counters and histograms, to merge() into the metrics of another process '''
+		self._lock.acquire()
+		try:
+			return {'counters': dict(self.counters),
+					'timings': dict([(k, h.state()) for k, h in self.timings.items()])}
+		finally:
+			self._lock.release()
+
+	def merge(self, exported):
+		''' Add in what export() gave in another process (a shard of the crawl, say) '''
+		self._lock.acquire()
+		try:
+			for name, n in exported['counters'].items():
+				self.counters[name] = self.counters.get(name, 0) + n
+			for name, state in exported['timings'].items():
+				h = self.timings.get(name)
+				if h is None:
+					h = self.timings[name] = Histogram()
+				h.merge(state)
+		finally:
+			self._lock.release()
+
+	def line(self):
+		''' One line: rate of crawled pages, the counters and p50/p99 of each timing '''
+		snap = self.snapshot()
+		counters = snap['counters']
+		parts = ['%.0fs' % snap['elapsed'],
+				 '%.1f pages/s' % (counters.get('pages', 0) / max(snap['elapsed'], 1e-3))]
+		parts += ['%s=%d' % kv for kv in sorted(counters.items())]
+		parts += ['%s %.1f/%.1fms' % (k, 1e3 * t['p50'], 1e3 * t['p99'])
+				  for k, t in sorted(snap['timings'].items())]
+		return ' '.join(parts)
+
+	def report(self):
+		''' Table of timings by total time spent, for the end of a crawl '''
+		snap = self.snapshot()
+		rows = ["%-16s %8s %10s %9s %9s %9s %9s" % ('timing', 'count', 'total s', 'mean ms', 'p50 ms', 'p99 ms', 'max ms')]
+		for k, t in sorted(snap['timings'].items(), key=lambda kt: -kt[1]['total']):
+			rows.append("%-16s %8d %10.2f %9.2f %9.2f %9.2f %9.2f" % (
+				k, t['count'], t['total'], 1e3 * t['mean'], 1e3 * t['p50'], 1e3 * t['p99'], 1e3 * t['max']))
+		rows.append(' '.join(['%s=%d' % kv for kv in sorted(snap['counters'].items())]))
+		return '\n'.join(rows)
+
+	def write(self, path):
+		''' Dump snapshot() as JSON to path, replacing it atomically '''
+		import json, tempfile  # only for --metrics-file: keep them off every importer's start-up
+		fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+		fp = os.fdopen(fd, 'w')
+		try:
+			json.dump(self.snapshot(), fp, indent=1, sort_keys=True)
+		finally:
+			fp.close()
+		os.rename(tmp, path)
+
+
+METRICS = Metrics()  # shared by crawl_utils, crawl_sink and menupages_crawl
+
+
+class Reporter(object):
+	'''	Every `interval` seconds, prints the metrics line to `stream` and/or
+		writes the metrics to the JSON file `path`, until stopped. '''
+	def __init__(self, metrics=METRICS, interval=10.0, stream=sys.stdout, path=None):
+		self.metrics = metrics
+		self.interval = interval
+		self.stream = stream
+		self.path = path
+		self._stop = threading.Event()
+		self.thread = threading.Thread(target=self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def emit(self):
+		if self.stream:
+			self.stream.write('[stats] %s\n' % self.metrics.line())
+			self.stream.flush()
+		if self.path:
+			self.metrics.write(self.path)
+
+	def _run(self):
+		while not self._stop.wait(self.interval):
+			self.emit()
+
+	def stop(self):
+		self._stop.set()
+		self.thread.join()
+		if self.path:
+			self.metrics.write(self.path)
@@ -0,0 +1,308 @@
+from __future__ import print_function
+
+from sgmllib import SGMLParser, SGMLParseError
+from HTMLParser import HTMLParser, HTMLParseError
+from htmlentitydefs import entitydefs
+from BeautifulSoup import BeautifulSoup, UnicodeDammit
+import re
+
+from crawl_utils import Capture
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' SGML/HTML Parsers Behind crawl_utils.FieldSpec '''
+
+
+_ATTR_ENTITY_RE = re.compile("&(#\d+|#x[0-9a-fA-F]+|\w+);")
+
+def _attr_entity(match):
+    # BeautifulSoup (without convertEntities) only decodes numeric references in attribute values
+    x = match.group(1)
+    if x[0] == '#':
+        if x[1:2] == 'x':
+            return unichr(int(x[2:], 16))
+        return unichr(int(x[1:]))
+    return u'&%s;' % x
+
+
+class FieldExtractor(SGMLParser):
+    '''Single pass over a document on behalf of a FieldSpec.  No tree is built:
+       only a stack of open tag names and the captures open on it.  Tokenizing,
+       tag nesting, entity handling and markup massage all follow
+       BeautifulSoup, so the captures agree with what BeautifulSoup.fetch
+       would have found.'''
+    SELF_CLOSING_TAGS = BeautifulSoup.SELF_CLOSING_TAGS
+    NESTABLE_TAGS = BeautifulSoup.NESTABLE_TAGS
+    RESET_NESTING_TAGS = BeautifulSoup.RESET_NESTING_TAGS
+    QUOTE_TAGS = BeautifulSoup.QUOTE_TAGS
+    MARKUP_MASSAGE = BeautifulSoup.MARKUP_MASSAGE
+    ROOT_TAG_NAME = BeautifulSoup.ROOT_TAG_NAME
+
+    def __init__(self, spec):
+        self.spec = spec
+        SGMLParser.__init__(self)
+
+    def reset(self):
+        SGMLParser.reset(self)
+        self.root = Capture(self.ROOT_TAG_NAME, {})
+        self.stack = [(self.ROOT_TAG_NAME, ())]   # (tag name, captures opened by that tag)
+        self.open = []                            # every open capture, outermost first
+        self.in_scope = dict((f, []) for f in self.spec.scopes)
+        self.awaiting_first = []
+        self.currentData = []
+        self.quoteStack = []
+
+    def feed_document(self, doc):
+        if not isinstance(doc, unicode):
+            doc = UnicodeDammit(doc, [None, None], smartQuotesTo=BeautifulSoup.HTML_ENTITIES,
+                                isHTML=True).unicode or u''
+        for fix, m in self.MARKUP_MASSAGE:
+            doc = fix.sub(m, doc)
+        self.feed(doc)
+        self.endData()
+        while len(self.stack) > 1:
+            self.popTag()
+
+    def endData(self):
+        if self.currentData:
+            data = u''.join(self.currentData).strip()
+            self.currentData = []
+            for cap in self.open:
+                cap._strings.append(data)
+
+    def popTag(self):
+        name, caps = self.stack.pop()
+        for cap in caps:
+            cap.text = u''.join(cap._strings)
+            cap._strings = None
+            if cap.field in self.in_scope:
+                self.in_scope[cap.field].remove(cap)
+            if cap in self.awaiting_first:
+                self.awaiting_first.remove(cap)
+        if caps:
+            del self.open[-len(caps):]
+
+    def _popToTag(self, name, inclusivePop=True):
+        if name == self.ROOT_TAG_NAME:
+            return
+        numPops = 0
+        for i in range(len(self.stack)-1, 0, -1):
+            if name == self.stack[i][0]:
+                numPops = len(self.stack)-i
+                break
+        if not inclusivePop:
+            numPops = numPops - 1
+        for i in range(0, numPops):
+            self.popTag()
+
+    def _smartPop(self, name):
+        # the same nesting rules as BeautifulSoup._smartPop
+        nestingResetTriggers = self.NESTABLE_TAGS.get(name)
+        isNestable = nestingResetTriggers != None
+        isResetNesting = self.RESET_NESTING_TAGS.has_key(name)
+        popTo = None
+        inclusive = True
+        for i in range(len(self.stack)-1, 0, -1):
+            pname = self.stack[i][0]
+            if pname == name and not isNestable:
+                popTo = name
+                break
+            if (nestingResetTriggers is not None and pname in nestingResetTriggers) \
+                or (nestingResetTriggers is None and isResetNesting
+                    and self.RESET_NESTING_TAGS.has_key(pname)):
+                popTo = pname
+                inclusive = False
+                break
+        if popTo:
+            self._popToTag(popTo, inclusive)
+
+    def unknown_starttag(self, name, attrs, selfClosing=0):
+        if self.quoteStack:
+            attrs = ''.join([' %s="%s"' % (x, y) for x, y in attrs])
+            self.handle_data('<%s%s>' % (name, attrs))
+            return
+        self.endData()
+        selfClosing = selfClosing or self.SELF_CLOSING_TAGS.has_key(name)
+        if not selfClosing:
+            self._smartPop(name)
+
+        caps = []
+        if self.awaiting_first:
+            first = Capture(None, None)
+            for cap in self.awaiting_first:
+                cap.first = first
+            self.awaiting_first = []
+            caps.append(first)
+
+        rules = self.spec.rules.get(name)
+        if rules:
+            amap = None
+            opened_scopes = []
+            for field, attr, pattern, scope, want_first in rules:
+                if scope and not self.in_scope[scope]:
+                    continue
+                if amap is None:
+                    amap = dict([(k, '&' in v and _ATTR_ENTITY_RE.sub(_attr_entity, v) or v)
+                                 for k, v in attrs])
+                value = amap.get(attr)
+                if not value or not pattern.search(value):
+                    continue
+                cap = Capture(field, amap)
+                if scope:
+                    for parent in self.in_scope[scope]:
+                        parent.fields.setdefault(field, []).append(cap)
+                else:
+                    self.root.fields.setdefault(field, []).append(cap)
+                if field in self.in_scope:
+                    opened_scopes.append(cap)
+                if want_first:
+                    self.awaiting_first.append(cap)
+                caps.append(cap)
+            # only descendants belong to a scope, never the element itself
+            for cap in opened_scopes:
+                self.in_scope[cap.field].append(cap)
+
+        self.stack.append((name, caps))
+        self.open.extend(caps)
+        if selfClosing:
+            self.popTag()
+        if name in self.QUOTE_TAGS:
+            self.quoteStack.append(name)
+            self.literal = 1
+
+    def unknown_endtag(self, name):
+        if self.quoteStack and self.quoteStack[-1] != name:
+            self.handle_data('</%s>' % name)
+            return
+        self.endData()
+        self._popToTag(name)
+        if self.quoteStack and self.quoteStack[-1] == name:
+            self.quoteStack.pop()
+            self.literal = (len(self.quoteStack) > 0)
+
+    def handle_data(self, data):
+        self.currentData.append(data)
+
+    def _handle_string(self, text):
+        self.endData()
+        self.handle_data(text)
+        self.endData()
+
+    def handle_pi(self, text):
+        if text[:3] == "xml":
+            text = u"xml version='1.0' encoding='%SOUP-ENCODING%'"
+        self._handle_string(text)
+
+    def handle_comment(self, text):
+        self._handle_string(text)
+
+    def handle_decl(self, data):
+        self._handle_string(data)
+
+    def handle_charref(self, ref):
+        self.handle_data('&#%s;' % ref)
+
+    def handle_entityref(self, ref):
+        self.handle_data('&%s;' % ref)
+
+    def convert_charref(self, name):
+        try:
+            n = int(name)
+        except ValueError:
+            return
+        if not 0 <= n <= 127:
+            return
+        return self.convert_codepoint(n)
+
+    def parse_declaration(self, i):
+        j = None
+        if self.rawdata[i:i+9] == '<![CDATA[':
+            k = self.rawdata.find(']]>', i)
+            if k == -1:
+                k = len(self.rawdata)
+            self._handle_string(self.rawdata[i+9:k])
+            j = k+3
+        else:
+            try:
+                j = SGMLParser.parse_declaration(self, i)
+            except SGMLParseError:
+                toHandle = self.rawdata[i:]
+                self.handle_data(toHandle)
+                j = i + len(toHandle)
+        return j
+
+
+'''
+# ---------------------------------------------------------------------------------------
+# ---------------------------------SIMPLE & EFFECTIVE -----------------------------------
+# ---------------------------------------------------------------------------------------
+'''
+
+class URLLister(SGMLParser):
+	def reset(self):
+		# extend (called by SGMLParser.__init__)
+		self.urls = []
+		SGMLParser.reset(self)
+		
+	def start_a(self, attrs):
+		href = [v for k,v in attrs if k=='href']
+		if href:
+			self.urls.extend(href)
+
+
+'''
+# ---------------------------------------------------------------------------------------
+# -------------------------------------- TODO -------------------------------------------
+# ---------------------------------------------------------------------------------------
+'''
+
+class ParsePageError(HTMLParseError):
+	"""Exception raised for all parse errors."""
+
+	def __init__(self, msg, position=(None, None)):
+		HTMLParseError.__init__(self, msg, position)
+		
+
+	def __str__(self):
+    		result = HTMLParseError.__str__(self)
+		return result
+
+
+
+class ParsePage(HTMLParser):
+	def reset(self):
+		# extend (called by HTMLParser.__init__)
+		self.pieces = []		
+		HTMLParser.reset(self)
+		
+
+	def handle_starttag(self, tag, attrs):
+		strattrs = "".join([' %s="%s"' % (key, value) for key, value in attrs])
+		print("Parsed: <%(tag)s%(strattrs)s>" % locals())
+		if tag=='script':
+			self.handle_comment(attrs)
+		else:
+			print('Tag start:', tag, attrs)
+		
+
+	def handle_endtag(self, tag):
+		print('tag end:  ', tag)
+		
+	def handle_data(self, data):
+		print('data......', data.rstrip())
+		
+	def handle_charref(self, name):
+		print('charref.......', name)
+		
+	def handle_entityref(self, name):
+		if entitydefs.has_key(name):
+			print('ref.......', entitydefs[name])
+	
+	def handle_comment(self, data):
+		print('comment.......', data)
+		
+	def handle_decl(self, decl):
+		print('SGML Decl.....', decl)
+		
+	def handle_pi(self, text):
+		print('Proc Instr....', text)
@@ -0,0 +1,188 @@
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' Compact Records for Scraped Venue Profiles '''
+
+_strings = {}
+
+def intern_str(s):
+	''' One shared copy of a (unicode or byte) string that repeats across venues '''
+	if s is None:
+		return s
+	return _strings.setdefault((type(s), s), s)  # u'x' == 'x', keep them apart
+
+
+class Vocabulary(object):
+	'''	Bit positions for the members of a SET column (meals, features): a list
+		of strings is stored as one int mask with a bit per member.  Members
+		not seen before get the next free bit, so masks built in one process
+		only decode against that process's vocabulary (pickle the records,
+		which reduce to plain dicts, rather than the masks).
+	'''
+	def __init__(self, members=()):
+		self.members = []
+		self.bits = {}
+		for m in members:
+			self.bit(m)
+		self.seeded = len(self.members)
+
+	def bit(self, member):
+		b = self.bits.get(member)
+		if b is None:
+			b = self.bits[intern_str(member)] = 1 << len(self.members)
+			self.members.append(member)
+		return b
+
+	def encode(self, members):
+		mask = 0
+		for m in members or ():
+			mask |= self.bit(m)
+		return mask
+
+	def decode(self, mask):
+		'''	Members in the order of the SET definition, as MySQL returns them,
+			then any not in it sorted (the same order in every process) '''
+		found = [m for i, m in enumerate(self.members) if mask >> i & 1]
+		known = len([b for b in xrange(self.seeded) if mask >> b & 1])
+		return found[:known] + sorted(found[known:])
+
+	def normalize(self, members):
+		''' members as decode gives them back: in that order, without repeats '''
+		return self.decode(self.encode(members))
+
+
+# seeded in the order of the SET columns in mp_setup.sql (pages parse to unicode)
+MEALS = Vocabulary((u'breakfast', u'lunch', u'brunch', u'dinner'))
+FEATURES = Vocabulary((
+	u'Accepts Credit Cards', u'BYOB', u'Bar Scene', u'Buffet', u'Business Dining', u'Catering',
+	u'Cheap Eats', u'Delivery', u'Discount Reservations', u'Fireplace', u'Gluten Free Items',
+	u'Great Views', u'Group Dining', u'Happy Hour', u'Kid-friendly', u'Live Entertainment',
+	u'Lunch Special', u'Online Ordering', u'Online Reservations', u'Open 24 Hours', u'Open Late',
+	u'Outdoor Dining', u'People Watching', u'Pre/Post Theater', u'Private Parties', u'Prix Fixe',
+	u'Raw Bar', u'Romantic', u'Take Out', u'Tasting Menu', u'Trendy', u'Waterfront',
+	u'Wheelchair Friendly', u'WiFi'))
+
+
+def _rebuild(cls, d):
+	return cls.from_dict(d)
+
+
+class _Record(object):
+	'''	Base for the slotted records: `fields` pairs each profile dict key with
+		its slot, and the record reads like that dict (record['zip-code'],
+		.get, .keys, .items) so code written against profile dicts keeps
+		working.  as_dict() gives back an actual dict.
+	'''
+	__slots__ = ()
+	fields = ()
+	_interned = ()
+
+	@classmethod
+	def from_dict(cls, d):
+		rec = cls.__new__(cls)
+		for key, slot in cls.fields:
+			v = d.get(key)
+			setattr(rec, slot, slot in cls._interned and intern_str(v) or v)
+		return rec
+
+	def __getitem__(self, key):
+		for k, slot in self.fields:
+			if k == key:
+				return getattr(self, slot)
+		raise KeyError(key)
+
+	def get(self, key, default=None):
+		try:
+			return self[key]
+		except KeyError:
+			return default
+
+	def keys(self):
+		return [k for k, slot in self.fields]
+
+	def __iter__(self):
+		return iter(self.keys())
+
+	def __contains__(self, key):
+		return key in self.keys()
+
+	def __len__(self):
+		return len(self.fields)
+
+	def items(self):
+		return [(k, self[k]) for k, slot in self.fields]
+
+	def as_dict(self):
+		return dict(self.items())
+
+	def __eq__(self, other):
+		if isinstance(other, _Record):
+			other = other.as_dict()
+		return self.as_dict() == other
+
+	def __ne__(self, other):
+		return not self == other
+
+	def __repr__(self):
+		return repr(self.as_dict())
+
+	def __reduce__(self):
+		return (_rebuild, (type(self), self.as_dict()))
+
+
+class Rating(_Record):
+	__slots__ = ('count', 'average', 'food', 'value', 'service', 'atmosphere')
+	fields = tuple(zip(__slots__, __slots__))
+
+
+class Review(_Record):
+	__slots__ = ('reviewer', 'dtreviewed', 'summary', 'comment')
+	fields = tuple(zip(__slots__, __slots__))
+	_interned = ('dtreviewed',)
+
+
+class Venue(_Record):
+	'''	A venue profile as parse_profile scrapes it, with the cuisine and
+		location strings interned, meals and features held as MEALS/FEATURES
+		bitmasks and the ratings and reviews as Rating/Review records.
+	'''
+	__slots__ = ('mp_url', 'name', 'street_address', 'city', 'zip_code', 'area',
+				 'neighborhood', 'cuisine', 'meal_mask', 'feature_mask', 'rating', 'review_list')
+	fields = (('mp_url', 'mp_url'), ('name', 'name'), ('street address', 'street_address'),
+			  ('city', 'city'), ('zip-code', 'zip_code'), ('area', 'area'),
+			  ('neighborhood', 'neighborhood'), ('cuisine', 'cuisine'), ('meals', 'meals'),
+			  ('features', 'features'), ('ratings', 'ratings'), ('reviews', 'reviews'))
+	_interned = ('city', 'area', 'neighborhood', 'cuisine')
+
+	@classmethod
+	def from_dict(cls, d):
+		rec = cls.__new__(cls)
+		rec.mp_url = d.get('mp_url')
+		rec.name = d.get('name')
+		rec.street_address = d.get('street address')
+		rec.zip_code = d.get('zip-code')
+		for slot in cls._interned:
+			setattr(rec, slot, intern_str(d.get(slot)))
+		rec.meal_mask = MEALS.encode(d['meals']) if d.get('meals') is not None else None
+		rec.feature_mask = FEATURES.encode(d['features']) if d.get('features') is not None else None
+		r = d.get('ratings')
+		rec.rating = Rating.from_dict(r) if r is not None else None
+		reviews = d.get('reviews')
+		rec.review_list = tuple(map(Review.from_dict, reviews)) if reviews is not None else None
+		return rec
+
+	# the dict view: lists and dicts, as parse_profile builds them
+	@property
+	def meals(self):
+		return MEALS.decode(self.meal_mask) if self.meal_mask is not None else None
+
+	@property
+	def features(self):
+		return FEATURES.decode(self.feature_mask) if self.feature_mask is not None else None
+
+	@property
+	def ratings(self):
+		return self.rating.as_dict() if self.rating is not None else None
+
+	@property
+	def reviews(self):
+		return [rv.as_dict() for rv in self.review_list] if self.review_list is not None else None
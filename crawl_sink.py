@@ -0,0 +1,425 @@
+import hashlib, os, re, time
+
+from crawl_metrics import METRICS
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' Writers for Scraped Venue Profiles '''
+
+# venue rows are keyed on url; the rest hang off the venue's rest_id
+VENUE_COLS = ('name', 'url', 'street_addr', 'city', 'zip_code', 'area', 'neighborhood')
+DETAIL_COLS = ('rest_id', 'cuisine', 'meals')
+RATING_COLS = ('rest_id', 'count', 'average', 'food', 'value', 'service', 'atmosphere')
+REVIEW_COLS = ('rest_id', 'rev_key', 'reviewer', 'dtreviewed', 'summary', 'comment')
+FEATURE_COLS = ('rest_id', 'feature')
+
+# (table, group column, the table it is on): mean ratings of the rated venues in each group
+RATING_AGGREGATES = (('area_rating', 'area', 'venue'), ('cuisine_rating', 'cuisine', 'detail'))
+AGGREGATE_COLS = ('venues', 'reviews', 'average', 'food', 'value', 'service', 'atmosphere')
+
+# Each sink imports what it writes with (sqlite3, csv, json, gzip, ...) when one
+# is made, so a crawl only loads the output backends it was asked for.
+
+# SQLite stand-in for the MySQL tables in mp_setup.sql (SET columns become text)
+SQLITE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS venue (rest_id INTEGER PRIMARY KEY, name TEXT, url TEXT UNIQUE,
+	street_addr TEXT, city TEXT, zip_code INTEGER, area TEXT, neighborhood TEXT);
+CREATE INDEX IF NOT EXISTS venue_area ON venue (area, neighborhood);
+CREATE INDEX IF NOT EXISTS venue_neighborhood ON venue (neighborhood);
+CREATE TABLE IF NOT EXISTS detail (rest_id INTEGER PRIMARY KEY REFERENCES venue (rest_id),
+	cuisine TEXT, meals TEXT);
+CREATE INDEX IF NOT EXISTS detail_cuisine ON detail (cuisine);
+CREATE TABLE IF NOT EXISTS rating (rest_id INTEGER PRIMARY KEY REFERENCES venue (rest_id),
+	count INTEGER, average REAL, food REAL, value REAL, service REAL, atmosphere REAL);
+CREATE TABLE IF NOT EXISTS reviews (rev_id INTEGER PRIMARY KEY, rest_id INTEGER REFERENCES venue (rest_id),
+	rev_key TEXT NOT NULL, reviewer TEXT, dtreviewed TEXT, summary TEXT, comment TEXT, UNIQUE (rest_id, rev_key));
+CREATE TABLE IF NOT EXISTS venue_feature (rest_id INTEGER REFERENCES venue (rest_id), feature TEXT,
+	PRIMARY KEY (rest_id, feature));
+CREATE INDEX IF NOT EXISTS venue_feature_feature ON venue_feature (feature, rest_id);
+CREATE TABLE IF NOT EXISTS area_rating (area TEXT PRIMARY KEY, venues INTEGER, reviews INTEGER,
+	average REAL, food REAL, value REAL, service REAL, atmosphere REAL);
+CREATE TABLE IF NOT EXISTS cuisine_rating (cuisine TEXT PRIMARY KEY, venues INTEGER, reviews INTEGER,
+	average REAL, food REAL, value REAL, service REAL, atmosphere REAL);
+'''
+
+
+def connect_db(host='localhost', user='crawler', db='menupages', local_infile=False):
+	''' Connect to the menupages MySQL database (local_infile for BulkLoader) '''
+	import MySQLdb
+	return MySQLdb.connect(host=host, user=user, db=db, charset='utf8', use_unicode=True,
+						   local_infile=local_infile and 1 or 0)
+
+
+def review_key(reviewer, dtreviewed, summary, comment):
+	'''	What tells a venue's reviews apart (the reviews table is unique on
+		rest_id and this): the reviewer and date, or for an undated review the
+		reviewer and its text.  Not the date column itself, as NULLs never
+		clash in a UNIQUE key and reruns would add undated reviews again. '''
+	parts = dtreviewed and (reviewer, dtreviewed) or (reviewer, summary, comment)
+	return hashlib.md5('\0'.join([_utf8(p or '') for p in parts])).hexdigest()
+
+
+def venue_rows(profile):
+	'''	Split a scraped profile into its venue row and the (detail, rating,
+		[reviews], [features]) rows that go under its rest_id, less the rest_id '''
+	venue = (profile['name'], profile['mp_url'], profile['street address'], profile['city'],
+			 profile['zip-code'], profile['area'], profile['neighborhood'])
+	# meals go into a SET column: comma separated, no spaces
+	detail = (profile['cuisine'], ','.join(profile['meals'] or []))
+	r = profile['ratings'] or {}
+	rating = (r.get('count', 0), r.get('average', 0.0), r.get('food', 0.0),
+			  r.get('value', 0.0), r.get('service', 0.0), r.get('atmosphere', 0.0))
+	reviews = [(review_key(rv['reviewer'], rv['dtreviewed'], rv['summary'], rv['comment']),
+				rv['reviewer'], rv['dtreviewed'] or None, rv['summary'], rv['comment'])
+			   for rv in profile['reviews'] or []]
+	features = sorted(set(profile['features'] or []))
+	return venue, detail, rating, reviews, features
+
+
+class DbSink(object):
+	'''	Streams venue profiles into the venue tables while the crawl runs.
+		Profiles are buffered and written every `batch` venues as multi-row
+		upserts, one transaction per batch, so a rerun updates rows rather
+		than duplicating them: venues keyed on url, and detail, rating, reviews
+		and the venue_feature bridge on the venue's rest_id.  The area_rating
+		and cuisine_rating aggregates are recomputed in the same transaction,
+		for just the areas and cuisines the batch touched (before and after).
+		Works against MySQLdb or, as a local stand-in, sqlite3 connections.
+	'''
+	MAX_PARAMS = 999  # stay under SQLite's bound-variable limit per statement
+
+	def __init__(self, conn, batch=200):
+		self.conn = conn
+		self.batch = batch
+		import sqlite3
+		self.sqlite = isinstance(conn, sqlite3.Connection)
+		self.param = self.sqlite and '?' or '%s'
+		self.pending = []
+		self.written = 0
+		if self.sqlite:
+			conn.executescript(SQLITE_SCHEMA)
+
+	def add(self, profile):
+		self.pending.append(profile)
+		if len(self.pending) >= self.batch:
+			self.flush()
+
+	def flush(self):
+		if not self.pending:
+			return
+		rows = map(venue_rows, self.pending)
+		urls = [r[0][1] for r in rows]
+		start = time.time()
+		cursor = self.conn.cursor()
+		try:
+			groups = self._groups(cursor, urls)  # where these venues were before, to take them out of
+			self._upsert(cursor, 'venue', VENUE_COLS, ('url',), [r[0] for r in rows])
+			ids = self._rest_ids(cursor, urls)
+			keyed = [(ids[url],) + r[1:] for url, r in zip(urls, rows)]
+			self._upsert(cursor, 'detail', DETAIL_COLS, ('rest_id',), [(k[0],) + k[1] for k in keyed])
+			self._upsert(cursor, 'rating', RATING_COLS, ('rest_id',), [(k[0],) + k[2] for k in keyed])
+			self._upsert(cursor, 'reviews', REVIEW_COLS, ('rest_id', 'rev_key'),
+						 [(k[0],) + rv for k in keyed for rv in k[3]])
+			self._in(cursor, 'DELETE FROM venue_feature WHERE rest_id IN (%s)', ids.values())
+			self._insert(cursor, 'venue_feature', FEATURE_COLS, [(k[0], f) for k in keyed for f in k[4]])
+			groups['area'].update([r[0][5] for r in rows])
+			groups['cuisine'].update([r[1][0] for r in rows])
+			self._refresh_aggregates(cursor, groups)
+			self.conn.commit()
+		except:
+			self.conn.rollback()
+			raise
+		finally:
+			cursor.close()
+			METRICS.observe('db_flush', time.time() - start)
+		self.written += len(self.pending)
+		self.pending = []
+
+	def close(self):
+		self.flush()
+
+	def last_review(self, url):
+		''' The date of the newest review stored for the venue at url ('' if none) '''
+		cursor = self.conn.cursor()
+		try:
+			cursor.execute('SELECT MAX(r.dtreviewed) FROM reviews r JOIN venue v ON v.rest_id = r.rest_id'
+						   ' WHERE v.url = ' + self.param, (url,))
+			row = cursor.fetchone()
+		finally:
+			cursor.close()
+		return row and row[0] and str(row[0]) or ''  # MySQLdb hands back a date
+
+	def _in(self, cursor, sql, values):
+		''' Run sql with its IN (%s) over values, a chunk of them at a time; all the rows fetched '''
+		values = list(values)
+		fetched = []
+		for i in xrange(0, len(values), self.MAX_PARAMS):
+			chunk = values[i:i+self.MAX_PARAMS]
+			cursor.execute(sql % ','.join([self.param] * len(chunk)), chunk)
+			fetched.extend(cursor.fetchall())
+		return fetched
+
+	def _rest_ids(self, cursor, urls):
+		return dict([(url, rest_id) for rest_id, url in
+					 self._in(cursor, 'SELECT rest_id, url FROM venue WHERE url IN (%s)', set(urls))])
+
+	def _groups(self, cursor, urls):
+		rows = self._in(cursor, 'SELECT v.area, d.cuisine FROM venue v LEFT JOIN detail d ON d.rest_id = v.rest_id '
+							   'WHERE v.url IN (%s)', set(urls))
+		return {'area': set([r[0] for r in rows]), 'cuisine': set([r[1] for r in rows])}
+
+	def _refresh_aggregates(self, cursor, groups=None):
+		'''	Recompute the rows of the rating aggregates for groups ({'area':
+			areas, 'cuisine': cuisines}), or all of them when groups is None '''
+		for table, col, source in RATING_AGGREGATES:
+			select = ('INSERT INTO %s (%s, %s) SELECT g.%s, COUNT(*), SUM(r.count), AVG(r.average), AVG(r.food), '
+					  'AVG(r.value), AVG(r.service), AVG(r.atmosphere) FROM %s g JOIN rating r ON r.rest_id = g.rest_id '
+					  'WHERE r.count > 0 AND g.%s IS NOT NULL') % (
+				table, col, ', '.join(AGGREGATE_COLS), col, source, col)
+			if groups is None:
+				cursor.execute('DELETE FROM %s' % table)
+				cursor.execute(select + ' GROUP BY g.%s' % col)
+				continue
+			keys = [g for g in groups[col] if g is not None]
+			self._in(cursor, 'DELETE FROM %s WHERE %s IN (%%s)' % (table, col), keys)
+			self._in(cursor, select + ' AND g.%s IN (%%s) GROUP BY g.%s' % (col, col), keys)
+
+	def _upsert(self, cursor, table, cols, keys, rows):
+		if not rows:
+			return
+		updates = [c for c in cols if c not in keys]
+		if self.sqlite:
+			tail = ' ON CONFLICT (%s) DO UPDATE SET ' % ', '.join(keys) \
+				+ ', '.join(['%s = excluded.%s' % (c, c) for c in updates])
+		else:
+			tail = ' ON DUPLICATE KEY UPDATE ' + ', '.join(['%s = VALUES(%s)' % (c, c) for c in updates])
+		self._insert(cursor, table, cols, rows, tail)
+
+	def _insert(self, cursor, table, cols, rows, tail=''):
+		place = '(' + ','.join([self.param] * len(cols)) + ')'
+		step = max(self.MAX_PARAMS // len(cols), 1)
+		for i in xrange(0, len(rows), step):
+			chunk = rows[i:i+step]
+			sql = 'INSERT INTO %s (%s) VALUES ' % (table, ', '.join(cols)) \
+				+ ','.join([place] * len(chunk)) + tail
+			cursor.execute(sql, [v for row in chunk for v in row])
+
+
+_TSV_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'}
+_TSV_ESCAPE_RE = re.compile(r'[\\\t\n\r\0]')
+
+
+def _tsv_field(v):
+	''' v as LOAD DATA reads a field by default: backslash escapes, \\N for NULL '''
+	if v is None:
+		return '\\N'
+	if isinstance(v, unicode):
+		v = v.encode('utf-8')
+	elif not isinstance(v, str):
+		return str(v)
+	if _TSV_ESCAPE_RE.search(v) is None:
+		return v
+	return _TSV_ESCAPE_RE.sub(lambda m: _TSV_ESCAPES[m.group()], v)
+
+
+class BulkLoader(DbSink):
+	'''	Reloads the venue tables wholesale, for full crawls where DbSink's
+		upserts as it goes would be the slow part.  Profiles are streamed out
+		to tab separated files as they are added, and close() then empties
+		the tables and reads each file in with one LOAD DATA LOCAL INFILE,
+		with foreign key checks off until the load is whole, and recomputes
+		the rating aggregates.  On sqlite3, where there is no such thing, the tables are
+		emptied and the rows inserted `batch` venues at a time as they come,
+		all in the one transaction close() commits.  Venues are numbered as
+		they come, so every row can carry its venue's rest_id from the start;
+		a url added again gets a new one, and the rows under its old one are
+		deleted once all are in, so it keeps just its last profile's reviews
+		and features.  MySQL connections need local_infile (see connect_db).
+	'''
+	TABLES = (('venue', ('rest_id',) + VENUE_COLS), ('detail', DETAIL_COLS), ('rating', RATING_COLS),
+			  ('reviews', REVIEW_COLS), ('venue_feature', FEATURE_COLS))
+
+	def __init__(self, conn, batch=1000, tmpdir=None):
+		DbSink.__init__(self, conn, batch)
+		self.ids = {}  # venue url -> rest_id
+		self.stale = []  # rest_ids of profiles a later one for the same url replaced
+		if self.sqlite:
+			self.rows = [[] for t in self.TABLES]
+			for table, cols in self.TABLES:
+				conn.execute('DELETE FROM %s' % table)  # opens the transaction close() commits
+		else:
+			import tempfile
+			self.dir = tempfile.mkdtemp(prefix='mp_load_', dir=tmpdir)
+			self.files = [open(os.path.join(self.dir, table + '.tsv'), 'wb') for table, cols in self.TABLES]
+
+	def add(self, profile):
+		venue, detail, rating, reviews, features = venue_rows(profile)
+		if venue[1] in self.ids:
+			self.stale.append(self.ids[venue[1]])
+		rest_id = self.ids[venue[1]] = self.written + 1
+		rows = [[(rest_id,) + venue], [(rest_id,) + detail], [(rest_id,) + rating],
+				[(rest_id,) + rv for rv in reviews], [(rest_id, f) for f in features]]
+		self.written += 1
+		if self.sqlite:
+			for pending, table_rows in zip(self.rows, rows):
+				pending.extend(table_rows)
+			if self.written % self.batch == 0:
+				self._insert_sqlite()
+			return
+		for fp, table_rows in zip(self.files, rows):
+			for row in table_rows:
+				fp.write('\t'.join(map(_tsv_field, row)) + '\n')
+
+	def flush(self):
+		''' Nothing is committed before close() '''
+		if self.sqlite:
+			self._insert_sqlite()
+		else:
+			for fp in self.files:
+				fp.flush()
+
+	def close(self):
+		''' Replace what the tables hold with the profiles added, and clean up '''
+		start = time.time()
+		try:
+			if self.sqlite:
+				self._insert_sqlite()
+				cursor = self.conn.cursor()
+				self._drop_stale(cursor)
+				self._refresh_aggregates(cursor)
+				cursor.close()
+				self.conn.commit()
+			else:
+				for fp in self.files:
+					fp.close()
+				self._load_mysql()
+		except:
+			self.conn.rollback()
+			raise
+		finally:
+			METRICS.observe('db_load', time.time() - start)
+			if not self.sqlite:
+				import shutil
+				shutil.rmtree(self.dir, True)
+
+	def _load_mysql(self):
+		cursor = self.conn.cursor()
+		# InnoDB won't truncate a table others reference, and until the stale rows are dropped
+		# some reference venue rows a url's later profile replaced
+		cursor.execute('SET FOREIGN_KEY_CHECKS = 0')
+		try:
+			for (table, cols), fp in zip(self.TABLES, self.files):
+				cursor.execute('TRUNCATE TABLE %s' % table)
+				cursor.execute('LOAD DATA LOCAL INFILE %s REPLACE INTO TABLE ' + table
+							   + ' CHARACTER SET utf8 (' + ', '.join(cols) + ')', (fp.name,))
+			self._drop_stale(cursor)
+			self._refresh_aggregates(cursor)
+			self.conn.commit()
+		finally:
+			cursor.execute('SET FOREIGN_KEY_CHECKS = 1')
+			cursor.close()
+
+	def _drop_stale(self, cursor):
+		''' Delete the rows of the profiles replaced by a later one for the same url '''
+		if self.stale:
+			for table, cols in reversed(self.TABLES):  # the venue rows last, after what references them
+				cursor.executemany('DELETE FROM %s WHERE rest_id = %s' % (table, self.param),
+								   [(rest_id,) for rest_id in self.stale])
+
+	def _insert_sqlite(self):
+		for (table, cols), pending in zip(self.TABLES, self.rows):
+			if pending:
+				# OR REPLACE: a url added again replaces its venue row, as LOAD DATA's REPLACE does in MySQL
+				self.conn.executemany('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+					table, ', '.join(cols), ','.join(['?'] * len(cols))), pending)
+				del pending[:]
+
+
+def _open_out(fname, compress):
+	if compress or fname.endswith('.gz'):
+		if not fname.endswith('.gz'):
+			fname += '.gz'
+		import gzip
+		return gzip.open(fname, 'wb')
+	return open(fname, 'wb')
+
+
+def _as_dict(record):
+	return record.as_dict()  # Venue records (see crawl_records)
+
+
+def _utf8(v):
+	return isinstance(v, unicode) and v.encode('utf-8') or v
+
+
+VENUE_CSV_FIELDS = ['mp_url', 'name', 'street address', 'city', 'zip-code', 'area', 'neighborhood',
+					'cuisine', 'meals', 'features', 'ratings_count', 'ratings_average', 'ratings_food',
+					'ratings_value', 'ratings_service', 'ratings_atmosphere', 'reviews']
+REVIEW_CSV_FIELDS = ['mp_url', 'reviewer', 'dtreviewed', 'summary', 'comment']
+
+
+class CsvSink(object):
+	'''	Writes each profile as one CSV row the moment it is added, under the
+		fixed VENUE_CSV_FIELDS header: meals and features are comma joined in
+		one cell (as in the SET columns) and reviews is the review count.  The
+		reviews themselves go one per row to <fname>_reviews.csv, keyed by
+		mp_url.  Memory use doesn't grow with the number of venues.
+	'''
+	def __init__(self, fname, reviews=True, compress=False, header_row=True):
+		from csv import DictWriter
+		ext = (compress or fname.endswith('.gz')) and '.csv.gz' or '.csv'
+		base = fname.endswith('.gz') and fname[:-3] or fname
+		base = base.endswith('.csv') and base[:-4] or base
+		self.files = [_open_out(base + ext, False)]
+		self.venues = DictWriter(self.files[0], VENUE_CSV_FIELDS)
+		self.reviews = None
+		if reviews:
+			self.files.append(_open_out(base + '_reviews' + ext, False))
+			self.reviews = DictWriter(self.files[1], REVIEW_CSV_FIELDS)
+		if header_row:
+			self.venues.writerow(dict(zip(VENUE_CSV_FIELDS, VENUE_CSV_FIELDS)))
+			if self.reviews:
+				self.reviews.writerow(dict(zip(REVIEW_CSV_FIELDS, REVIEW_CSV_FIELDS)))
+		self.written = 0
+
+	def add(self, profile):
+		row = dict([(k, _utf8(profile.get(k))) for k in VENUE_CSV_FIELDS[:8]])
+		row['meals'] = ','.join(profile['meals'] or []).encode('utf-8')
+		row['features'] = ','.join(profile['features'] or []).encode('utf-8')
+		for k, v in (profile['ratings'] or {}).items():
+			row['ratings_' + k] = v
+		row['reviews'] = len(profile['reviews'] or [])
+		self.venues.writerow(row)
+		if self.reviews:
+			for rv in profile['reviews'] or []:
+				rrow = dict([(k, _utf8(v)) for k, v in rv.items()])
+				rrow['mp_url'] = _utf8(profile['mp_url'])
+				self.reviews.writerow(rrow)
+		self.written += 1
+
+	def flush(self):
+		for fp in self.files:
+			fp.flush()
+
+	def close(self):
+		for fp in self.files:
+			fp.close()
+
+
+class JsonlSink(object):
+	'''	Writes each profile, reviews and all, as one JSON object per line '''
+	def __init__(self, fname, compress=False):
+		import json
+		self.dumps = json.dumps
+		self.fp = _open_out(fname, compress)
+		self.written = 0
+
+	def add(self, profile):
+		self.fp.write(self.dumps(profile, separators=(',', ':'), default=_as_dict) + '\n')
+		self.written += 1
+
+	def flush(self):
+		self.fp.flush()
+
+	def close(self):
+		self.fp.close()
@@ -0,0 +1,311 @@
+import sqlite3, zlib, cPickle, hashlib, heapq, json, math, time
+import os, mmap, threading
+
+from crawl_utils import Frontier
+from crawl_records import Venue
+from crawl_metrics import METRICS
+
+__author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
+
+''' Local Persistence of Crawl State '''
+
+CHECKPOINT_FILE = 'menupages_crawl.ckpt'
+SCHEDULE_FILE = 'menupages_crawl.sched'
+ARCHIVE_DIR = 'menupages_pages'
+
+
+class CrawlCheckpoint(object):
+	'''	SQLite record of a crawl in progress: the frontier, the visited links and
+		the scraped profiles.  Changes are buffered and committed every `every`
+		pages, so a crash loses at most that many pages of work, and a resumed
+		crawl picks up where the last commit left off.
+	'''
+	def __init__(self, path=CHECKPOINT_FILE, every=50):
+		self.path = path
+		self.every = every
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.executescript('''
+			CREATE TABLE IF NOT EXISTS frontier (url TEXT PRIMARY KEY, tag TEXT);
+			CREATE TABLE IF NOT EXISTS visited (url TEXT PRIMARY KEY);
+			CREATE TABLE IF NOT EXISTS profiles (url TEXT PRIMARY KEY, data BLOB);
+			''')
+		self._queued = []
+		self._visited = []
+		self._profiles = []
+
+	def is_empty(self):
+		cursor = self.conn.execute("SELECT EXISTS (SELECT 1 FROM frontier) OR EXISTS (SELECT 1 FROM visited)")
+		return not cursor.fetchone()[0]
+
+	def reset(self):
+		''' Drop any saved state and start a fresh crawl '''
+		self._queued, self._visited, self._profiles = [], [], []
+		self.conn.executescript("DELETE FROM frontier; DELETE FROM visited; DELETE FROM profiles;")
+
+	def queue(self, urls, tag):
+		self._queued.extend([(u, tag) for u in urls])
+
+	def visit(self, url, profile=None):
+		self._visited.append(url)
+		if profile is not None:
+			self._profiles.append((url, sqlite3.Binary(zlib.compress(
+				cPickle.dumps(profile, cPickle.HIGHEST_PROTOCOL)))))
+		if len(self._visited) >= self.every:
+			self.flush()
+
+	def flush(self):
+		''' Write everything buffered so far in one transaction '''
+		if not (self._queued or self._visited):
+			return
+		with METRICS.timer('checkpoint'), self.conn:
+			self.conn.executemany("INSERT OR IGNORE INTO frontier (url, tag) VALUES (?, ?)", self._queued)
+			self.conn.executemany("DELETE FROM frontier WHERE url = ?", [(u,) for u in self._visited])
+			self.conn.executemany("INSERT OR IGNORE INTO visited (url) VALUES (?)", [(u,) for u in self._visited])
+			self.conn.executemany("INSERT OR REPLACE INTO profiles (url, data) VALUES (?, ?)", self._profiles)
+		self._queued, self._visited, self._profiles = [], [], []
+
+	def restore(self, crawler):
+		''' Load the saved frontier, visited links and profiles into crawler '''
+		crawler.link_queue = Frontier(self.conn.execute("SELECT url, tag FROM frontier ORDER BY rowid"),
+									  crawler.link_queue.priority)
+		for (url,) in self.conn.execute("SELECT url FROM visited"):
+			crawler.crawled.add(url)
+		for url, data in self.conn.execute("SELECT url, data FROM profiles"):
+			crawler.restaurants[url] = Venue.from_dict(cPickle.loads(zlib.decompress(data)))
+		return crawler
+
+	def close(self):
+		self.flush()
+		self.conn.close()
+
+
+def content_digest(profile, links):
+	''' What a page is worth recrawling for: its profile, or the links on a category page '''
+	# not mp_url, so the same venue under another url has the same digest
+	content = profile is not None and dict(profile, mp_url=None) or sorted(links or [])
+	return hashlib.md5(json.dumps(content, sort_keys=True, default=repr)).hexdigest()
+
+
+class RecrawlSchedule(object):
+	'''	Per-url history kept across runs (last fetch, content digest, newest
+		review, ratings count, fetch and change counts) to decide what is worth
+		refetching.  A page's change rate is estimated from how often its
+		digest changed between fetches, or from how fast its ratings count is
+		growing if that is quicker, and plan() puts the pages most likely to
+		have changed since their last fetch first: 1 - exp(-rate * age).
+		Pages we know about but have never fetched come before all of them.
+	'''
+	DAY = 86400.0
+	DEFAULT_RATE = 1 / 7.0  # changes per day assumed for a page fetched only once
+	
+	def __init__(self, path=SCHEDULE_FILE, every=50):
+		self.path = path
+		self.every = every
+		self._visits = 0
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		self.conn.executescript('''
+			CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, first_fetch REAL, last_fetch REAL,
+				digest TEXT, page_print BLOB, last_review TEXT, rating_count INTEGER, count_rate REAL DEFAULT 0,
+				fetches INTEGER DEFAULT 0, changes INTEGER DEFAULT 0);
+			''')
+	
+	def is_empty(self):
+		return not self.conn.execute("SELECT EXISTS (SELECT 1 FROM pages)").fetchone()[0]
+	
+	def discover(self, urls):
+		''' Remember urls we have seen links to, to be planned in a later run '''
+		self.conn.executemany("INSERT OR IGNORE INTO pages (url) VALUES (?)", [(u,) for u in urls])
+	
+	def venues(self):
+		''' {url: whether it gave a venue profile} for every page fetched so far '''
+		return dict((url, bool(venue)) for url, venue in self.conn.execute(
+			"SELECT url, rating_count IS NOT NULL FROM pages WHERE last_fetch IS NOT NULL"))
+	
+	def last_review(self, url):
+		''' The date of the newest review of the venue at url seen so far (None if none) '''
+		row = self.conn.execute("SELECT last_review FROM pages WHERE url = ?", (url,)).fetchone()
+		return row and row[0]
+	
+	def fingerprints(self):
+		''' (url, html fingerprint) and (url, content digest) pairs for ContentFingerprints '''
+		rows = self.conn.execute("SELECT url, page_print, digest FROM pages WHERE last_fetch IS NOT NULL").fetchall()
+		return ([(url, str(p)) for url, p, d in rows if p is not None],
+				[(url, d) for url, p, d in rows if d is not None])
+	
+	def visit(self, url, digest=None, profile=None, now=None, page_print=None):
+		'''	Record a fetch of url.  digest None means the page was unchanged
+			(a 304); profile, for venues, gives the ratings count and reviews. '''
+		now = now or time.time()
+		self._visits += 1
+		if self._visits % self.every == 0:
+			self.conn.commit()
+		row = self.conn.execute("SELECT last_fetch, digest, rating_count, count_rate, last_review, page_print "
+								"FROM pages WHERE url = ?", (url,)).fetchone()
+		last_fetch, old_digest, old_count, count_rate, last_review, old_print = row or (None, None, None, 0.0, None, None)
+		page_print = page_print is not None and sqlite3.Binary(page_print) or old_print
+		count = None
+		if profile is not None:
+			count = (profile['ratings'] or {}).get('count', 0)  # 0 for an unrated venue: still a venue (see venues)
+			last_review = max([rv['dtreviewed'] for rv in profile['reviews'] or []] + [last_review or '']) or None
+		if last_fetch is None:
+			self.conn.execute("INSERT OR REPLACE INTO pages (url, first_fetch, last_fetch, digest, page_print, "
+							  "last_review, rating_count, fetches) VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+							  (url, now, now, digest, page_print, last_review, count))
+			return
+		changed = digest is not None and digest != old_digest
+		if count is not None and old_count is not None and now > last_fetch:
+			# smooth the growth over the last few fetches
+			count_rate = 0.5 * count_rate + 0.5 * max(count - old_count, 0) * self.DAY / (now - last_fetch)
+		self.conn.execute("UPDATE pages SET last_fetch = ?, digest = ?, page_print = ?, last_review = ?, "
+						  "rating_count = ?, count_rate = ?, fetches = fetches + 1, changes = changes + ? "
+						  "WHERE url = ?",
+						  (now, digest or old_digest, page_print, last_review,
+						   count if count is not None else old_count, count_rate, int(changed), url))
+	
+	def change_rate(self, first_fetch, last_fetch, fetches, changes, count_rate):
+		''' Estimated changes per day '''
+		if fetches < 2 or last_fetch <= first_fetch:
+			rate = self.DEFAULT_RATE
+		else:
+			# Cho & Garcia-Molina's estimator for changes seen over fetches-1 intervals
+			n = fetches - 1
+			interval = (last_fetch - first_fetch) / n / self.DAY
+			rate = -math.log((n - changes + 0.5) / (n + 0.5)) / interval
+		return max(rate, count_rate or 0.0)
+	
+	def staleness(self, row, now):
+		first_fetch, last_fetch, fetches, changes, count_rate = row
+		if last_fetch is None:
+			return 2.0  # never fetched
+		age = max(now - last_fetch, 0) / self.DAY
+		return 1 - math.exp(-self.change_rate(first_fetch, last_fetch, fetches, changes, count_rate) * age)
+	
+	def plan(self, budget=-1, now=None):
+		''' The `budget` urls (all, if negative) most likely to have changed, stalest first '''
+		now = now or time.time()
+		rows = self.conn.execute("SELECT url, first_fetch, last_fetch, fetches, changes, count_rate FROM pages")
+		scored = ((self.staleness(row[1:], now), row[0]) for row in rows)
+		if budget < 0:
+			return [url for score, url in sorted(scored, reverse=True)]
+		return [url for score, url in heapq.nlargest(budget, scored)]
+	
+	def flush(self):
+		self.conn.commit()
+	
+	def close(self):
+		self.conn.commit()
+		self.conn.close()
+
+
+class PageArchive(object):
+	'''	Raw bodies of fetched pages, so extraction can be rerun (see
+		MpCrawler.reparse) without refetching anything.  Each body is zlib
+		compressed and appended to the current segment file in directory
+		`path` (a new one is started past `segment_bytes`); an SQLite index
+		maps each url to the segment, offset and length of its latest body.
+		Segments are read through read-only mmaps, the compressed bytes handed
+		to zlib as buffers over the map rather than copied out first.  Index
+		entries are committed every `every` pages, after the segment data they
+		point at has been flushed.
+	'''
+	def __init__(self, path=ARCHIVE_DIR, every=50, segment_bytes=256 << 20, level=6):
+		self.path = path
+		self.every = every
+		self.segment_bytes = segment_bytes
+		self.level = level
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+		self.conn.executescript('''
+			CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, segment INTEGER, offset INTEGER,
+				length INTEGER, size INTEGER, fetched REAL);
+			''')
+		self._lock = threading.Lock()
+		self._pending = []
+		self._maps = {}
+		self._out = None
+		self.segment = self.conn.execute("SELECT COALESCE(MAX(segment), 0) FROM pages").fetchone()[0]
+
+	def __len__(self):
+		return self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0] + len(self._pending)
+
+	def _segment_file(self, segment):
+		return os.path.join(self.path, 'segment-%05d.dat' % segment)
+
+	def add(self, url, data, fetched=None):
+		blob = zlib.compress(data, self.level)
+		self._lock.acquire()
+		try:
+			if self._out is None or self._out.tell() >= self.segment_bytes:
+				self._roll()
+			offset = self._out.tell()
+			self._out.write(blob)
+			self._pending.append((url, self.segment, offset, len(blob), len(data), fetched or time.time()))
+			if len(self._pending) >= self.every:
+				self._flush()
+		finally:
+			self._lock.release()
+
+	def _roll(self):
+		if self._out is not None:
+			self._out.close()
+			self.segment += 1
+		self._out = open(self._segment_file(self.segment), 'ab')
+		self._out.seek(0, os.SEEK_END)  # 'a' mode reports 0 until the first write
+		if self._out.tell() >= self.segment_bytes:
+			self._roll()
+
+	def _flush(self):
+		if self._out is not None:
+			self._out.flush()
+			os.fsync(self._out.fileno())
+		with self.conn:
+			self.conn.executemany("INSERT OR REPLACE INTO pages (url, segment, offset, length, size, fetched) "
+								  "VALUES (?, ?, ?, ?, ?, ?)", self._pending)
+		self._pending = []
+
+	def flush(self):
+		self._lock.acquire()
+		try:
+			self._flush()
+		finally:
+			self._lock.release()
+
+	def _map(self, segment, end):
+		mm = self._maps.get(segment)
+		if mm is None or len(mm) < end:  # a segment still being appended to has grown
+			if mm is not None:
+				mm.close()
+			fp = open(self._segment_file(segment), 'rb')
+			try:
+				mm = self._maps[segment] = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+			finally:
+				fp.close()
+		return mm
+
+	def _body(self, segment, offset, length):
+		return zlib.decompress(buffer(self._map(segment, offset + length), offset, length))
+
+	def get(self, url):
+		''' The latest body archived for url, or None '''
+		row = self.conn.execute("SELECT segment, offset, length FROM pages WHERE url = ?", (url,)).fetchone()
+		return row and self._body(*row)
+
+	def urls(self):
+		return [url for (url,) in self.conn.execute("SELECT url FROM pages ORDER BY segment, offset")]
+
+	def pages(self):
+		''' (url, body) of every archived page, in the order they sit on disk '''
+		rows = self.conn.execute("SELECT url, segment, offset, length FROM pages ORDER BY segment, offset").fetchall()
+		for url, segment, offset, length in rows:
+			yield url, self._body(segment, offset, length)
+
+	def close(self):
+		self.flush()
+		if self._out is not None:
+			self._out.close()
+			self._out = None
+		for mm in self._maps.values():
+			mm.close()
+		self._maps = {}
+		self.conn.close()
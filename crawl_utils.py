@@ -1,13 +1,20 @@
 from __future__ import print_function
 
-from sgmllib import SGMLParser
-from HTMLParser import HTMLParser, HTMLParseError
-from htmlentitydefs import entitydefs
-from BeautifulSoup import BeautifulSoup, MinimalSoup, SoupStrainer  ### HTML Parsing
-from StringIO import StringIO
+# Only what the whole crawl needs is imported here: the HTTP stack (crawl_http)
+# and the SGML/HTML parsers (crawl_parse) are imported the first time a page
+# is fetched or a FieldSpec run, so a process that never does either (or a
+# worker that doesn't yet) doesn't pay for them.  See crawl_bench.py imports.
+import urlparse
+import threading, Queue, time
+import os, re, zlib, hashlib, cPickle, struct, math
+from collections import OrderedDict
 
-import urllib2, urlparse, gzip
-import re
+from crawl_metrics import METRICS
+
+try:
+    import brotli  # optional: lets us accept br-encoded pages
+except ImportError:
+    brotli = None
 
 __author__ = 'Jeremy S. Gerstle (jgerstle@realoptimal.com)'
 __date__  = '$Date: 2011-06-28 16:25:41 $'
@@ -15,152 +22,930 @@ __date__  = '$Date: 2011-06-28 16:25:41 $'
 ''' Tools for Querying URLs and Grabbing HTML Objects '''
 
 USER_AGENT = 'Mozilla/5.0' #"crawl_utils/1.0 +http://www.realoptimal.com/"
+ACCEPT_ENCODING = brotli and 'gzip, deflate, br' or 'gzip, deflate'
+CHUNK_SIZE = 64 * 1024  # bytes read off the socket at a time
+        
 
+class PooledResponse(object):
+    '''File-like view of an httplib response that hands its connection back
+       to the pool once the body has been read to the end'''
+    def __init__(self, pool, key, conn, resp, url, status):
+        self.pool, self.key, self.conn, self.resp = pool, key, conn, resp
+        self.headers = resp.msg
+        self.url = url
+        self.status = status
 
-# Subclass urllib2.HTTPRedirectHandler so that we know status code for future
-class SmartRedirectHandler(urllib2.HTTPRedirectHandler):
-    def http_error_301(self, req, fp, code, msg, headers):
-        result = urllib2.HTTPRedirectHandler.http_error_301(
-            self, req, fp, code, msg, headers)
-        result.status = code
-        return result
+    def read(self, amt=None):
+        data = self.resp.read(amt)
+        if self.resp.isclosed():
+            self.close()
+        return data
 
-    def http_error_302(self, req, fp, code, msg, headers):
-        result = urllib2.HTTPRedirectHandler.http_error_302(
-            self, req, fp, code, msg, headers)
-        result.status = code
-        return result
-        
+    def close(self):
+        if self.conn is None:
+            return
+        if self.resp.isclosed() and not self.resp.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            # body left unread or server said goodbye: the socket can't be reused
+            self.conn.close()
+        self.conn = None
 
-# Subclass urllib2.HTTPError so that we handle errors gracefully       
-class DefaultErrorHandler(urllib2.HTTPDefaultErrorHandler):
-    def http_error_default(self, req, fp, code, msg, headers):
-        result = urllib2.HTTPError(
-            req.get_full_url(), code, msg, headers, fp)
-        result.status = code
-        return result
-        
 
-def open_url(source, etag=None, lastmodified=None, agent=USER_AGENT):
+
+class ConnectionPool(object):
+    '''Keep-alive HTTP/1.1 connections, kept idle per (scheme, host) and reused
+       across requests.  Redirects and error statuses are reported the way
+       crawl_http's SmartRedirectHandler and DefaultErrorHandler report them
+       through urllib2: a 301/302 sets `status` to the redirect code on the
+       final response and an error response is returned (not raised) with
+       `status` set to its code.'''
+    MAX_REDIRECTS = 10
+    MAX_IDLE = 8  # per host
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.reused = 0
+        self.requests = 0
+
+    def stats(self):
+        return {'requests' : self.requests, 'opened' : self.opened, 'reused' : self.reused}
+
+    def acquire(self, key):
+        self._lock.acquire()
+        try:
+            self.requests += 1
+            idle = self._idle.get(key)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+        finally:
+            self._lock.release()
+        import crawl_http
+        return crawl_http.connection(key[0], key[1], self.timeout), False
+
+    def release(self, key, conn):
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.MAX_IDLE:
+                idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+    def _send(self, conn, path, headers):
+        if conn.sock is None:
+            conn.connect()
+        start = time.time()
+        conn.request('GET', path, headers=headers)
+        resp = conn.getresponse()
+        METRICS.observe('ttfb', time.time() - start)  # request out to response headers in
+        return conn, resp
+
+    def _request(self, key, path, headers):
+        import httplib, socket
+        conn, reused = self.acquire(key)
+        try:
+            return self._send(conn, path, headers)
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused:
+                raise
+        # an idle connection the server has since dropped; retry once on a fresh one
+        METRICS.incr('stale_connections')
+        conn, reused = self.acquire(key)
+        try:
+            return self._send(conn, path, headers)
+        except:
+            conn.close()
+            raise
+
+    def open(self, source, headers):
+        status = None
+        for hop in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(source)
+            key = (parts[0], parts[1])
+            path = urlparse.urlunsplit(('', '', parts[2] or '/', parts[3], ''))
+            conn, resp = self._request(key, path, headers)
+            location = resp.getheader('location') or resp.getheader('uri')
+            if resp.status in (301, 302, 303, 307) and location:
+                # drain the redirect body so the connection can go back to the pool
+                resp.read()
+                PooledResponse(self, key, conn, resp, source, None).close()
+                if status is None and resp.status in (301, 302):
+                    status = resp.status
+                source = urlparse.urljoin(source, location)
+                continue
+            if status is None:
+                status = resp.status
+            return PooledResponse(self, key, conn, resp, source, status)
+        import crawl_http
+        raise crawl_http.redirect_loop(source, resp)
+
+
+HTTP_POOL = ConnectionPool()
+
+
+def open_url(source, etag=None, lastmodified=None, agent=USER_AGENT, pool=None):
 	""" Function takes a source URL and builds a stream object capable of 
 		handling redirects and other HTTP request errors and opens the connection.
 		It also checks to see if the requested page is cached via a server ETag 
 		and if the requested page has been modified since our last request.
+		Requests go over a kept-alive connection from `pool` (HTTP_POOL by
+		default); pass pool=False to open a one-off connection through urllib2.
 	"""
 	
-	if urlparse.urlparse(source)[0] == 'http':
+	scheme = urlparse.urlparse(source)[0]
+	if pool is not False and scheme in ('http', 'https'):
+		headers = {'User-Agent' : agent, 'Accept-encoding' : ACCEPT_ENCODING}
+		if lastmodified:
+			headers['If-Modified-Since'] = lastmodified
+		if etag:
+			headers['If-None-Match'] = etag
+		return (pool or HTTP_POOL).open(source, headers)
+	
+	if scheme == 'http':
 		# open URL with urllib2
-		request = urllib2.Request(source)
-		request.add_header('User-Agent', agent)
+		import crawl_http
+		headers = {'User-Agent' : agent, 'Accept-encoding' : ACCEPT_ENCODING}
 		if lastmodified:
-			request.add_header('If-Modified-Since', lastmodified)
+			headers['If-Modified-Since'] = lastmodified
 		if etag:
-			request.add_header('If-None-Match', etag)
-		request.add_header('Accept-encoding', 'gzip')
-		opener = urllib2.build_opener(SmartRedirectHandler(), DefaultErrorHandler())
-		return opener.open(request)
+			headers['If-None-Match'] = etag
+		return crawl_http.open_urllib2(source, headers)
 		
 
 
-def fetch_page(source, etag=None, lastmodified=None, agent=USER_AGENT):
-    '''Fetch data and metadata from a URL'''
+class HttpCache(object):
+    '''On-disk cache of fetched pages keyed by URL.  Each entry keeps the
+       decompressed body with the ETag / Last-Modified validators it was served
+       with, so a recrawl can ask for it conditionally and reuse it on a 304,
+       and beside it the profile scraped from it, so a 304 needn't be re-scraped.'''
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _file(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, url):
+        return self._read(self._file(url))
+
+    def put(self, url, page):
+        if not (page.get('etag') or page.get('lastmodified')):
+            return  # nothing to revalidate with
+        self._write(self._file(url), {'url' : url, 'data' : page['data'],
+                                      'etag' : page.get('etag'), 'lastmodified' : page.get('lastmodified')})
+
+    def profile(self, url):
+        '''The profile last scraped from the cached page, to stand in for it on a 304'''
+        return self._read(self._file(url) + '.profile')
+
+    def put_profile(self, url, profile):
+        self._write(self._file(url) + '.profile', profile)
+
+    def _read(self, fname):
+        try:
+            fp = open(fname, 'rb')
+        except IOError:
+            return None
+        try:
+            return cPickle.loads(zlib.decompress(fp.read()))
+        except Exception:
+            return None  # truncated or stale format; treat as a miss
+        finally:
+            fp.close()
+
+    def _write(self, fname, entry):
+        if not os.path.isdir(os.path.dirname(fname)):
+            try:
+                os.makedirs(os.path.dirname(fname))
+            except OSError:
+                pass  # another thread got there first
+        # write to a temp file and rename over the old entry so readers never see half a file
+        import tempfile
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname))
+        fp = os.fdopen(fd, 'wb')
+        try:
+            fp.write(zlib.compress(cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL)))
+        finally:
+            fp.close()
+        os.rename(tmp, fname)
+
+
+class PageTooLarge(Exception):
+    '''A body that decodes to more than fetch_page's max_bytes'''
+
+
+class BodyDecoder(object):
+    '''Decodes a response body a chunk at a time as it comes off the socket,
+       for a Content-Encoding of gzip, deflate, br (with the brotli module) or
+       none, so the compressed body is never held whole.  A gzip body may be
+       several members back to back, each decoded in turn.  Raises PageTooLarge
+       once the decoded body would pass max_bytes; zlib is asked for no more
+       than that, so a small compressed body can't balloon in memory first.'''
+    def __init__(self, encoding=None, max_bytes=None):
+        self.encoding = (encoding or '').strip().lower()
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._zlib = None
+        self._brotli = None
+        self._head = None
+        self._gzip = self.encoding in ('gzip', 'x-gzip')
+        if self._gzip:
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == 'deflate':
+            self._head = ''  # zlib-wrapped or raw deflate (as some servers send it): see the first 2 bytes
+        elif self.encoding == 'br':
+            if brotli is None:
+                raise ValueError('br-encoded body and no brotli module to decode it')
+            d = brotli.Decompressor()
+            self._brotli = getattr(d, 'process', None) or d.decompress  # brotli or brotlipy
+
+    def _room(self):
+        return self.max_bytes is not None and self.max_bytes - self.size + 1 or 0
+
+    def _count(self, out):
+        self.size += len(out)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise PageTooLarge('body over %d bytes' % self.max_bytes)
+        return out
+
+    def decode(self, chunk):
+        if self._head is not None:
+            self._head += chunk
+            if len(self._head) < 2:
+                return ''
+            chunk, self._head = self._head, None
+            cmf, flg = ord(chunk[0]), ord(chunk[1])
+            wrapped = cmf & 0x0f == 8 and (cmf << 8 | flg) % 31 == 0
+            self._zlib = zlib.decompressobj(wrapped and zlib.MAX_WBITS or -zlib.MAX_WBITS)
+        if self._zlib is not None:
+            out = self._count(self._zlib.decompress(chunk, self._room()))
+            # what follows the end of a gzip member is the next one (or zero padding)
+            while self._gzip and self._zlib.unused_data.strip('\0'):
+                rest = self._zlib.unused_data
+                self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                out += self._count(self._zlib.decompress(rest, self._room()))
+            return out
+        if self._brotli is not None:
+            return self._count(self._brotli(chunk))
+        return self._count(chunk)
+
+    def finish(self):
+        out = ''
+        if self._head:
+            self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)  # a 1-byte body can't be zlib-wrapped
+            out = self._count(self._zlib.decompress(self._head, self._room()))
+        if self._zlib is not None:
+            out += self._count(self._zlib.flush())
+        return out
+
+
+def fetch_page(source, etag=None, lastmodified=None, agent=USER_AGENT, pool=None, cache=None,
+               max_bytes=None, on_chunk=None):
+    '''Fetch data and metadata from a URL.  With an HttpCache the request is
+       made conditional on the cached validators; a 304 comes back with
+       status 304, the cached body as data and fromcache set.
+       The body is read and decoded CHUNK_SIZE bytes at a time (see
+       BodyDecoder); a body over max_bytes raises PageTooLarge.  With
+       on_chunk, each decoded chunk is handed to it as it arrives (to feed an
+       incremental parser, say) and data is left empty, unless the page is
+       going into the cache.'''
+    entry = None
+    if cache is not None:
+        entry = cache.get(source)
+        if entry and not (etag or lastmodified):
+            etag, lastmodified = entry['etag'], entry['lastmodified']
     result = {}
-    f = open_url(source, etag, lastmodified, agent)
-    result['data'] = f.read()
-    if hasattr(f, 'headers'):
-        # save ETag, if the server sent one
-        result['etag'] = f.headers.get('ETag')
-        # save Last-Modified header, if the server sent one
-        result['lastmodified'] = f.headers.get('Last-Modified')
-        if f.headers.get('content-encoding') == 'gzip':
-            # data came back gzip-compressed, decompress it
-            result['data'] = gzip.GzipFile(fileobj=StringIO(result['data'])).read()
-    if hasattr(f, 'url'):
-        result['url'] = f.url
-        result['status'] = 200
-    if hasattr(f, 'status'):
-        result['status'] = f.status
-    f.close()
+    f = open_url(source, etag, lastmodified, agent, pool)
+    try:
+        headers = getattr(f, 'headers', None)
+        decoder = BodyDecoder(headers and headers.get('content-encoding'), max_bytes)
+        keep = on_chunk is None or cache is not None
+        parts, received, decoding = [], 0, 0.0
+        with METRICS.timer('download'):
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                last = not chunk
+                start = time.time()
+                try:
+                    data = decoder.finish() if last else decoder.decode(chunk)
+                except PageTooLarge:
+                    METRICS.incr('too_large')
+                    raise
+                decoding += time.time() - start
+                received += len(chunk)
+                if data:
+                    if on_chunk is not None:
+                        on_chunk(data)
+                    if keep:
+                        parts.append(data)
+                if last:
+                    break
+        result['data'] = ''.join(parts)
+        METRICS.incr('bytes', received)
+        if decoder.encoding:
+            METRICS.observe('decode', decoding)
+        if headers is not None:
+            # save ETag, if the server sent one
+            result['etag'] = headers.get('ETag')
+            # save Last-Modified header, if the server sent one
+            result['lastmodified'] = headers.get('Last-Modified')
+            # how long a 429/503 asks us to wait before trying again
+            result['retryafter'] = headers.get('Retry-After')
+        if hasattr(f, 'url'):
+            result['url'] = f.url
+            result['status'] = 200
+        if hasattr(f, 'status'):
+            result['status'] = f.status
+        METRICS.incr('http_%s' % result.get('status'))
+    finally:
+        f.close()  # a PooledResponse left unread closes its socket rather than reuse it
+    if cache is not None:
+        if result.get('status') == 304 and entry:
+            result['data'] = entry['data']
+            result['etag'] = result.get('etag') or entry['etag']
+            result['lastmodified'] = result.get('lastmodified') or entry['lastmodified']
+            result['fromcache'] = True
+        elif result.get('status') == 200:
+            cache.put(source, result)
     return result
     
 
-'''
-# ---------------------------------------------------------------------------------------
-# ---------------------------------SIMPLE & EFFECTIVE -----------------------------------
-# ---------------------------------------------------------------------------------------
-'''
+class HostThrottle(object):
+    '''Per-host politeness: cap the requests in flight to one host and keep
+       consecutive requests to it at least `delay` seconds apart'''
+    def __init__(self, limit=2, delay=0.0):
+        self.limit = max(int(limit), 1)
+        self.delay = delay
+        self._cond = threading.Condition()
+        self._active = {}   # host -> requests in flight
+        self._next = {}     # host -> earliest time the next request may start
 
-''' Tools for Parsing HTML Objects ''' 
-		
-class URLLister(SGMLParser):
-	def reset(self):
-		# extend (called by SGMLParser.__init__)
-		self.urls = []
-		SGMLParser.reset(self)
-		
-	def start_a(self, attrs):
-		href = [v for k,v in attrs if k=='href']
-		if href:
-			self.urls.extend(href)
-		
-'''
-# ---------------------------------------------------------------------------------------
-# -------------------------------------- TODO -------------------------------------------
-# ---------------------------------------------------------------------------------------
-'''
+    def acquire(self, host):
+        self._cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                busy = self._active.get(host, 0) >= self.limit
+                wait = self._next.get(host, 0) - now
+                if not busy and wait <= 0:
+                    break
+                # a full host waits for a release; otherwise just sleep out the delay
+                self._cond.wait(None if busy else wait)
+            self._active[host] = self._active.get(host, 0) + 1
+            self._next[host] = now + self.delay
+        finally:
+            self._cond.release()
 
-class ParsePageError(HTMLParseError):
-	"""Exception raised for all parse errors."""
+    def release(self, host):
+        self._cond.acquire()
+        try:
+            self._active[host] -= 1
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
 
-	def __init__(self, msg, position=(None, None)):
-		HTMLParseError.__init__(self, msg, position)
-		
 
-	def __str__(self):
-    		result = HTMLParseError.__str__(self)
-		return result
+def retry_after_seconds(value, now=None):
+    '''Seconds to wait from a Retry-After header: delta-seconds or an HTTP date'''
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    from email.utils import parsedate_tz, mktime_tz
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - (now or time.time()), 0.0)
 
 
+class TokenBucket(object):
+    '''Requests allowed at `rate` per second on average, in bursts of up to
+       `burst`; take() blocks until a token is free'''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.hold = 0.0  # no tokens at all before this time (Retry-After)
+        self._lock = threading.Lock()
 
-class ParsePage(HTMLParser):
-	def reset(self):
-		# extend (called by HTMLParser.__init__)
-		self.pieces = []		
-		HTMLParser.reset(self)
-		
+    def take(self):
+        while True:
+            self._lock.acquire()
+            try:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if now >= self.hold and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.hold - now, (1 - self.tokens) / self.rate)
+            finally:
+                self._lock.release()
+            time.sleep(wait)
 
-	def handle_starttag(self, tag, attrs):
-		strattrs = "".join([' %s="%s"' % (key, value) for key, value in attrs])
-		print("Parsed: <%(tag)s%(strattrs)s>" % locals())
-		if tag=='script':
-			self.handle_comment(attrs)
-		else:
-			print('Tag start:', tag, attrs)
-		
 
-	def handle_endtag(self, tag):
-		print('tag end:  ', tag)
-		
-	def handle_data(self, data):
-		print('data......', data.rstrip())
-		
-	def handle_charref(self, name):
-		print('charref.......', name)
-		
-	def handle_entityref(self, name):
-		if entitydefs.has_key(name):
-			print('ref.......', entitydefs[name])
-	
-	def handle_comment(self, data):
-		print('comment.......', data)
-		
-	def handle_decl(self, decl):
-		print('SGML Decl.....', decl)
-		
-	def handle_pi(self, text):
-		print('Proc Instr....', text)
-		
-		
-		
-    
+class HostRateLimiter(object):
+    '''A TokenBucket per host whose rate adapts AIMD-style to how the host is
+       coping: every quick, successful response adds `increase` requests/sec (up
+       to max_rate) and every throttling or server error, or a response more
+       than `slow` times slower than the fastest seen from that host, halves it
+       (down to min_rate).  A Retry-After stops all requests to the host until
+       it has passed.  Like TCP, the rate is cut at most once per `window`
+       seconds, so a burst of failures from requests already in flight
+       counts as one.'''
+    def __init__(self, rate=5.0, max_rate=20.0, min_rate=0.2, increase=1.0, decrease=0.5, slow=4.0, window=1.0):
+        self.start, self.max_rate, self.min_rate = rate, max_rate, min_rate
+        self.increase, self.decrease, self.slow, self.window = increase, decrease, slow, window
+        self.buckets = {}
+        self.fastest = {}
+        self.last_cut = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, host):
+        self._lock.acquire()
+        try:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.start)
+            return self.buckets[host]
+        finally:
+            self._lock.release()
+
+    def acquire(self, host):
+        self.bucket(host).take()
+
+    def feedback(self, host, latency, status=None, retry_after=None):
+        '''Adjust host's rate after a request: status None for a network error'''
+        b = self.bucket(host)
+        self._lock.acquire()
+        try:
+            fastest = self.fastest[host] = min(self.fastest.get(host, latency), latency)
+            if status is None or status == 429 or status >= 500 or latency > self.slow * max(fastest, 0.05):
+                now = time.time()
+                if now - self.last_cut.get(host, 0) >= self.window:
+                    b.rate = max(self.min_rate, b.rate * self.decrease)
+                    self.last_cut[host] = now
+            else:
+                b.rate = min(self.max_rate, b.rate + self.increase)
+            b.burst = max(b.rate, 1)
+            if retry_after:
+                b.hold = max(b.hold, time.time() + retry_after)
+        finally:
+            self._lock.release()
+
+    def rates(self):
+        return dict([(host, b.rate) for host, b in self.buckets.items()])
+
+
+class RetryPolicy(object):
+    '''Which failed fetches to try again and how long to wait first: a random
+       time up to base * 2**attempt seconds (capped at `cap`), or as long as
+       the server's Retry-After asks'''
+    STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=3, base=0.5, cap=30.0, max_retry_after=300.0):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.max_retry_after = max_retry_after
+
+    def should_retry(self, attempt, page, error):
+        if attempt >= self.retries:
+            return False
+        if error is not None:
+            import crawl_http  # loaded already, by the fetch that failed
+            return isinstance(error, crawl_http.ERRORS)
+        return page.get('status') in self.STATUSES
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after)
+        import random
+        return random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+
+
+class FetchPool(object):
+    '''Worker threads pulling URLs off a request queue and running fetch_page.
+       Each result comes back on `results` as a ('fetch', url, page, error)
+       tuple, so the caller can parse one page while the workers are busy
+       fetching the next (and can share the queue with other pipeline stages).
+       With a HostRateLimiter each request first waits for a token for its
+       host, and with a RetryPolicy failed fetches are retried before the
+       result is posted.'''
+    def __init__(self, workers=4, host_limit=2, delay=0.0, fetch=fetch_page, results=None,
+                 limiter=None, retry=None, **fetch_args):
+        self.requests = Queue.Queue()
+        self.results = results or Queue.Queue()
+        self.throttle = HostThrottle(host_limit, delay)
+        self.limiter = limiter  # optional HostRateLimiter
+        self.retry = retry  # optional RetryPolicy
+        self.retried = 0
+        self.fetch = fetch
+        self.fetch_args = fetch_args
+        self.threads = [threading.Thread(target=self._work) for i in range(max(int(workers), 1))]
+        for t in self.threads:
+            t.daemon = True
+            t.start()
+
+    def size(self):
+        return len(self.threads)
+
+    def submit(self, url):
+        self.requests.put(url)
+
+    def _work(self):
+        while True:
+            url = self.requests.get()
+            if url is None:
+                break
+            host = urlparse.urlparse(url)[1]
+            attempt = 0
+            while True:
+                page, error = self._fetch(url, host)
+                if not (self.retry and self.retry.should_retry(attempt, page, error)):
+                    break
+                wait = retry_after_seconds(page and page.get('retryafter'))
+                time.sleep(self.retry.delay(attempt, wait))
+                attempt += 1
+                self.retried += 1
+                METRICS.incr('retries')
+            self.results.put(('fetch', url, page, error))
+
+    def _fetch(self, url, host):
+        page, error = None, None
+        start = time.time()
+        if self.limiter:
+            self.limiter.acquire(host)
+        self.throttle.acquire(host)
+        METRICS.observe('throttle_wait', time.time() - start)
+        start = time.time()
+        try:
+            page = self.fetch(url, **self.fetch_args)
+        except Exception, e:
+            error = e
+        finally:
+            self.throttle.release(host)
+        METRICS.observe('fetch', time.time() - start)
+        if error is not None:
+            METRICS.incr('fetch_errors')
+        if self.limiter:
+            self.limiter.feedback(host, time.time() - start, page and page.get('status'),
+                                  retry_after_seconds(page and page.get('retryafter')))
+        return page, error
+
+    def close(self):
+        for t in self.threads:
+            self.requests.put(None)
+        for t in self.threads:
+            t.join()
+
+
+''' Tools for Tracking Crawl State '''
+
+_DEFAULT_PORTS = {'http' : 80, 'https' : 443}
+
+def normalize_url(url):
+    '''Canonical form of a URL for queueing and dedupe: lower-case scheme and
+       host, no default port, no fragment and '/' for an empty path'''
+    parts = urlparse.urlsplit(url.strip())
+    scheme, netloc = parts[0].lower(), parts[1].lower()
+    if ':' in netloc:
+        host, port = netloc.rsplit(':', 1)
+        if port.isdigit() and _DEFAULT_PORTS.get(scheme) == int(port):
+            netloc = host
+    return urlparse.urlunsplit((scheme, netloc, parts[2] or '/', parts[3], ''))
+
+
+_MISSING = object()
+
+
+class Frontier(object):
+    '''Link queue mapping url -> category tag, with a FIFO per tag.  Iterating
+       over it goes through the tags in `priority` order (tags not listed
+       there last, in the order first queued), each in the order its links
+       were queued.  Lookups, inserts and removal of any url are O(1);
+       re-queueing a url keeps its place (and tag) in line.'''
+    def __init__(self, items=(), priority=()):
+        self.priority = list(priority)
+        self.queues = OrderedDict()
+        self.tags = {}
+        for url, tag in items:
+            self.push([url], tag)
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __contains__(self, url):
+        return url in self.tags
+
+    def __getitem__(self, url):
+        return self.tags[url]
+
+    def get(self, url, default=None):
+        return self.tags.get(url, default)
+
+    def count(self, tag):
+        queue = self.queues.get(tag)
+        return len(queue) if queue is not None else 0
+
+    def push(self, urls, tag):
+        '''Queue urls not already waiting and return how many were new'''
+        queue = self.queues.get(tag)
+        if queue is None:
+            queue = self.queues[tag] = OrderedDict()
+        added = 0
+        for url in urls:
+            if url not in self.tags:
+                self.tags[url] = tag
+                queue[url] = None
+                added += 1
+        return added
+
+    def pop(self, url, default=_MISSING):
+        tag = self.tags.pop(url, _MISSING)
+        if tag is _MISSING:
+            if default is _MISSING:
+                raise KeyError(url)
+            return default
+        del self.queues[tag][url]
+        return tag
+
+    def order(self):
+        return [t for t in self.priority if t in self.queues] + [t for t in self.queues if t not in self.priority]
+
+    def iterkeys(self):
+        for tag in self.order():
+            for url in self.queues[tag]:
+                yield url
+
+    __iter__ = iterkeys
+
+    def items(self):
+        return [(url, self.tags[url]) for url in self]
+
+    def popitem(self, last=True):
+        order = self.order()
+        for tag in (last and reversed(order) or order):
+            if self.queues[tag]:
+                url = self.queues[tag].popitem(last)[0]
+                del self.tags[url]
+                return url, tag
+        raise KeyError('popitem(): frontier is empty')
+
+
+def _slug(text):
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+class LinkClassifier(object):
+    '''Guesses what kind of page a link leads to, a venue ('by-name') or a
+       listing of venues by area, cuisine or feature, from its path alone.
+       Multinomial naive Bayes over the path depth, each path segment and
+       the words in it (digits folded to '#'), starting from a few seeded
+       pseudo-counts and learning as the crawl goes: each fetched page turns
+       out to be a venue or not (learn), and each venue profile names the
+       area, neighborhood, cuisine and features that category paths are
+       made of (learn_profile).  Features never seen with any tag (a new
+       venue's name, mostly) are left out of the score rather than counted
+       against every tag, which would favour the tag with fewest counts, and
+       there is no prior: how many pages of each kind have been fetched says
+       more about the order of the crawl than about the next link.  Depth is
+       seeded lighter than segments and words, since a venue (a /menu page
+       is taken for its venue's) and an area page can both sit one deep; and
+       venues get words common in their names, so that a tag's few seeds
+       don't make words it hasn't seen cost it less than the others.'''
+    TAGS = ('by-name', 'by-area', 'by-cuisine', 'by-feature')
+    CATEGORIES = TAGS[1:]
+    SEEDS = {
+        'by-name': ['depth=1', 'word=#', 'word=cafe', 'word=grill', 'word=bistro', 'word=kitchen', 'word=deli',
+                    'word=restaurant', 'word=house', 'word=tavern', 'word=trattoria'],
+        'by-area': ['depth=2', 'seg=manhattan', 'seg=brooklyn', 'seg=queens', 'seg=bronx', 'seg=staten-island',
+                    'word=area', 'word=areas', 'word=neighborhood', 'word=neighborhoods'],
+        'by-cuisine': ['depth=2', 'word=cuisine', 'word=cuisines'],
+        'by-feature': ['depth=2', 'word=feature', 'word=features'],
+        }
+    SEED_WEIGHT = 3
+    DEPTH_SEED_WEIGHT = 1
+    ALPHA = 0.5  # additive smoothing
+
+    def __init__(self, seeds=SEEDS):
+        self.counts = dict((tag, {}) for tag in self.TAGS)
+        self.totals = dict.fromkeys(self.TAGS, 0)
+        self.known = {}  # feature -> count over all tags
+        for tag, feats in seeds.items():
+            self._add(tag, [f for f in feats if f.startswith('depth=')], self.DEPTH_SEED_WEIGHT)
+            self._add(tag, [f for f in feats if not f.startswith('depth=')], self.SEED_WEIGHT)
+
+    @staticmethod
+    def features(url):
+        segs = [seg for seg in urlparse.urlsplit(url)[2].lower().split('/') if seg]
+        if segs[:1] in (['restaurants'], ['restaurant']):
+            segs = segs[1:]
+        if len(segs) > 1 and segs[-1] == 'menu':
+            segs = segs[:-1]  # a venue's menu page, taken for the venue's own
+        feats = ['depth=%d' % len(segs)]
+        for seg in segs:
+            feats.append('seg=' + seg)
+            feats.extend(['word=' + re.sub(r'\d+', '#', w) for w in re.split(r'[^a-z0-9]+', seg) if w])
+        return feats
+
+    def _add(self, tag, feats, weight=1):
+        counts = self.counts[tag]
+        for f in feats:
+            counts[f] = counts.get(f, 0) + weight
+            self.known[f] = self.known.get(f, 0) + weight
+        self.totals[tag] += weight * len(feats)
+
+    def scores(self, url):
+        '''Log likelihood (up to a constant) of url's path under each tag'''
+        feats = [f for f in self.features(url) if f in self.known]
+        scores = {}
+        for tag in self.TAGS:
+            counts = self.counts[tag]
+            denom = self.totals[tag] + self.ALPHA * len(self.known)
+            scores[tag] = sum([math.log((counts.get(f, 0) + self.ALPHA) / denom) for f in feats])
+        return scores
+
+    def classify(self, url, tags=TAGS):
+        scores = self.scores(url)
+        return max(tags, key=scores.get)
+
+    def learn(self, url, is_venue):
+        '''Count a fetched page in: a venue, or the likeliest kind of category page'''
+        tag = is_venue and 'by-name' or self.classify(url, self.CATEGORIES)
+        feats = self.features(url)
+        if is_venue:
+            # a venue's own name says nothing about the next one's, and there is one per venue
+            feats = [f for f in feats if not f.startswith('seg=')]
+        self._add(tag, feats)
+        return tag
+
+    def learn_profile(self, profile):
+        '''The first time an area, cuisine or feature turns up in a profile, seed
+           its slug as a path segment of that kind of category page'''
+        for tag, values in (('by-area', [profile.get('area'), profile.get('neighborhood')]),
+                            ('by-cuisine', [profile.get('cuisine')]),
+                            ('by-feature', profile.get('features') or [])):
+            for value in values:
+                seg = value and 'seg=' + _slug(value)
+                if seg and seg not in self.counts[tag]:
+                    self._add(tag, [seg], self.SEED_WEIGHT)
+
+
+class BloomFilter(object):
+    '''Fixed-size probabilistic set for very large visited sets.  Membership
+       tests may give false positives at about `error_rate` once `capacity`
+       items are in, but never false negatives.'''
+    def __init__(self, capacity, error_rate=0.001):
+        import math
+        self.capacity = capacity
+        self.nbits = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.nhashes = max(int(round(self.nbits * math.log(2) / capacity)), 1)
+        self.bits = bytearray((self.nbits + 7) // 8)
+        self.count = 0
+
+    def _probes(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(item).digest())
+        for i in xrange(self.nhashes):
+            yield (h1 + i * h2) % self.nbits
+
+    def add(self, item):
+        new = False
+        for b in self._probes(item):
+            if not self.bits[b >> 3] & (1 << (b & 7)):
+                self.bits[b >> 3] |= 1 << (b & 7)
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item):
+        for b in self._probes(item):
+            if not self.bits[b >> 3] & (1 << (b & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+
+_VOLATILE_RE = re.compile(r'<!--.*?-->|<script\b.*?</script\s*>|<style\b.*?</style\s*>', re.S | re.I)
+_SPACE_RE = re.compile(r'\s+')
+
+def html_fingerprint(data):
+    '''Digest of a page with comments, scripts, styles and runs of whitespace
+       taken out, so trivial differences in markup don't make it a new page'''
+    return hashlib.md5(_SPACE_RE.sub(' ', _VOLATILE_RE.sub('', data))).digest()
+
+
+class ContentFingerprints(object):
+    '''Tells a crawl which fetched pages it has effectively seen before.  page()
+       is checked before parsing, against the html_fingerprint of every page
+       fetched so far; fields() after parsing, against digests of the profiles
+       scraped so far (see crawl_store.content_digest).  Both return the url
+       that first had that content (the url itself for an unchanged page) or
+       None for new content, and a different url is recorded in `aliases` as
+       another name for that first one.'''
+    def __init__(self, page_prints=(), field_digests=()):
+        self.pages = dict([(p, url) for url, p in page_prints])  # html fingerprint -> url
+        self.profiles = dict([(d, url) for url, d in field_digests])  # field digest -> url
+        self.aliases = {}  # alias url -> canonical url
+        self.stats = {'unchanged': 0, 'aliases': 0}
+
+    def page(self, url, fingerprint):
+        return self._check(self.pages, fingerprint, url)
+
+    def fields(self, url, digest):
+        return self._check(self.profiles, digest, url)
+
+    def _check(self, seen, key, url):
+        owner = seen.get(key)
+        if owner is None:
+            seen[key] = url
+            return None
+        if owner == url:
+            self.stats['unchanged'] += 1
+        else:
+            self.aliases[url] = owner
+            self.stats['aliases'] += 1
+        return owner
+
+
+''' Tools for Parsing HTML Objects '''
+
+
+class Capture(object):
+    '''An element picked out by a FieldSpec: its attributes, its text (the
+       same as BeautifulSoup's Tag.text), the first tag inside it when the rule
+       asked for it, and the elements matched by rules scoped to it.'''
+    __slots__ = ('field', 'attrs', 'text', 'first', 'fields', '_strings')
+
+    def __init__(self, field, attrs):
+        self.field = field
+        self.attrs = attrs
+        self.text = u''
+        self.first = None
+        self.fields = {}
+        self._strings = []
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def fetch(self, field):
+        '''Elements matched for field inside this one, in document order'''
+        return self.fields.get(field, [])
+
+
+class FieldSpec(object):
+    '''A declarative list of fields to pull out of a page, compiled once.
+       Each rule is (field, tags, attribute, pattern[, scope[, first]]): an
+       element matches when its tag is one of tags and pattern (a regex string
+       or compiled pattern) is found in the given attribute.  With a scope the
+       rule only matches inside an element matched by the scope field; with
+       first set the match also records the first tag nested in it.'''
+    def __init__(self, rules):
+        self.rules = {}
+        self.scopes = set()
+        for rule in rules:
+            field, tags, attr, pattern = rule[:4]
+            scope = len(rule) > 4 and rule[4] or None
+            first = len(rule) > 5 and rule[5] or False
+            if isinstance(pattern, basestring):
+                pattern = re.compile(pattern)
+            for tag in tags:
+                self.rules.setdefault(tag, []).append((field, attr, pattern, scope, first))
+            if scope:
+                self.scopes.add(scope)
 
+    def extract(self, doc):
+        '''Run the spec over doc and return the document as a Capture'''
+        from crawl_parse import FieldExtractor
+        parser = FieldExtractor(self)
+        parser.feed_document(doc)
+        return parser.root
@@ -63,16 +63,29 @@ __date__  = '$Date: 2011-06-28 20:16:34 $'
 # Import most of the libraries we need for crawling & parsing
 # Primarily we rely on urllib2 and BeautifulSoup for this.
 from crawl_utils import *          
+from BeautifulSoup import MinimalSoup, SoupStrainer
+from crawl_store import CrawlCheckpoint, CHECKPOINT_FILE, RecrawlSchedule, SCHEDULE_FILE, content_digest, PageArchive
+from crawl_sink import DbSink, BulkLoader, CsvSink, JsonlSink, connect_db
+from crawl_records import Venue, MEALS, FEATURES
+from crawl_metrics import METRICS, Reporter
 from datetime import *
 from csv import *
-import optparse, re, sys, codecs, types
+import re, sys, codecs, types, threading, collections, Queue, itertools
+import time  # the module, not the datetime.time star-imported above
 
 BASE_URL = "http://www.menupages.com/"
 USER_AGENT = "menupages_crawl/1.0 +http://www.realoptimal.com/"
+VERBOSE = True  # per-page progress output (see log); --quiet turns it off
 
 ''' 
 	-------------------------random helper functions ---------------------------------------- 
 '''
+def log(msg):
+	''' Print per-page progress, unless VERBOSE is off, in which case msg isn't even formatted '''
+	if VERBOSE:
+		print(msg)
+
+
 def objinfo(object, spacing=10, collapse=1):
 	"""Print methods and doc strings. Similar to __dict__ if object has this attribute
 	Takes module, class, list, dictionary, or string.  
@@ -128,14 +141,295 @@ def flatten_r(d):
 	
 	
 def list_uniques(olist):
-	''' return a list with just unique elements non destructively '''
-	import copy
-	lst = copy.deepcopy(olist)
-	for l in lst:
-		while(lst.count(l) > 1): 
-			lst.remove(l)
-	return lst	
+	''' return a list with just unique elements non destructively (first occurrence wins) '''
+	seen = set()
+	return [l for l in olist if not (l in seen or seen.add(l))]
+
+
+
+''' 
+	--------------------Venue Profile Field Spec -------------------------------------------- 
+'''
+# Known structure of mp restaurant pages: where each piece of a profile lives,
+# plus the /restaurant(s)/ links we follow.  Compiled once here and run as a
+# single pass over each page, so profile and links come out of one tokenization.
+LINK_RULE = ('links', ['a'], 'href', '/?restaurants?/')
+LINK_SPEC = FieldSpec([LINK_RULE])
+
+PROFILE_TAGS = ['meta', 'li', 'span', 'tr', 'div']
+RATING_TAGS = PROFILE_TAGS + ['table', 'th']  # a few more tags needed for combing the structure; exclude "td"
+REVIEW_TAGS = ['p', 'li', 'cite', 'h6', 'span']  # Review items are nested in these tags
+
+REVIEW_RULES = [
+	('reviews',			REVIEW_TAGS,	'class',	'comment.\w*'),
+	('reviewer',		REVIEW_TAGS,	'class',	'reviewer',					'reviews'),
+	('dtreviewed',		REVIEW_TAGS,	'class',	'dtreviewed',				'reviews'),
+	('summary',			REVIEW_TAGS,	'class',	'summary',					'reviews'),
+	('comment',			REVIEW_TAGS,	'class',	'description',				'reviews'),
+	]
+
+PROFILE_SPEC = FieldSpec([
+	# field				tags			attribute	pattern						scope		first tag
+	('restaurant',		PROFILE_TAGS,	'name',		re.compile('restaurant', re.I)),
+	('street address',	PROFILE_TAGS,	'class',	'street.address'),
+	('city',			PROFILE_TAGS,	'name',		'city'),
+	('zip-code',		PROFILE_TAGS,	'class',	'postal.code'),
+	('area',			PROFILE_TAGS,	'name',		'area'),
+	('neighborhood',	PROFILE_TAGS,	'name',		'neighborhood'),
+	('cuisine',			PROFILE_TAGS,	'name',		'cuisine'),
+	('meals',			PROFILE_TAGS,	'name',		'meal'),
+	('features',		PROFILE_TAGS,	'name',		'feature'),
+	('ratings',			PROFILE_TAGS,	'id',		'restaurant.ratings'),
+	('count',			RATING_TAGS,	'class',	'count',					'ratings'),
+	('average',			RATING_TAGS,	'class',	'average',					'ratings'),
+	('food',			RATING_TAGS,	'class',	'food.rating',				'ratings',	True),
+	('value',			RATING_TAGS,	'class',	'value.rating',				'ratings',	True),
+	('service',			RATING_TAGS,	'class',	'service.rating',			'ratings',	True),
+	('atmosphere',		RATING_TAGS,	'class',	'atmosphere.rating',		'ratings',	True),
+	] + REVIEW_RULES + [
+	LINK_RULE,
+	])
+
+# The rest of a venue's reviews are served a page at a time from links like
+# /restaurants/<venue>/reviews/?page=2 (see ReviewPager)
+REVIEW_SPEC = FieldSpec(REVIEW_RULES + [LINK_RULE])
+REVIEW_PAGE_RE = re.compile(r'/reviews?/?\?(?:[^#]*&)?page=(\d+)')
+
+
+def parse_profile(doc, url, page=None):
+	''' Checks if doc (html data) is for a venue and gathers the relevant info.
+		Returns the venue name ('' if it isn't one worth keeping) and its profile
+		dict (None for a non-restaurant page).  Pass page to reuse a document
+		already run through PROFILE_SPEC. '''
+	if page is None:
+		page = PROFILE_SPEC.extract(doc)
+	
+	''' Cheating for now: using known structure of restaurant pages to pull out relevant info '''
+	venue_tag = page.fetch('restaurant')
+	
+	try:
+		assert venue_tag, "No Tag Reference Found"
+		venue_txt = venue_tag[0]['content'].rsplit('-')[0]
+
+	except Exception, e:
+		log("Unretrievable Info Or Non-Restaurant Page")
+		log("Non-Exit Failure: " + str(e)) # DEBUG statement
+		return '', None
+	
+	profile = dict.fromkeys([
+									'name', 'street address', 'city', 
+									'zip-code', 'area', 'neighborhood', 
+									'cuisine', 'meals', 'features',
+									'ratings', 'reviews'])
+	
+	profile['mp_url'] = url
+	profile['name'] = venue_txt
+	profile['street address'] = page.fetch('street address')[0].text
+	profile['city'] = page.fetch('city')[0]['content']
+	profile['zip-code'] = page.fetch('zip-code')[0].text
+	profile['area'] = page.fetch('area')[0]['content']
+	profile['neighborhood'] = page.fetch('neighborhood')[0]['content']
+	profile['cuisine'] = page.fetch('cuisine')[0]['content']
+	# in the order a kept Venue record gives them back, so every output agrees (see Vocabulary)
+	profile['meals'] = MEALS.normalize([tag['content'] for tag in page.fetch('meals')])
+	profile['features'] = FEATURES.normalize([tag['content'] for tag in page.fetch('features')])
+	
+	ratings_tag = page.fetch('ratings')
+	
+	# If there are no ratings (or reviews) then we should dismiss this profile
+	if not ratings_tag:
+		venue_txt = ''
+		return venue_txt, profile
+	
+	ratings_dct = { 
+		'count' : 0, 'average' : 0.0, 
+		'food' : 0.0, 'value' : 0.0, 
+		'service' : 0.0, 'atmosphere' : 0.0
+		}
+	
+	itm_fetch = ratings_tag[0].fetch
+	ratings_dct['count'] = int(itm_fetch('count')[0].text)
+	if ratings_dct['count']:  # if there are no ratings, other values will be non-existent
+		ratings_dct['average'] = float(itm_fetch('average')[0].text)
+		for k in ('food', 'value', 'service', 'atmosphere'):
+			ratings_dct[k] = float(itm_fetch(k)[0].first.text)
+	
+	profile['ratings'] = ratings_dct
+	# Just the reviews listed on this page (ReviewPager fetches the rest)
+	profile['reviews'] = parse_reviews(page)
+	
+	log(profile)			# DEBUG statement
+	
+	return venue_txt, profile
+
+
+def parse_reviews(page):
+	''' The reviews in a document run through PROFILE_SPEC or REVIEW_SPEC, newest first '''
+	reviews = []
+	for tag in page.fetch('reviews'):
+		reviews_dct = {
+			'reviewer' : '', 'dtreviewed' : '',
+			'summary' : '', 'comment' : ''
+			}
+		reviews_dct['reviewer'] = tag.fetch('reviewer')[0].text
+		_dt_str = tag.fetch('dtreviewed')[0].text
+		if _dt_str != '':
+			_dt_mdy = map(int, _dt_str.encode().split('/'))
+			reviews_dct['dtreviewed'] = date(_dt_mdy[2], _dt_mdy[0], _dt_mdy[1]).isoformat()
+		reviews_dct['summary'] = tag.fetch('summary')[0].text
+		reviews_dct['comment'] = tag.fetch('comment')[0].text
+		reviews.append(reviews_dct)
+	return reviews
+
+
+def find_restaurant_links(doc, page=None):
+	''' Parse out the unique relative links containing the term restaurant or restaurants.
+		Pass page to reuse a document already run through PROFILE_SPEC. '''
+	## BUG / ISSUE: Links on restaurant pages may be loaded by an AJAX process
+	## ------------ May be possible to recreate pythonically using spidermonkey
+	if page is None:
+		page = LINK_SPEC.extract(doc)
+	return list_uniques([tag['href'] for tag in page.fetch('links')])
+
+
+def process_page(doc, url):
+	''' Tokenize doc once and return (venue name, profile, links) as
+		parse_profile and find_restaurant_links would. '''
+	page = PROFILE_SPEC.extract(doc)
+	venue_txt, profile = parse_profile(doc, url, page)
+	return venue_txt, profile, find_restaurant_links(doc, page)
+
+
+def parse_page(url, doc, want_profile=True):
+	''' The parse stage of a crawl, run in a worker process when crawling with
+		parsers: returns (url, (venue name, profile, links), error). '''
+	try:
+		if want_profile:
+			return url, process_page(doc, url), None
+		return url, ('', None, find_restaurant_links(doc)), None
+	except Exception, e:
+		return url, None, e
+
 
+def timed_parse_page(url, doc, want_profile=True):
+	''' parse_page, plus the seconds it took (parser processes can't record to METRICS) '''
+	start = time.time()
+	return parse_page(url, doc, want_profile) + (time.time() - start,)
+
+
+def _reparse_page(page):
+	''' timed_parse_page for a (url, body) pair out of a PageArchive '''
+	return timed_parse_page(page[0], page[1])
+
+
+def _parsed(events):
+	''' multiprocessing callback: record the parse time and queue up the result '''
+	def callback(r):
+		METRICS.observe('parse', r[3])
+		events.put(('parse',) + r[:3])
+	return callback
+
+
+class ReviewPager(object):
+	'''	Fetches the review pages after the first for a venue and merges their
+		reviews into its profile.  Pages go out `per_venue` at a time on a fetch
+		pool of their own, up to `max_pages` pages per venue; links to further
+		pages are picked up from each page as it comes in.  Reviews run newest
+		first, so paging stops at the first page reaching back past `since` (an
+		ISO date, normally the newest review kept from the last crawl).
+		submit() pages a venue in the pager's own thread, one venue at a time,
+		so the crawl can get on with other pages meanwhile.
+	'''
+	def __init__(self, per_venue=3, max_pages=20, host_limit=2, delay=0.0, cache=None, limiter=None, retry=None):
+		self.results = Queue.Queue()
+		# its fetch threads start with the first venue, after the crawl has forked its parsers
+		self.pool = None
+		self.pool_args = ((per_venue, host_limit, delay),
+						  {'results': self.results, 'limiter': limiter, 'retry': retry, 'cache': cache})
+		self.max_pages = max_pages
+		self.fetched = 0
+		self.todo = Queue.Queue()
+		self.thread = None
+	
+	def page_links(self, links):
+		''' {page number: url} for the review page links among links '''
+		pages = {}
+		for link in links:
+			m = REVIEW_PAGE_RE.search(link)
+			if m:
+				pages[int(m.group(1))] = normalize_url(urlparse.urljoin(BASE_URL, link.lstrip('/')))
+		return pages
+	
+	def complete(self, profile, links, since=''):
+		'''	Add the reviews from the venue's other review pages to profile, given
+			the links on its first page, and return the number of pages fetched. '''
+		if self.pool is None:
+			self.pool = FetchPool(*self.pool_args[0], **self.pool_args[1])
+		known = self.page_links(links)
+		seen = set([(rv['reviewer'], rv['dtreviewed'], rv['summary']) for rv in profile['reviews']])
+		done = set([1])
+		fetched = 0
+		while fetched < self.max_pages:
+			wave = sorted([p for p in known if p not in done])[:min(self.pool.size(), self.max_pages - fetched)]
+			if not wave:
+				break
+			urls = dict([(known[p], p) for p in wave])
+			for url in urls:
+				self.pool.submit(url)
+			pages = {}
+			for i in xrange(len(urls)):
+				stage, url, result, err = self.results.get()
+				pages[urls[url]] = (err is None and result.get('status') in (200, 304)) and result or None
+			done.update(wave)
+			fetched += len(wave)
+			# merge in page order, so the reviews stay newest first
+			stop = False
+			for p in wave:
+				if pages[p] is None:
+					stop = True  # can't tell what's past a page we couldn't get
+					break
+				doc = REVIEW_SPEC.extract(pages[p]['data'])
+				for rv in parse_reviews(doc):
+					if since and rv['dtreviewed'] and rv['dtreviewed'] < since:
+						stop = True  # past the cutoff; those from its own day may be new, and are kept
+						continue
+					key = (rv['reviewer'], rv['dtreviewed'], rv['summary'])
+					if key not in seen:
+						seen.add(key)
+						profile['reviews'].append(rv)
+				known.update(self.page_links(find_restaurant_links(None, doc)))
+			if stop:
+				break
+		self.fetched += fetched
+		return fetched
+	
+	def submit(self, url, profile, links, since, done):
+		'''	complete() the venue at url in the pager's thread, then call
+			done(url, profile, links, error) from there. '''
+		if self.thread is None:
+			self.thread = threading.Thread(target=self.__run)
+			self.thread.daemon = True
+			self.thread.start()
+		self.todo.put((url, profile, links, since, done))
+	
+	def __run(self):
+		while True:
+			job = self.todo.get()
+			if job is None:
+				return
+			url, profile, links, since, done = job
+			try:
+				self.complete(profile, links, since)
+				done(url, profile, links, None)
+			except Exception, e:
+				done(url, profile, links, e)
+	
+	def close(self):
+		if self.thread is not None:
+			self.todo.put(None)
+			self.thread.join()
+		if self.pool is not None:
+			self.pool.close()
 
 
 ''' 
@@ -145,13 +439,29 @@ def list_uniques(olist):
 class MpCrawler(MinimalSoup):
 	'''	Encapsulate most of the BS features we need to gather mp listings and reviews. '''
 	link_queue = {}  # key, value store of links; k = url, v = filter-type {by-name, by-area, by-cusine, by-feature}
-	restaurants = {} # key, value store of restaurant profiles with k = url, v is the list of attributes
-	crawled = []	  # list of links that have been crawled already
+	restaurants = {} # key, value store of restaurant profiles with k = url, v is a Venue record
+	crawled = set()  # set of links that have been crawled already
 	
-	def __init__(self, doc, parseOnlyThese=None):
-		self.link_queue = {}
+	def __init__(self, doc, parseOnlyThese=None, seen_capacity=None):
+		''' seen_capacity: track crawled links in a BloomFilter sized for this many
+			urls instead of an exact set (for very large runs) '''
+		self.link_queue = Frontier(priority=LinkClassifier.TAGS)
+		self.classifier = LinkClassifier() # tags each link by-name/by-area/by-cuisine/by-feature
+		self.link_yield = {} # tag -> (pages fetched, new venue links they brought), to rank the categories
 		self.restaurants = {}
-		self.crawled = []
+		self.crawled = seen_capacity and BloomFilter(seen_capacity) or set()
+		self._lock = threading.RLock() # guards the three stores above during a concurrent crawl
+		self.cache = None # optional HttpCache for conditional recrawls
+		self.fetch = fetch_page # what the fetch workers call for each page (crawl_bench records through it)
+		self.max_page_bytes = None # pages that decode to more than this are dropped (PageTooLarge)
+		self.checkpoint = None # optional CrawlCheckpoint to resume from after a crash
+		self.archive = None # optional PageArchive every fetched body is saved to, for reparse
+		self.sinks = [] # DbSink/CsvSink/JsonlSinks profiles are streamed into as they are scraped
+		self.keep_profiles = True # False leaves profiles to the sinks instead of self.restaurants
+		self.pager = None # optional ReviewPager to pull in reviews past a venue's first page
+		self.schedule = None # optional RecrawlSchedule recording what changed on each page
+		self.dedupe = ContentFingerprints() # spots pages and profiles we already have; None to parse everything
+		self.shard = None # ShardLink when this crawler is one shard of a sharded crawl (see crawl_shard)
 		MinimalSoup.__init__(self, doc, parseOnlyThese)
 
 	
@@ -159,432 +469,686 @@ class MpCrawler(MinimalSoup):
 		print(self.prettify())
 
 
-	def output_db(self):
-		import MySQLdb
-
-		conn = MySQLdb.connect(
-			host='localhost',
-			user='crawler',
-			db='menupages')
-	
-		cursor = conn.cursor()
-		data = list(self.restaurants.values())
-					
-		venue_tbl_sql = "INSERT INTO venue (name, url, street_addr, " \
-					+ "city, zip_code, area, neighborhood) " \
-					+ "VALUES (%(name)s, %(mp_url)s, %(street address)s, " \
-					+ "%(city)s, %(zip-code)s, %(area)s, %(neighborhood)s);"
-		
-		cursor.executemany(venue_tbl_sql, data)
-		
-		detail_tbl_sql = "INSERT INTO detail (name, cuisine, meals, features) " \
-					+ "VALUES (%(name)s, %(cuisine)s, %(meals)s, %(features)s);"
-
-		detail_data = [{'name' : r['name']} for r in data]
-
-		c = [{'cuisine' : r['cuisine']} for r in data]
-		m = [r['meals'] for r in data]
-		f = [r['features'] for r in data]
-		
-		# Combine values for features and meals into a flat record per venue
-		
-		# The 'detail' table uses the SET column type for meals and for features
-		# Basically, the set of values that are contained in the meals list is
-		# binary encoded so that that the binary value in the table is the sum
-		# of values that are contained in a venue's meals or features lists.
-		
-		_details_dct = { 'cuisine' : "NULL", 'meals' : "NULL", 'features' : "NULL"} 
-		update_details = lambda x, y: x.update(y) if isinstance(y, dict) else x.update(_details_dct)
-		
-		map(update_details, detail_data, c) # detail_data now has cuisine for each venue
-		
-		# gather up the list of features that we'll turn in to 'detail' table fields		
-		flat_ftrs = []
-		for ent in f:
-			for itm in ent:
-				flat_ftrs.append(itm)
-				
-		# only want uniques from the list; this is the total set of known features across restaurants
-		uniq_ftrs = list_uniques(flat_ftrs)
-		uniq_ftrs = [s.encode('utf-8') for s in uniq_ftrs] # convert from unicode to utf-8
-		uniq_ftrs.sort() # sort in alphabetical asc. order
-		
-		# now let's add them to the table if they are not already there.
-		modify_tbl_sql = "ALTER TABLE detail MODIFY features SET ('" + "','".join(uniq_ftrs) + "');"
-		cursor.execute(modify_tbl_sql)
-		
-		# create the the string of meals and string of features to pass into the sql
-		# note: there should be no space between comma seperated elements in a set when referenced
-		# a sql INSERT or UPDATE statement.
-		
-		meals_sqlsubstr = lambda i: ','.join([mval.encode('utf-8') for mval in m[i]])
-		meals_sqlstr = map(meals_sqlsubstr, range(0, len(m)))
-		meals_data = [{'meals' : s} for s in meals_sqlstr]
-		map(update_details, detail_data, meals_data) # detail_data now has meals for each venue
-		
-
-		ftrs_sqlsubstr = lambda i: ','.join([fval.encode('utf-8') for fval in f[i]])
-		ftrs_sqlstr = map(ftrs_sqlsubstr, range(0, len(f)))
-		ftrs_data = [{'features' : s} for s in ftrs_sqlstr]
-		map(update_details, detail_data, ftrs_data) # detail_data now has meals for each venue
-		
-		# now write the table
-		cursor.executemany(detail_tbl_sql, detail_data)
-		
-		# Now write restaurant ratings to the 'rating' table
-		p = [{'name' : r['name']} for r in data]
-		q = [r['ratings'] for r in data]
-		
-		# Combine these into a flat dictionary
-		# Update with an empty dictionary rather than None as a place-holder
-		_ratings_dct = { 
-			'count' : 0, 'average' : 0.0, 
-			'food' : 0.0, 'value' : 0.0, 
-			'service' : 0.0, 'atmosphere' : 0.0
-			}
-		update_ratings = lambda x,y: x.update(y) if isinstance(y, dict) else x.update(_ratings_dct)
-		map(update_ratings, p, q)  
-		# Note: the result is actually in p
-		rating_data = p
-		
-		rating_tbl_sql = "INSERT INTO rating (name, count, average, " \
-					+ "food, value, service, atmosphere) " \
-					+ "VALUES (%(name)s, %(count)s, %(average)s, " \
-					+ "%(food)s, %(value)s, %(service)s, " \
-					+ "%(atmosphere)s);"
-		
-		cursor.executemany(rating_tbl_sql, rating_data)
-		
-		
-		w = [{'name' : r['name']} for r in data]
-		v = [r['reviews'] for r in data]
-		add_name_to_reviews = lambda i,j: v[i][j].update(w[i])
-		
-		for i in range(0, len(w)):
-			if v[i]:				
-				for j in range(0, len(v[i])):
-					add_name_to_reviews(i, j)
-				review_data = v[i]
-				review_tbl_sql = "INSERT INTO reviews (name, reviewer, dtreviewed, " \
-							+ "summary, comment) " \
-							+ "VALUES (%(name)s, %(reviewer)s, %(dtreviewed)s, " \
-							+ "%(summary)s, %(comment)s);"
-				cursor.executemany(review_tbl_sql, review_data)		
-		
-		# Finalize Everything By Halting the cursor and closing the connection.
-		cursor.close()
-		conn.close()
-		
-		
-		
-	def output_csv(self, fname, header_row=True):
+	def output_db(self, conn=None, reload=False):
+		''' Upsert every restaurant profile into the menupages db (see DbSink), or
+			with reload, replace what the tables hold with them (see BulkLoader) '''
+		own_conn = conn is None
+		if own_conn:
+			conn = connect_db(local_infile=reload)
+		sink = reload and BulkLoader(conn) or DbSink(conn)
+		for profile in self.restaurants.itervalues():
+			sink.add(profile)
+		sink.close()
+		if own_conn:
+			conn.close()
+		
+		
+	def output_csv(self, fname, header_row=True, compress=False):
 		''' 
-			Flatten all restaurant entity attributes and in the restaurants array
-			and write them to a csv file named by the string var: fname .
+			Write all restaurant profiles to fname.csv (and their reviews to
+			fname_reviews.csv), one row per venue under a fixed header (see CsvSink).
 		'''
-		flatten_func = lambda (x): flatten_dict(flatten_r(x))
-		
-		rsts = self.restaurants.values()  # all our attributes are in the dictionary
-		rsts_flat = map(flatten_func, rsts)
-		
-		fp = open(fname + '.csv', 'w')
-		flds = []
-		for rst in rsts_flat:
-			flds.extend(rst.keys())
-			
-		flds = list_uniques(flds)
-		csv_writer = DictWriter(fp, flds)
-		
-		if header_row:
-			headers = dict([(n,n) for n in flds])
-			csv_writer.writerow(headers)
-	
-		csv_writer.writerows(rsts_flat)
-		fp.close()
+		sink = CsvSink(fname, header_row=header_row, compress=compress)
+		for profile in self.restaurants.itervalues():
+			sink.add(profile)
+		sink.close()
 		print('done writing csv files') # DEBUG statement
 	
 
-			
-	def scrape_profile(self, doc, url):
-		''' Checks if doc (html data) is for a venue, gathers and saves relevant info.  '''
-		pparser = BeautifulSoup(doc)
-		info_tags = ['meta', 'li', 'span', 'tr', 'div']
-		
-		''' Cheating for now: using known structure of restaurant pages to pull out relevant info '''
-		venue_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('restaurant', 2)})
-		
-		try:
-			assert venue_tag, "No Tag Reference Found"
-			venue_txt = venue_tag[0]['content'].rsplit('-')[0]
+	def output_jsonl(self, fname, compress=False):
+		''' Write all restaurant profiles to fname, one JSON object per line '''
+		sink = JsonlSink(fname, compress)
+		for profile in self.restaurants.itervalues():
+			sink.add(profile)
+		sink.close()
 
-		except Exception, e:
-			print("Unretrievable Info Or Non-Restaurant Page")
-			print("Non-Exit Failure: " + str(e)) # DEBUG statement
-			return ''
-		
 
-		self.restaurants[url] = dict.fromkeys([
-										'name', 'street address', 'city', 
-										'zip-code', 'area', 'neighborhood', 
-										'cuisine', 'meals', 'features',
-										'ratings', 'reviews'])
-		
-		self.restaurants[url]['mp_url'] = url
-		self.restaurants[url]['name'] = venue_txt
-		
-		street_tag = pparser.fetch(info_tags, attrs = {'class' : re.compile('street.address')})
-		self.restaurants[url]['street address'] = street_tag[0].text
-		
-		city_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('city')})
-		self.restaurants[url]['city'] = city_tag[0]['content']
-		
-		postal_tag = pparser.fetch(info_tags, attrs = {'class' : re.compile('postal.code')})
-		self.restaurants[url]['zip-code'] = postal_tag[0].text
-		
-		area_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('area')})
-		self.restaurants[url]['area'] = area_tag[0]['content']
-		
-		hood_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('neighborhood')})
-		self.restaurants[url]['neighborhood'] = hood_tag[0]['content']
-		
-		cuisine_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('cuisine')})
-		self.restaurants[url]['cuisine'] = cuisine_tag[0]['content']
-		
-		meals_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('meal')})
-		self.restaurants[url]['meals'] = map(lambda(x): x['content'], meals_tag)
-
-		features_tag = pparser.fetch(info_tags, attrs = {'name' : re.compile('feature')})
-		self.restaurants[url]['features'] = map(lambda(x): x['content'], features_tag)
-		
-		ratings_tag = pparser.fetch(info_tags, attrs = {'id' : re.compile('restaurant.ratings')})
-		
-		# If there are no ratings (or reviews) then we should dismiss this profile
-		if not ratings_tag:
-			venue_txt = ''
-			return venue_txt
-			
-		# Store ratings items in a dictionary (not the most efficient for memory but simpler code)
-		ratings_dct = { 
-			'count' : 0, 'average' : 0.0, 
-			'food' : 0.0, 'value' : 0.0, 
-			'service' : 0.0, 'atmosphere' : 0.0
-			}
-			
-		# Descend the tag structure to gather the necessary data items to put into dictionary
-		info_tags.append('table') # a few more tags needed for combing the structure; exclude "td"
-		info_tags.append('th')
-		
-		itm_fetch = lambda(s): ratings_tag[0].fetch(info_tags, attrs = {'class' : re.compile(s)})
-		# Slightly different treatment depending on where each element resides in the table structure
-		''' 
-		##  In the future a few helper functions to traverse the tag structure and "find" relevant elements
-		##  would allow this to be more generic; relying on known structure of mp's restaurant profile html
-		##  for now.  There's no reason that these items need to be hardcoded -- but would require
-		##  a lexical ontology from which parsing can take place.
-		'''
-		
-		ratings_dct['count'] = int(itm_fetch('count')[0].text)
-		if ratings_dct['count']:  # if there are no ratings, other values will be non-existent
-			ratings_dct['average'] = float(itm_fetch('average')[0].text)
-			ratings_dct['food'] = float(itm_fetch('food.rating')[0].first().text)
-			ratings_dct['value'] = float(itm_fetch('value.rating')[0].first().text)
-			ratings_dct['service'] = float(itm_fetch('service.rating')[0].first().text)
-			ratings_dct['atmosphere'] = float(itm_fetch('atmosphere.rating')[0].first().text)
-		
-		# Assign it to the ratings key
-		self.restaurants[url]['ratings'] = ratings_dct
-		
-		
-		info_tags = ['p', 'li', 'cite', 'h6', 'span']  # Review items are nested in these tags
-		reviews_tag = pparser.fetch(info_tags, attrs = {'class' : re.compile('comment.\w*')})
-		
-		self.restaurants[url]['reviews'] = []
-		
-		select_itm = lambda s,m: m.fetch(info_tags, attrs = {'class' : re.compile(s)})
-		# Just the reviews listed on this page -- to get all the reviews we'd have to make AJAX calls to
-		# paginate through and pull in the ones on other pages for this restaurant
-		for tag in reviews_tag:
-			# Store reviews in a dictionary too
-			reviews_dct = {
-				'reviewer' : '', 'dtreviewed' : '',
-				'summary' : '', 'comment' : ''
-				}
-			reviews_dct['reviewer'] = select_itm('reviewer', tag)[0].text
-			_dt_str = select_itm('dtreviewed', tag)[0].text
-			if _dt_str != '':
-				_dt_mdy = map(int, _dt_str.encode().split('/'))
-				reviews_dct['dtreviewed'] = date(_dt_mdy[2], _dt_mdy[0], _dt_mdy[1]).isoformat()
-			reviews_dct['summary'] = select_itm('summary', tag)[0].text
-			reviews_dct['comment'] = select_itm('description', tag)[0].text
-			
-			# Finally -- append it to the list of reviews for this url
-			self.restaurants[url]['reviews'].append(reviews_dct)
-		
-		print(self.restaurants[url])			# DEBUG statement
-		
+	def scrape_profile(self, doc, url):
+		''' Checks if doc (html data) is for a venue, gathers and saves relevant info.  '''
+		venue_txt, profile = parse_profile(doc, url)
+		if profile is not None:
+			self.restaurants[url] = Venue.from_dict(profile)
 		return venue_txt
 		
 		
-	def scan_restaurant_links(self, doc=''):
-		''' Parse Out relative links containing the term restaurant or restaurants '''
-		linkfilt = SoupStrainer('a', href = re.compile('/?restaurants?/'))
-		linktags = []
-		if doc != '':
+	def scan_restaurant_links(self, doc='', links=None):
+		''' Parse Out relative links containing the term restaurant or restaurants
+			and queue them; pass links to queue ones already parsed out elsewhere. '''
+		if links is not None:
+			pass
+		elif doc != '':
 			#print("Scanning Link Tags off Related")   # DEBUG statement
-			## BUG / ISSUE: Links on restaurant pages may be loaded by an AJAX process
-			## ------------ May be possible to recreate pythonically using spidermonkey
-			linktags = [tag for tag in BeautifulSoup(doc, parseOnlyThese=linkfilt)]
+			links = find_restaurant_links(doc)
 		else:
-			linktags = self.findAll(linkfilt)
-		# We only care about the urls themselves
-		links =  list_uniques([tag['href'] for tag in linktags])  # filter a unique list
+			linkfilt = SoupStrainer('a', href = re.compile('/?restaurants?/'))
+			# We only care about the urls themselves
+			links =  list_uniques([tag['href'] for tag in self.findAll(linkfilt)])  # filter a unique list
 		if links:
-			print("Trying to add %d restaurant links to queue." % len(links))
+			log("Trying to add %d restaurant links to queue." % len(links))
 			
-			num_urls = self.__update_link_queue(links)
-			print("\tadded %d successfully" % num_urls)
+			with METRICS.timer('link_queue'):
+				num_urls = self.__update_link_queue(links)
+			log("\tadded %d successfully" % num_urls)
 
 		else:
-			print("No Restaurant Links To Add")
+			log("No Restaurant Links To Add")
 			
 
 	## INTERNAL: __update_link_queue(self, urls)
 		
 	def __update_link_queue(self, urls):
-		# import nltk # need for [future dev]
-		
-		''' filter out non-relevant links and add links if they were not already visited '''
-		full_urls = map(lambda (x): urlparse.urljoin(BASE_URL, x.lstrip('/')), urls)
+		''' Queue the links we haven't visited yet, each under the kind of page
+			self.classifier takes it for: venues (by-name) or the area, cuisine
+			and feature listings that lead to them (see crawl for the order
+			they are fetched in).  Review pages are left to the ReviewPager. '''
+		full_urls = map(lambda (x): normalize_url(urlparse.urljoin(BASE_URL, x.lstrip('/'))), urls)
 		
 		# filter out the ones we've been to before
 		in_crawled = lambda(x): x in self.crawled
-		full_urls = [url for url in full_urls if not in_crawled(url)]		
+		full_urls = [url for url in full_urls if not in_crawled(url) and not REVIEW_PAGE_RE.search(url)]
+		if self.shard is not None:
+			full_urls = self.shard.route(full_urls)  # links other shards own are sent on to them
 		
 		if not full_urls:
-			print ("Links to Add Already Crawled")
+			log("Links to Add Already Crawled")
 			return 0
-			
-		''' OPTION 1 '''		
-		
-		# Break up the urls again into components recognized by urlparse
-		urlparse_objs = map(urlparse.urlparse, full_urls)				
-	
-				
-		'''		 
-		##	Ignore the scheme & netloc: scheme+netloc = BASE_URL
-		##	If others are blank for all urls in the list we ignore those too.
-		##
-		##	------------------ Highlighted Feature ----------------------------
-		##	While this is written generically, we know for menupages.com that 
-		##	the params, query and fragment pieces will be blank, all navigation
-		##	info is encoded by the url path, but let's pretend we didn't know
-		##	that a priori as this could potentially change in the future.
-		'''
-		
-		upo_paths = [url.path for url in urlparse_objs]	
-
-		# Let's examine the last piece of the path since we know that the other items
-		# after the path are empty (all info is in the path) the shortest paths
-		# that are unique are the most likely venue pages.  At the end of longer
-		# paths they are higher level categorizations.  We can figure out what
-		# to do with those later.
-		upo_path_wrds = map(lambda (x): x.strip('/').split('/'), upo_paths)
-		plen_min = min(map(len, upo_path_wrds))
-		upo_venue_wrds = [wrd[len(wrd)-1] for wrd in upo_path_wrds if len(wrd) == plen_min]
-		upo_venue_wrds = list_uniques(upo_venue_wrds)
-		
-		is_venue = lambda(wlst): wlst[len(wlst)-1] in upo_venue_wrds
-		venue_path_idxs = [upo_path_wrds.index(wset) for wset in upo_path_wrds if is_venue(wset)] 
-		venue_paths = map(lambda(i): upo_paths[i], venue_path_idxs)
 		
-		# Reconstruct the full path urls to push onto the queue
-		full_urls = map(lambda (x): urlparse.urljoin(BASE_URL, x.lstrip('/')), venue_paths)
+		# all navigation info is encoded in the url path, and the words in it say
+		# whether a page is a venue (a name) or a category bucket (see LinkClassifier)
+		by_tag = collections.OrderedDict()
+		for url in full_urls:
+			if url not in self.link_queue:
+				by_tag.setdefault(self.classifier.classify(url), []).append(url)
 		
-		''' ---------------------- OPTION 2 [FUTURE DEV] ---------------------------- 	
-		##	Let's look at path structure and use a bit of nltk magic to 
-		##	help us organize and select relevant links!
-		'''
-		
-		# Let's bust everything up into words that we can hopefully use to determine 
-		# pages to look at based on uniqueness.  The concept being that our 
-		# categorization is organized by words in the url and restauarants are
-		# usually names which are somewhat unique. i.e. build a word count or 
-		# word freqz (occurrence and/or co-occurence) distribution and only crawl
-		# urls containing lowest freq words or bigrams.  Higher freq words or bigrams
-		# are likely to be category buckets -- figure out what to do with them later.
-		
-		## upo_paths = [url.path for url in urlparse_objs]	
-		
-		## Similarily we could get the list of other pieces to include:
+		self._lock.acquire()
+		try:
+			if self.schedule:
+				self.schedule.discover(full_urls)
+			added = 0
+			for tag, tagged in by_tag.items():
+				if self.checkpoint:
+					self.checkpoint.queue([u for u in tagged if u not in self.link_queue], tag)
+				added += self.link_queue.push(tagged, tag)
+			return added
+		finally:
+			self._lock.release()
+	
+	
+	def queue_plan(self, urls, venues):
+		'''	Queue a recrawl's urls (see RecrawlSchedule.plan), in order, each
+			under its kind of page: by-name for the venues, going by venues
+			({url: whether it gave a profile} for the pages fetched before), and
+			the likeliest kind of category page for the rest of those and the
+			front page.  Pages never fetched get the classifier's guess. '''
+		home = normalize_url(BASE_URL)
+		by_tag = collections.OrderedDict()
+		for url in urls:
+			if url in venues and venues[url]:
+				tag = 'by-name'
+			elif url in venues or url == home:
+				tag = self.classifier.classify(url, LinkClassifier.CATEGORIES)
+			else:
+				tag = self.classifier.classify(url)
+			by_tag.setdefault(tag, []).append(url)
+		for tag, tagged in by_tag.items():
+			if self.checkpoint:
+				self.checkpoint.queue(tagged, tag)
+			self.link_queue.push(tagged, tag)
+		
+		
+	def crawl(self, n = -1, workers = 1, host_limit = 2, delay = 0.0, parsers = 0, limiter = None, retry = None):
+		'''	Crawl the link queue as a pipeline.  Pages are fetched by a pool of
+			`workers` threads (at most `host_limit` at a time against one host,
+			spaced `delay` seconds apart, paced by an optional HostRateLimiter and
+			retried according to an optional RetryPolicy) and parsed by a pool of `parsers`
+			processes, or in this thread when parsers is 0.  This thread hands out
+			work, merges profiles and links back in, and stops handing out fetches
+			while fetched pages are still waiting for a parser.  As a shard (see
+			self.shard) it doesn't stop when it runs out of links, but waits for
+			more from the other shards until the coordinator calls it off.
 		'''
-		N.B. There is probably a more elegeant and more efficient
-			way of doing this all in one shot. THis is just easier! 
-		'''		
-		## upo_qrs   = [url.query for url in urlparse_objs]
-		## upo_prms  = [url.params for url in urlparse_objs]
-		## upo_frags = [url.fragments for url in urlparse_objs]
-		''' -------------------------------------------------------------------------- '''
-		
-		# The next line adds the urls as keys to the link_queue
-		self.link_queue.update(dict.fromkeys(full_urls, 'by-name'))
-		return len(full_urls)
-		
-		
-	def crawl(self, n = -1):
 		if n < 0:  # Loop through the whole queue if passed a negative number or default
-			n = len(self.link_queue)
 			self.CRAWL_MAX = 10000
 		else:
 			self.CRAWL_MAX = n
-			
-		htmldata = ''
-		while n and (len(self.crawled) < self.CRAWL_MAX):
-			try:
-				assert n <= len(self.link_queue), "Will Only Crawl %d Links in Queue" % len(self.link_queue)
+		
+		events = Queue.Queue()  # ('fetch' | 'parse', url, result, error) from both stages
+		# fork the parsers before the fetch threads start, so no child inherits a lock one holds
+		import multiprocessing
+		procs = parsers > 0 and multiprocessing.Pool(parsers) or None
+		pool = FetchPool(workers, host_limit, delay, fetch=self.fetch, results=events,
+						 limiter=limiter, retry=retry, cache=self.cache, max_bytes=self.max_page_bytes)
+		pending = set()  # urls anywhere in the pipeline
+		fetching = 0
+		backlog = collections.deque()  # fetched pages waiting for a parser
+		parsing = 0
+		unchanged = set()  # pages the cache says haven't changed since the last fetch
+		prints = {}  # html fingerprints of pages in the parse stage
+		if self.shard is not None:
+			self.shard.start(events)  # ('links' | 'stop', ...) from the cluster
+		
+		try:
+			while True:
+				# Keep the fetchers busy: hand out queued links that are not already out,
+				# venues first; category pages only once there are no venues left to
+				# fetch (queued or out), since all they're good for is finding more
+				self._lock.acquire()
+				try:
+					for url in self.link_queue.iterkeys():
+						if fetching >= 2 * pool.size() or backlog:
+							break
+						if len(self.crawled) + len(pending) >= self.CRAWL_MAX:
+							break
+						if self.link_queue[url] != 'by-name' and self.link_queue.count('by-name'):
+							break
+						if url not in pending:
+							if self.shard is not None and not self.shard.reserve():
+								break  # the other shards have had the rest of the cluster's budget
+							pending.add(url)
+							pool.submit(url)
+							fetching += 1
+				finally:
+					self._lock.release()
+				
+				# ... and the parsers, up to a bounded number of pages each
+				while backlog and parsing < 2 * parsers:
+					args = backlog.popleft()
+					procs.apply_async(timed_parse_page, args, callback=_parsed(events))
+					parsing += 1
 				
-				iter_q = self.link_queue.iterkeys()
-				mpp_url = iter_q.next()
-				mpp = fetch_page(mpp_url)
+				if not pending:
+					if self.shard is None:
+						break
+					self.shard.idle()
 				
-				if mpp['status'] != 200:
-					raise Exception("page fetch error: %d" % mpp['status'])
+				stage, mpp_url, result, err = events.get()
+				if stage == 'stop':
 					break
-				htmldata = mpp['data']
-								
-			except (AssertionError, Exception), e:
-				print str(e)
-				continue
-			
-			else:
-
-				venue = self.scrape_profile(htmldata, mpp_url)
-				if venue:
-					print("Restaurant: %s Info Pulled" % venue) 
-				self.scan_restaurant_links(htmldata)	
-
+				if stage == 'links':
+					self.scan_restaurant_links(links=self.shard.take(result))
+					continue
+				if stage == 'fetch':
+					fetching -= 1
+					try:
+						if err:
+							raise err
+						# a 304 is fine as long as the cache handed back the body
+						if result['status'] != 200 and not result.get('fromcache'):
+							raise Exception("page fetch error: %d" % result['status'])
+					except Exception, e:
+						log(str(e))
+						METRICS.incr('failed_pages')
+						if self.schedule:
+							self.schedule.visit(mpp_url)  # so a dead link doesn't stay top of the plan
+						pending.discard(mpp_url)
+						self.__crawled(mpp_url)
+						continue
+					if self.archive is not None and not result.get('fromcache'):
+						self.archive.add(mpp_url, result['data'])
+					if result.get('fromcache'):
+						unchanged.add(mpp_url)
+					elif self.dedupe:
+						prints[mpp_url] = html_fingerprint(result['data'])
+						owner = self.dedupe.page(mpp_url, prints[mpp_url])
+						if owner:
+							# the same page as one we've already parsed, here or under another url
+							log("Unchanged page: %s" % (owner == mpp_url and mpp_url or mpp_url + " = " + owner))
+							METRICS.incr('duplicate_pages')
+							if self.schedule:
+								self.schedule.visit(mpp_url, page_print=prints[mpp_url])
+							del prints[mpp_url]
+							pending.discard(mpp_url)
+							self.__crawled(mpp_url)
+							continue
+					# unchanged since the last crawl (a 304): its profile was stored then, so only
+					# its links are wanted
+					args = (mpp_url, result['data'], not result.get('fromcache'))
+					if procs:
+						backlog.append(args)
+						continue
+					with METRICS.timer('parse'):
+						stage, mpp_url, result, err = ('parse',) + parse_page(*args)
+				elif stage == 'parse':
+					parsing -= 1
 				
-			finally:
-				# Regardless of errors, pop the link off the queue
-				# and add it to a list of crawled links
-				qmsg = self.link_queue.pop(mpp_url,'empty')	
-				if qmsg != 'empty':
-					self.crawled.append(mpp_url)
-					print("Adding to Already Crawled: %s" % mpp_url)
-				print("Crawled %d links so far." % len(self.crawled))
-				print("Crawl Q Has %d links to go" % len(self.link_queue))
-				n = len(self.link_queue)
-					
+				profile = None
+				if err and stage != 'reviews':
+					log(str(err))
+					METRICS.incr('parse_errors')
+					if self.schedule:
+						self.schedule.visit(mpp_url)
+				else:
+					if stage == 'reviews':
+						# back from the pager; an error leaves the reviews it did get
+						if err:
+							log("Review pages: %s" % err)
+						venue, profile, links, digest = result
+						links = self.__paged(mpp_url, profile, links)
+					else:
+						venue, profile, links = result
+						if mpp_url in unchanged and self.keep_profiles and mpp_url not in self.restaurants:
+							kept = self.cache.profile(mpp_url)
+							if kept is not None:
+								self.restaurants[mpp_url] = Venue.from_dict(kept)
+						if mpp_url not in unchanged:
+							self.classifier.learn(mpp_url, profile is not None)
+							if profile is not None:
+								self.classifier.learn_profile(profile)
+						digest = mpp_url not in unchanged and content_digest(profile, links) or None
+						if profile is not None and digest and self.dedupe:
+							owner = self.dedupe.fields(mpp_url, digest)
+							if owner:
+								# nothing new to store or write out
+								log("Unchanged profile: %s" % (owner == mpp_url and mpp_url or mpp_url + " = " + owner))
+								METRICS.incr('duplicate_profiles')
+								profile = venue = None
+						if self.pager and profile is not None and profile['reviews'] is not None:
+							self.__page_reviews(mpp_url, venue, profile, links, digest, events)
+							continue  # comes back as a 'reviews' event
+					if profile is not None and self.cache is not None:
+						self.cache.put_profile(mpp_url, profile)
+					self._lock.acquire()
+					try:
+						if profile is not None:
+							METRICS.incr('profiles')
+							if self.keep_profiles:
+								self.restaurants[mpp_url] = Venue.from_dict(profile)
+							for sink in self.sinks:
+								sink.add(profile)
+						if venue:
+							log("Restaurant: %s Info Pulled" % venue)
+						venues_queued = self.link_queue.count('by-name')
+						self.scan_restaurant_links(links=links)
+						self.__rank_categories(self.link_queue.get(mpp_url),
+											   self.link_queue.count('by-name') - venues_queued)
+						if self.schedule:
+							self.schedule.visit(mpp_url, digest, profile, page_print=prints.get(mpp_url))
+					finally:
+						self._lock.release()
+				unchanged.discard(mpp_url)
+				prints.pop(mpp_url, None)
+				pending.discard(mpp_url)
+				self.__crawled(mpp_url, profile)
+		finally:
+			pool.close()
+			if procs:
+				procs.terminate()
+				procs.join()
+			if self.checkpoint:
+				self.checkpoint.flush()
+			if self.schedule:
+				self.schedule.flush()
+			if self.archive is not None:
+				self.archive.flush()
+			for sink in self.sinks:
+				sink.flush()
+		
+		print("HTTP connections: %(opened)d opened, %(reused)d reused over %(requests)d requests" % HTTP_POOL.stats())
+		if pool.retried:
+			print("Retried %d requests" % pool.retried)
+		if limiter:
+			print("Requests/sec per host: %s" % ', '.join(["%s %.1f" % hr for hr in limiter.rates().items()]))
+		if self.dedupe:
+			print("Skipped %(unchanged)d unchanged pages and %(aliases)d aliases of pages already seen" % self.dedupe.stats)
 		print {'status': 'SUCCESS', 'errors' : None}
 		return 1
-				
+	
+	
+	def reparse(self, archive, parsers = 0):
+		'''	Run extraction again over every page in a PageArchive, without going
+			near the network: profiles go to self.restaurants and the sinks as
+			they would in a crawl.  Links aren't followed, the archive already
+			holds every page the crawl reached (though not the extra review
+			pages a ReviewPager fetched).  Pages are parsed by a pool of
+			`parsers` processes, or in this thread when parsers is 0.
+		'''
+		import multiprocessing
+		procs = parsers > 0 and multiprocessing.Pool(parsers) or None
+		pages = archive.pages()
+		results = procs and procs.imap(_reparse_page, pages, 16) or itertools.imap(_reparse_page, pages)
+		count = 0
+		try:
+			for url, result, err, seconds in results:
+				count += 1
+				METRICS.observe('parse', seconds)
+				METRICS.incr('pages')
+				if err:
+					log(str(err))
+					METRICS.incr('parse_errors')
+					continue
+				venue, profile, links = result
+				if profile is None:
+					continue
+				METRICS.incr('profiles')
+				if self.keep_profiles:
+					self.restaurants[url] = Venue.from_dict(profile)
+				for sink in self.sinks:
+					sink.add(profile)
+				if venue:
+					log("Restaurant: %s Info Pulled" % venue)
+		finally:
+			if procs:
+				procs.terminate()
+				procs.join()
+			for sink in self.sinks:
+				sink.flush()
+		print("Reparsed %d archived pages" % count)
+		return 1
+	
+	
+	def __page_reviews(self, url, venue, profile, links, digest, events):
+		'''	Hand the venue to the pager to fill in the reviews on its other review
+			pages, back to the newest one we already have; it comes back to the
+			crawl as a ('reviews', url, (venue, profile, links, digest), error)
+			event once they are in. '''
+		def done(url, profile, links, err):
+			events.put(('reviews', url, (venue, profile, links, digest), err))
+		self.pager.submit(url, profile, links, self.__review_cutoff(url), done)
+	
+	
+	def __review_cutoff(self, url):
+		'''	The date of the newest review of the venue at url that we already
+			have: kept from earlier in this crawl, in the recrawl schedule or in
+			the db.  '' (all of them wanted) when a BulkLoader is going to
+			replace the db's reviews with just the ones this crawl gets. '''
+		if [sink for sink in self.sinks if isinstance(sink, BulkLoader)]:
+			return ''
+		old = self.restaurants.get(url)
+		dates = [rv['dtreviewed'] for rv in old is not None and old['reviews'] or []]
+		if self.schedule:
+			dates.append(self.schedule.last_review(url) or '')
+		for sink in self.sinks:
+			if isinstance(sink, DbSink):
+				dates.append(sink.last_review(url))
+		return max(dates or [''])
+	
+	
+	def __paged(self, url, profile, links):
+		'''	Add to profile, back from the pager, the older reviews kept from
+			earlier in this crawl, and return links less the review pages. '''
+		old = self.restaurants.get(url)
+		old_reviews = old is not None and old['reviews'] or []
+		seen = set([(rv['reviewer'], rv['dtreviewed'], rv['summary']) for rv in profile['reviews']])
+		profile['reviews'].extend([rv for rv in old_reviews
+									if (rv['reviewer'], rv['dtreviewed'], rv['summary']) not in seen])
+		return [link for link in links if not REVIEW_PAGE_RE.search(link)]
+	
+	
+	def __rank_categories(self, tag, found):
+		'''	Credit a page of kind tag with the `found` new venue links on it, and
+			put the kinds of category page with the most new venues per page
+			first in line (behind the venues themselves).  Kinds not tried yet
+			count as one per page, so each gets a look. '''
+		if tag is None or tag == 'by-name':
+			return
+		pages, total = self.link_yield.get(tag, (0, 0))
+		self.link_yield[tag] = (pages + 1, total + found)
+		per_page = lambda t: (self.link_yield.get(t, (0, 0))[1] + 1.0) / (self.link_yield.get(t, (0, 0))[0] + 1.0)
+		categories = [t for t in self.link_queue.order() if t != 'by-name']
+		self.link_queue.priority = ['by-name'] + sorted(categories, key=per_page, reverse=True)
+	
+	
+	def __crawled(self, url, profile=None):
+		''' Regardless of errors, pop the link off the queue and add it to the crawled links '''
+		self._lock.acquire()
+		try:
+			qmsg = self.link_queue.pop(url,'empty')	
+			if qmsg != 'empty':
+				self.crawled.add(url)
+				if self.checkpoint:
+					self.checkpoint.visit(url, profile)
+				log("Adding to Already Crawled: %s" % url)
+				METRICS.incr('pages')
+			log("Crawled %d links so far." % len(self.crawled))
+			log("Crawl Q Has %d links to go" % len(self.link_queue))
+		finally:
+			self._lock.release()
+
+
+def crawl_shard(address, shard, authkey=None, workers=1, host_limit=2, delay=0.0, parsers=0, rate=0.0,
+				max_rate=20.0, retries=3, max_page_bytes=None, dedupe=True, review_pages=0):
+	'''	Run shard number `shard` of a sharded crawl coordinated at address (see
+		crawl_cluster.Cluster): crawl the links that hash to this shard as they
+		come in, from the coordinator and the other shards, sending the others
+		on and every profile back, until the coordinator calls the crawl off.
+		Pages come out of the coordinator's one page budget as they are handed
+		out, and the per-host `rate` is split evenly between the shards, so
+		together they crawl and load the site as one crawl would.
+	'''
+	global BASE_URL
+	from crawl_cluster import ShardLink, AUTHKEY
+	HTTP_POOL.close()  # a forked shard's idle connections are its parent's
+	METRICS.reset()
+	link = ShardLink(address, shard, authkey or AUTHKEY)
+	BASE_URL = link.config['base_url']
+	n, shards = link.config['max_pages'], link.shards
+	crawler = MpCrawler('')
+	crawler.shard = link
+	crawler.sinks = [link]
+	crawler.keep_profiles = False
+	crawler.max_page_bytes = max_page_bytes
+	if not dedupe:
+		crawler.dedupe = None
+	limiter = rate > 0 and HostRateLimiter(rate / shards, max(max_rate, rate) / shards) or None
+	retry = RetryPolicy(retries)
+	if review_pages:
+		crawler.pager = ReviewPager(host_limit, review_pages, host_limit, delay, None, limiter, retry)
+	try:
+		crawler.crawl(n, workers, host_limit, delay, parsers, limiter, retry)
+	finally:
+		if crawler.pager:
+			crawler.pager.close()
+		link.done(len(crawler.crawled), METRICS.export())
+		
+		
 if __name__ == "__main__":
 	
-	fp = fetch_page(BASE_URL)
-	data = fp['data']
-	crawler = MpCrawler(data)
-	crawler.close()
-	#crawler.output_markup()
-	crawler.scan_restaurant_links()
-	crawler.crawl()
+	import optparse, multiprocessing
+	optp = optparse.OptionParser(usage="%prog [options]")
+	optp.add_option('-n', '--max-pages', type='int', dest='max_pages', default=-1,
+					help="stop after crawling this many pages (default: whole site)")
+	optp.add_option('-w', '--workers', type='int', dest='workers', default=1,
+					help="number of concurrent fetch threads [%default]")
+	optp.add_option('--host-limit', type='int', dest='host_limit', default=2,
+					help="max concurrent requests to a single host [%default]")
+	optp.add_option('--delay', type='float', dest='delay', default=0.0,
+					help="min seconds between requests to a single host [%default]")
+	optp.add_option('-p', '--parsers', type='int', dest='parsers', default=0,
+					help="number of parser processes; 0 parses in the crawl thread [%default]")
+	optp.add_option('--rate', type='float', dest='rate', default=5.0,
+					help="starting requests/sec per host, adapted to how the host copes; 0 for no limit [%default]")
+	optp.add_option('--max-rate', type='float', dest='max_rate', default=20.0,
+					help="most requests/sec per host the rate may grow to [%default]")
+	optp.add_option('--retries', type='int', dest='retries', default=3,
+					help="times to retry a fetch that failed or was throttled [%default]")
+	optp.add_option('--max-page-bytes', type='int', dest='max_page_bytes', default=5 << 20, metavar='BYTES',
+					help="drop pages that decompress to more than this; 0 for no cap [%default]")
+	optp.add_option('--cache-dir', dest='cache_dir', default=None,
+					help="keep an HTTP cache here and revalidate pages against it")
+	optp.add_option('--db', action='store_true', dest='db', default=False,
+					help="write profiles to the menupages MySQL db as they are scraped")
+	optp.add_option('--db-file', dest='db_file', default=None, metavar='FILE',
+					help="... or to a SQLite file standing in for it")
+	optp.add_option('--db-reload', action='store_true', dest='db_reload', default=False,
+					help="with --db/--db-file, replace the tables' contents with this crawl's profiles, "
+						 "bulk loaded at the end (much faster than upserting as it goes)")
+	optp.add_option('--csv', dest='csv', default=None, metavar='NAME',
+					help="write profiles to NAME.csv and reviews to NAME_reviews.csv as they are scraped")
+	optp.add_option('--jsonl', dest='jsonl', default=None, metavar='FILE',
+					help="write profiles, one JSON object per line, to FILE as they are scraped")
+	optp.add_option('--gzip', action='store_true', dest='gzip', default=False,
+					help="gzip the --csv/--jsonl output")
+	optp.add_option('--stream-only', action='store_false', dest='keep_profiles', default=True,
+					help="don't also hold scraped profiles in memory (with --db/--db-file/--csv/--jsonl)")
+	optp.add_option('--all-reviews', action='store_true', dest='all_reviews', default=False,
+					help="page through each venue's reviews instead of keeping just the first page")
+	optp.add_option('--review-pages', type='int', dest='review_pages', default=20,
+					help="with --all-reviews, most extra review pages to fetch per venue [%default]")
+	optp.add_option('--recrawl', dest='recrawl', default=None, metavar='FILE',
+					help="keep per-page change history in FILE and spend the -n page budget "
+						 "on the pages most likely to have changed [%s]" % SCHEDULE_FILE)
+	optp.add_option('--no-dedupe', action='store_false', dest='dedupe', default=True,
+					help="parse and write out every page, even ones identical to a page already seen")
+	optp.add_option('-q', '--quiet', action='store_true', dest='quiet', default=False,
+					help="no per-page output, just the periodic stats line and the summary")
+	optp.add_option('--stats-every', type='float', dest='stats_every', default=10.0, metavar='SECS',
+					help="print a line of crawl metrics this often; 0 for none [%default]")
+	optp.add_option('--metrics-file', dest='metrics_file', default=None, metavar='FILE',
+					help="also keep the crawl metrics, as JSON, in FILE")
+	optp.add_option('--analytics', action='store_true', dest='analytics', default=False,
+					help="print rating breakdowns by area, cuisine and feature at the end (needs numpy)")
+	optp.add_option('--archive', dest='archive', default=None, metavar='DIR',
+					help="save the raw body of every page fetched to an archive in DIR")
+	optp.add_option('--reparse', dest='reparse', default=None, metavar='DIR',
+					help="don't crawl: extract profiles again from the pages archived in DIR")
+	optp.add_option('--shards', type='int', dest='shards', default=0,
+					help="split the crawl by url hash between this many shard processes, each with -w fetch threads")
+	optp.add_option('--local-shards', type='int', dest='local_shards', default=None, metavar='N',
+					help="with --shards, run only shards 0..N-1 here and start the rest with --join [all]")
+	optp.add_option('--listen', dest='listen', default='127.0.0.1:0', metavar='HOST:PORT',
+					help="with --shards, where the shards reach the coordinator [%default]")
+	optp.add_option('--join', dest='join', default=None, metavar='HOST:PORT',
+					help="run shard --shard of the sharded crawl coordinated at HOST:PORT")
+	optp.add_option('--shard', type='int', dest='shard', default=0,
+					help="with --join, which shard to run [%default]")
+	optp.add_option('--authkey', dest='authkey', default=None,
+					help="secret the coordinator and its shards share [crawl_cluster.AUTHKEY]")
+	optp.add_option('--checkpoint', dest='checkpoint', default=None, metavar='FILE',
+					help="periodically save crawl progress to FILE")
+	optp.add_option('--resume', action='store_true', dest='resume', default=False,
+					help="pick up the crawl saved in the checkpoint file [%s]" % CHECKPOINT_FILE)
+	opts, args = optp.parse_args()
+	VERBOSE = not opts.quiet
+	
+	sharded = opts.shards > 1
+	if (sharded or opts.join) and (opts.checkpoint or opts.resume or opts.recrawl or opts.archive
+								   or opts.reparse or opts.cache_dir):
+		optp.error("--shards and --join don't combine with --checkpoint, --resume, --recrawl, --archive, "
+				   "--reparse or --cache-dir")
+	shard_opts = dict(workers=opts.workers, host_limit=opts.host_limit, delay=opts.delay, parsers=opts.parsers,
+					  rate=opts.rate, max_rate=opts.max_rate, retries=opts.retries,
+					  max_page_bytes=opts.max_page_bytes or None, dedupe=opts.dedupe,
+					  review_pages=opts.review_pages if opts.all_reviews else 0)
+	if opts.join:
+		host, port = opts.join.rsplit(':', 1)
+		crawl_shard((host, int(port)), opts.shard, opts.authkey, **shard_opts)
+		sys.exit(0)
+	
+	cache = opts.cache_dir and HttpCache(opts.cache_dir) or None
+	checkpoint = None
+	if opts.checkpoint or opts.resume:
+		checkpoint = CrawlCheckpoint(opts.checkpoint or CHECKPOINT_FILE)
+	schedule = opts.recrawl and RecrawlSchedule(opts.recrawl) or None
+	
+	if opts.reparse:
+		crawler = MpCrawler('')
+	elif opts.resume and not checkpoint.is_empty():
+		crawler = MpCrawler('')
+		checkpoint.restore(crawler)
+		print("Resuming: %d links crawled, %d to go" % (len(crawler.crawled), len(crawler.link_queue)))
+		crawler.cache = cache
+		crawler.checkpoint = checkpoint
+		crawler.schedule = schedule
+	elif schedule and not schedule.is_empty():
+		if checkpoint:
+			checkpoint.reset()
+		crawler = MpCrawler('')
+		crawler.cache = cache
+		crawler.checkpoint = checkpoint
+		crawler.schedule = schedule
+		plan = schedule.plan(opts.max_pages)
+		crawler.queue_plan(plan, schedule.venues())
+		print("Recrawling the %d pages most likely to have changed" % len(plan))
+	else:
+		if checkpoint:
+			checkpoint.reset()
+		fp = fetch_page(BASE_URL, cache=cache)
+		data = fp['data']
+		crawler = MpCrawler(data)
+		crawler.close()
+		crawler.cache = cache
+		crawler.checkpoint = checkpoint
+		crawler.schedule = schedule
+		if schedule:
+			schedule.discover([normalize_url(BASE_URL)])  # refetched in later runs for new links
+		#crawler.output_markup()
+		crawler.scan_restaurant_links()
+	
+	db = None
+	if opts.db_file:
+		import sqlite3
+		db = sqlite3.connect(opts.db_file)
+	elif opts.db:
+		db = connect_db(local_infile=opts.db_reload)
+	if db:
+		crawler.sinks.append(opts.db_reload and BulkLoader(db) or DbSink(db))
+	if opts.csv:
+		crawler.sinks.append(CsvSink(opts.csv, compress=opts.gzip))
+	if opts.jsonl:
+		crawler.sinks.append(JsonlSink(opts.jsonl, compress=opts.gzip))
+	if crawler.sinks:
+		crawler.keep_profiles = opts.keep_profiles
+	
+	crawler.max_page_bytes = opts.max_page_bytes or None
+	archive = PageArchive(opts.archive) if opts.archive else None
+	crawler.archive = archive
+	
+	if not opts.dedupe:
+		crawler.dedupe = None
+	elif schedule:
+		crawler.dedupe = ContentFingerprints(*schedule.fingerprints())
+	
+	limiter = opts.rate > 0 and HostRateLimiter(opts.rate, max(opts.max_rate, opts.rate)) or None
+	retry = RetryPolicy(opts.retries)
+	if opts.all_reviews and not sharded:
+		crawler.pager = ReviewPager(opts.host_limit, opts.review_pages, opts.host_limit, opts.delay, cache,
+									limiter, retry)
+	
+	reporter = None
+	if opts.stats_every > 0 or opts.metrics_file:
+		reporter = Reporter(METRICS, opts.stats_every or 10.0, opts.stats_every > 0 and sys.stdout or None,
+							opts.metrics_file)
+	
+	if opts.reparse:
+		reparse_archive = PageArchive(opts.reparse)
+		crawler.reparse(reparse_archive, opts.parsers)
+		reparse_archive.close()
+	elif sharded:
+		from crawl_cluster import Cluster, AUTHKEY  # only sharded crawls pay for multiprocessing.managers
+		host, port = opts.listen.rsplit(':', 1)
+		cluster = Cluster(opts.shards, (host, int(port)), opts.authkey or AUTHKEY, base_url=BASE_URL,
+						  max_pages=opts.max_pages)
+		print("Coordinating %d shards at %s:%d" % ((opts.shards,) + tuple(cluster.server.address)))
+		local = opts.local_shards if opts.local_shards is not None else opts.shards
+		procs = [multiprocessing.Process(target=crawl_shard, args=(cluster.address, i, opts.authkey), kwargs=shard_opts)
+				 for i in xrange(local)]
+		done = cluster.run(crawler, procs)
+		print("Pages crawled by shard: %s" % ', '.join(["%d: %d" % (i, done[i]['pages']) for i in sorted(done)]))
+	else:
+		crawler.crawl(opts.max_pages, opts.workers, opts.host_limit, opts.delay, opts.parsers, limiter, retry)
+	if reporter:
+		reporter.stop()
+	print METRICS.report()
+	if crawler.pager:
+		crawler.pager.close()
+		print "%d Extra Review Pages Fetched" % crawler.pager.fetched
+	if checkpoint:
+		checkpoint.close()
+	if schedule:
+		schedule.close()
+	if archive is not None:
+		archive.close()
+	for sink in crawler.sinks:
+		sink.close()
+		print "%d Restaurant Profiles Written By %s" % (sink.written, type(sink).__name__)
+	if opts.analytics:
+		from crawl_analytics import VenueFrame, summarize, report
+		if crawler.keep_profiles or not db:
+			frame = VenueFrame.from_profiles(crawler.restaurants.itervalues())
+		else:
+			frame = VenueFrame.from_db(db)  # --stream-only: read back what was written
+		print report(summarize(frame))
+	if db:
+		db.close()
 	print "%d Restaurants Crawled Successfully!" % len(crawler.restaurants.keys())
 